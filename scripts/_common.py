@@ -3,13 +3,26 @@ Common functions in support of scripts - do not execute this file direct
 """
 
 import argparse
+from array import array
+import base64
 import csv
 import importlib.util
 import json
 import logging
 from math import floor, log10
 from pathlib import Path
-from typing import Union
+import sys
+from typing import Optional, Union
+import zlib
+
+import numpy as np
+
+
+LINK_NODE_KEYS = ["pickup", "s", "setdown", "split", "t", "u"]  # Link properties of nodes
+DATASET_KEYS = ["link", "node", "place"]  # Aquius keys split by tile, others in tile index
+PLACE_FINGERPRINT = "placeFingerprint"  # Meta key of node coordinates when places last assigned
+EARTH_METRES = 6371000  # Radius
+QUANTIZE_PRECISION = 7  # Decimal places compared by quantize() if precision < 0
 
 
 def get_common_args(doc: str) -> argparse.ArgumentParser:
@@ -47,12 +60,12 @@ def load_json(filepath: Path) -> Union[list, dict]:
         return {}
 
 
-def save_json(data: Union[list, dict], filepath: Path):
-    """Save JSON-like object to JSON file"""
+def save_json(data: Union[list, dict], filepath: Path, compact: bool = False):
+    """Save JSON-like object to JSON file, without whitespace if compact"""
 
     try:
         with open(filepath, mode="w", encoding="utf-8") as file:
-            json.dump(data, file)
+            json.dump(data, file, separators=(",", ":") if compact else None)
     except IOError as err:
         logging.error("Cannot write %s: %s", filepath, err)
 
@@ -92,6 +105,22 @@ def to_precision(numeric: Union[int, float], precision: int) -> Union[int, float
     return round(float(numeric), precision)
 
 
+def quantize(x_values: np.ndarray, y_values: np.ndarray, precision: int) -> np.ndarray:
+    """
+    Returns WGS84 coordinates quantized to precision (at most QUANTIZE_PRECISION) decimal places,
+    the int64 x and y pair packed into one int64, -1 if not finite or out of range
+    """
+
+    scale = 10 ** (min(precision, QUANTIZE_PRECISION) if precision >= 0 else QUANTIZE_PRECISION)
+    with np.errstate(invalid="ignore"):
+        valid = (np.abs(x_values) <= 180) & (np.abs(y_values) <= 90)
+    keys = np.full(len(x_values), -1, dtype=np.int64)
+    x_int = np.rint(x_values[valid] * scale).astype(np.int64) + 180 * scale
+    y_int = np.rint(y_values[valid] * scale).astype(np.int64) + 90 * scale
+    keys[valid] = x_int * (180 * scale + 1) + y_int
+    return keys
+
+
 def get_place_scale(population: int) -> float:
     """Returns appropriate placeScale aquius option based on population of one place"""
 
@@ -130,6 +159,12 @@ def is_aquius(aquius: dict, skip_place: bool = False) -> bool:
     return True
 
 
+def service_property_name(meta_one: dict) -> str:
+    """Returns name for a meta service [1] entry, in English else first available"""
+
+    return meta_one.get("en-US", next(iter(meta_one)))
+
+
 def use_arrow() -> bool:
     """True if pyarrow available (its use is generally faster)"""
 
@@ -138,5 +173,233 @@ def use_arrow() -> bool:
     return False
 
 
+def renumber_link(link: list, node_lookup: dict) -> list:
+    """
+    Returns copy of link with node indices renumbered by lookup: Route, pickup, setdown, split
+    Nodes not in lookup are dropped (with warning if route), as is a property if then empty
+    """
+
+    properties = dict(link[3]) if len(link) > 3 and isinstance(link[3], dict) else {}
+    for key in LINK_NODE_KEYS:
+        if key in properties and isinstance(properties[key], list):
+            nodes = [node_lookup[node] for node in properties[key] if node in node_lookup]
+            if nodes:
+                properties[key] = nodes
+            else:
+                del properties[key]
+    route = [node_lookup[node] for node in link[2] if node in node_lookup]
+    if len(route) < len(link[2]):
+        logging.warning("Dropped %s link route nodes not found", len(link[2]) - len(route))
+    return [link[0], link[1], route, properties]
+
+
+def renumber_node(node: list, place_lookup: dict) -> list:
+    """Returns copy of node with place index renumbered by lookup, dropped if not in lookup"""
+
+    if len(node) < 3 or not isinstance(node[2], dict):
+        return list(node)
+    properties = dict(node[2])
+    for key in ["p", "place"]:
+        if key in properties:
+            if properties[key] in place_lookup:
+                properties[key] = place_lookup[properties[key]]
+            else:
+                del properties[key]
+    return [node[0], node[1], properties] + list(node[3:])
+
+
+def is_bbox_intersect(bbox_a: list, bbox_b: list) -> bool:
+    """True if [min x, min y, max x, max y] bboxes intersect (or touch)"""
+
+    return (bbox_a[0] <= bbox_b[2] and bbox_b[0] <= bbox_a[2] and
+            bbox_a[1] <= bbox_b[3] and bbox_b[1] <= bbox_a[3])
+
+
+def load_aquius_bbox(filepath: Path, bbox: Optional[list] = None) -> dict:
+    """
+    Load tiled aquius (index filepath, as aquius_tile.py) within [min x, min y, max x, max y]
+    (all if None), stitching tiles into one dataset, nodes, links and places in original order
+    Links include all their nodes (whether or not within bbox)
+    """
+
+    index = load_json(filepath=filepath)
+    if not isinstance(index, dict) or not isinstance(index.get("tile"), list):
+        logging.error("Not a tiled aquius index: %s", filepath)
+        return {}
+    tiles = []
+    entries: dict[str, dict[int, tuple]] = {key: {} for key in DATASET_KEYS}
+    for tile in index["tile"]:
+        if bbox is not None and not is_bbox_intersect(tile["bbox"], bbox):
+            continue
+        tiled = load_json(filepath=Path(filepath).parent / tile["file"])
+        if not tiled:
+            continue
+        tiles.append(tiled)
+        # Tile entries are indexed locally, held once by original (global) index
+        for key in DATASET_KEYS:
+            for local_id, global_id in enumerate(tiled["id"][key]):
+                if global_id not in entries[key]:
+                    entries[key][global_id] = (tiled[key][local_id], len(tiles) - 1)
+
+    stitched = {key: {global_id: stitched_id for stitched_id, global_id in enumerate(
+        sorted(entries[key]))} for key in DATASET_KEYS}
+    # Local index of each tile to stitched index
+    lookup = [{key: {local_id: stitched[key][global_id] for local_id, global_id in enumerate(
+        tiled["id"][key])} for key in ["node", "place"]} for tiled in tiles]
+
+    aquius = {key: value for key, value in index.items() if key != "tile"}
+    aquius["place"] = [entries["place"][global_id][0] for global_id in sorted(entries["place"])]
+    aquius["node"] = [renumber_node(node=node, place_lookup=lookup[tile_id]["place"])
+                      for node, tile_id in (entries["node"][global_id]
+                                            for global_id in sorted(entries["node"]))]
+    aquius["link"] = [renumber_link(link=link, node_lookup=lookup[tile_id]["node"])
+                      for link, tile_id in (entries["link"][global_id]
+                                            for global_id in sorted(entries["link"]))]
+    return aquius
+
+
+def node_fingerprint(nodes: list) -> list[int]:
+    """Returns crc32 of the coordinates of each node"""
+
+    return [zlib.crc32(f"{node[0]}:{node[1]}".encode()) if isinstance(node, list) and len(
+        node) >= 2 else 0 for node in nodes]
+
+
+def set_place_fingerprint(aquius: dict, source: str):
+    """Records source (hash of place data) and node fingerprint in aquius meta"""
+
+    fingerprint = array("I", node_fingerprint(aquius["node"]))
+    if sys.byteorder == "big":
+        fingerprint.byteswap()  # Stored little-endian
+    aquius["meta"][PLACE_FINGERPRINT] = {
+        "source": source,
+        "node": base64.b64encode(fingerprint.tobytes()).decode("ascii"),
+    }
+
+
+def get_node_place(node: list, place_count: int) -> Optional[int]:
+    """Returns valid place index of node, else None"""
+
+    if len(node) < 3 or not isinstance(node[2], dict):
+        return None
+    place = node[2].get("p", node[2].get("place"))
+    if isinstance(place, int) and not isinstance(place, bool) and 0 <= place < place_count:
+        return place
+    return None
+
+
+def changed_nodes(aquius: dict, source: str) -> list[int]:
+    """
+    Returns indices of nodes needing place assignment: All unless the meta fingerprint was
+    recorded with the same source, else only nodes moved since, or without a valid place
+    """
+
+    recorded = aquius["meta"].get(PLACE_FINGERPRINT)
+    if not isinstance(recorded, dict) or recorded.get("source") != source:
+        return list(range(len(aquius["node"])))
+    try:
+        fingerprint = array("I", base64.b64decode(recorded.get("node", "")))
+    except ValueError:
+        return list(range(len(aquius["node"])))
+    if sys.byteorder == "big":
+        fingerprint.byteswap()
+    place_count = len(aquius.get("place", []))
+    return [node_id for node_id, (node, current) in enumerate(zip(
+        aquius["node"], node_fingerprint(aquius["node"])))
+        if node_id >= len(fingerprint) or fingerprint[node_id] != current or
+        get_node_place(node=node, place_count=place_count) is None]
+
+
+def clear_node_place(node: list):
+    """Removes any place from node"""
+
+    if len(node) > 2 and isinstance(node[2], dict):
+        node[2].pop("p", None)
+        node[2].pop("place", None)
+
+
+def get_max_population(places: list) -> int:
+    """Returns largest integer population of places, else 0"""
+
+    populations = [0]
+    for place in places:
+        if len(place) > 2 and isinstance(place[2], dict):
+            population = place[2].get("p", place[2].get("population"))
+            if isinstance(population, (int, float)) and not isinstance(population, bool):
+                populations.append(int(population))
+    return max(populations)
+
+
+def place_keys(place: list) -> list[str]:
+    """Returns keys identifying place: By name, and by coordinates"""
+
+    keys = []
+    properties = place[2] if len(place) > 2 and isinstance(place[2], dict) else {}
+    reference = properties.get("r", properties.get("reference"))
+    if isinstance(reference, list) and reference and isinstance(reference[0], dict) and (
+            "n" in reference[0]):
+        keys.append(f"n:{reference[0]['n']}")
+    if len(place) >= 2:
+        keys.append(f"xy:{place[0]}:{place[1]}")
+    return keys
+
+
+def index_places(places: list) -> dict[str, int]:
+    """Returns place_keys(): index in places, first place kept where keys repeat"""
+
+    index: dict[str, int] = {}
+    for place_id, place in enumerate(places):
+        for key in place_keys(place=place):
+            index.setdefault(key, place_id)
+    return index
+
+
+def match_place(place_index: dict[str, int], place: list) -> Optional[int]:
+    """Returns index of existing place matching place by name, else coordinates, else None"""
+
+    for key in place_keys(place=place):
+        if key in place_index:
+            return place_index[key]
+    return None
+
+
+def collect_places(aquius: dict) -> dict:
+    """Removes places referenced by no node, renumbering node places, returns aquius"""
+
+    place_count = len(aquius["place"])
+    referenced = sorted(set(get_node_place(node=node, place_count=place_count)
+                            for node in aquius["node"]) - {None})
+    if len(referenced) == place_count:
+        return aquius
+    place_lookup = {place_id: new_id for new_id, place_id in enumerate(referenced)}
+    aquius["place"] = [aquius["place"][place_id] for place_id in referenced]
+    aquius["node"] = [renumber_node(node=node, place_lookup=place_lookup)
+                      for node in aquius["node"]]
+    return aquius
+
+
+def entry_xy(entries: list) -> np.ndarray:
+    """Returns x, y of node or place entries, NaN if not numeric"""
+
+    xy = np.full((len(entries), 2), np.nan, dtype=np.float64)
+    for entry_id, entry in enumerate(entries):
+        if (isinstance(entry, list) and len(entry) >= 2 and
+                all(isinstance(value, (int, float)) and not isinstance(value, bool)
+                    for value in entry[:2])):
+            xy[entry_id] = entry[:2]
+    return xy
+
+
+def unit_xyz(xy: np.ndarray) -> np.ndarray:
+    """Returns WGS84 x, y as unit sphere cartesian coordinates, for KD-tree chord distance"""
+
+    radians = np.radians(xy)
+    return np.stack([
+        np.cos(radians[:, 1]) * np.cos(radians[:, 0]),
+        np.cos(radians[:, 1]) * np.sin(radians[:, 0]),
+        np.sin(radians[:, 1]),
+    ], axis=1)
+
+
 if __name__ == "__main__":
     logging.error("Run other scripts, not this directly")
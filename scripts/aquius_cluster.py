@@ -0,0 +1,229 @@
+"""
+Python script that clusters near-duplicate nodes (stops) of an aquius file, such as those of
+different operators a few metres apart, which merge.js only groups if coordinates match exactly
+at coordinatePrecision:
+* Nodes within --radius metres are found by KD-tree (in one query of all pairs).
+* Clusters are formed around the most served nodes first, each node joining the first cluster
+  whose (central) node is within radius - so clusters never span more than twice the radius.
+* Each cluster is collapsed to its central node, adding the references (and any missing place
+  or other property) of the rest, as merge_aquius.py.
+* Link nodes, pickup, setdown and split are rewritten, consecutive repeats of a node dropped
+  (dwell summed), and links that become identical are merged with their services summed.
+  A clustered node only keeps a pickup or setdown restriction if all its nodes had it.
+* Links left with less than 2 nodes (all within one cluster) are dropped.
+* Places are unchanged.
+
+Usage: python aquius_cluster.py aquius.json --radius 10 --output clustered.json
+See aquius_cluster.py -h for further arguments
+"""
+
+import argparse
+import copy
+import logging
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from _common import (EARTH_METRES, LINK_NODE_KEYS, entry_xy, get_common_args, is_aquius,
+                     load_json, save_json, unit_xyz)
+from merge_aquius import link_key, merge_link, within_keys
+
+
+def get_args() -> argparse.Namespace:
+    """Get command line arguments or apply defaults"""
+
+    parser = get_common_args(doc=__doc__)
+    parser.add_argument(
+        "--radius",
+        dest="radius",
+        type=float,
+        default=10,
+        help="Metres within which nodes are clustered into one.",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=Path,
+        default=Path("clustered.json"),
+        help="Output clustered aquius .json filename with path.",
+    )
+    return parser.parse_args()
+
+
+def node_occurrence(aquius: dict) -> np.ndarray:
+    """Returns count of link route, pickup, setdown and split references to each node"""
+
+    occurrence = np.zeros(len(aquius["node"]), dtype=np.int64)
+    for link in aquius["link"]:
+        nodes = list(link[2])
+        if len(link) > 3 and isinstance(link[3], dict):
+            for key in LINK_NODE_KEYS:
+                if isinstance(link[3].get(key), list):
+                    nodes += link[3][key]
+        for node in nodes:
+            if isinstance(node, int) and 0 <= node < len(occurrence):
+                occurrence[node] += 1
+    return occurrence
+
+
+def cluster_nodes(xy: np.ndarray, radius: float, occurrence: np.ndarray) -> np.ndarray:
+    """
+    Returns central node index of the cluster of each node (itself if unclustered), clusters
+    centred on the most occurring nodes first, nodes without coordinates never clustered
+    """
+
+    centre = np.arange(len(xy), dtype=np.int64)
+    valid = np.flatnonzero(np.isfinite(xy).all(axis=1))
+    if len(valid) < 2 or radius <= 0:
+        return centre
+    chord = 2 * np.sin(min(radius / EARTH_METRES, np.pi) / 2)
+    pairs = cKDTree(unit_xyz(xy[valid])).query_pairs(r=chord, output_type="ndarray")
+    if len(pairs) == 0:
+        return centre
+    pairs = valid[pairs]
+    adjacency = sparse.coo_matrix(
+        (np.ones(2 * len(pairs), dtype=np.int8),
+         (np.concatenate([pairs[:, 0], pairs[:, 1]]), np.concatenate([pairs[:, 1], pairs[:, 0]]))),
+        shape=(len(xy), len(xy))).tocsr()
+
+    is_assigned = np.zeros(len(xy), dtype=bool)
+    near = np.flatnonzero(np.diff(adjacency.indptr) > 0)
+    # Descending occurrence, then ascending index
+    for node in near[np.lexsort((near, -occurrence[near]))].tolist():
+        if is_assigned[node]:
+            continue
+        is_assigned[node] = True
+        neighbour = adjacency.indices[adjacency.indptr[node]:adjacency.indptr[node + 1]]
+        neighbour = neighbour[~is_assigned[neighbour]]
+        is_assigned[neighbour] = True
+        centre[neighbour] = node
+    return centre
+
+
+def merge_node(target: dict, properties: dict):
+    """Adds properties of a clustered node to its central node properties (target)"""
+
+    for name, value in properties.items():
+        if name in ["r", "reference"]:
+            if not isinstance(value, list):
+                continue
+            existing = target.setdefault(name, [])
+            for reference in value:
+                if not within_keys(reference, existing):
+                    existing.append(reference)
+        elif name in ["p", "place"]:
+            if "p" not in target and "place" not in target:
+                target[name] = value  # Node can only be in one place
+        elif name not in target:
+            target[name] = value
+
+
+def rewrite_link(link: list, node_lookup: dict) -> list:
+    """
+    Returns copy of link with nodes switched by lookup, consecutive repeats dropped. A node
+    keeps pickup or setdown restriction only if every route node collapsed into it had it
+    """
+
+    properties = copy.deepcopy(link[3]) if len(link) > 3 and isinstance(link[3], dict) else {}
+    dwell_key = "w" if "w" in properties else "dwell"
+    dwell = properties.get(dwell_key)
+    has_dwell = isinstance(dwell, list) and len(dwell) == len(link[2])
+    route = []
+    route_dwell = []
+    collapsed: dict = {}  # Node: Set of original route nodes
+    for position, node in enumerate(link[2]):
+        original = node
+        node = node_lookup.get(node, node)
+        collapsed.setdefault(node, set()).add(original)
+        if route and route[-1] == node:
+            if has_dwell and isinstance(dwell[position], (int, float)):
+                route_dwell[-1] += dwell[position]
+            continue
+        route.append(node)
+        if has_dwell:
+            route_dwell.append(dwell[position])
+    if has_dwell:
+        properties[dwell_key] = route_dwell
+
+    for key in LINK_NODE_KEYS:
+        if isinstance(properties.get(key), list):
+            restricted = set(properties[key])
+            nodes = []
+            for node in properties[key]:
+                node = node_lookup.get(node, node)
+                if node in nodes:
+                    continue
+                if key in ["pickup", "s", "setdown", "u"] and node in collapsed and \
+                        not collapsed[node].issubset(restricted):
+                    continue
+                nodes.append(node)
+            if nodes:
+                properties[key] = nodes
+            else:
+                del properties[key]
+    return [list(link[0]), list(link[1]), route, properties]
+
+
+def cluster(aquius: dict, radius: float) -> dict:
+    """Returns copy of aquius with nodes within radius metres clustered, links merged"""
+
+    centre = cluster_nodes(xy=entry_xy(aquius["node"]), radius=radius,
+                           occurrence=node_occurrence(aquius=aquius))
+    centres = np.unique(centre)
+    node_lookup = dict(zip(range(len(centre)), np.searchsorted(centres, centre).tolist()))
+
+    clustered = {key: value for key, value in aquius.items() if key not in ["link", "node"]}
+    clustered["node"] = []
+    for node in centres.tolist():
+        entry = copy.deepcopy(aquius["node"][node])
+        if len(entry) < 3 or not isinstance(entry[2], dict):
+            entry = list(entry[:2]) + [{}] + list(entry[3:])
+        clustered["node"].append(entry)
+    for node in np.flatnonzero(centre != np.arange(len(centre))).tolist():
+        original = aquius["node"][node]
+        if len(original) > 2 and isinstance(original[2], dict):
+            merge_node(target=clustered["node"][node_lookup[node]][2],
+                       properties=copy.deepcopy(original[2]))
+
+    clustered["link"] = []
+    link_lookup: dict = {}  # link_key(): index in clustered["link"]
+    dropped = 0
+    for link in aquius["link"]:
+        link = rewrite_link(link=link, node_lookup=node_lookup)
+        if len(link[2]) < 2:
+            dropped += 1
+            continue
+        key = link_key(product=link[0], node=link[2], prop=link[3])
+        if key in link_lookup:
+            merge_link(target=clustered["link"][link_lookup[key]], service=link[1],
+                       prop=link[3])
+        else:
+            link_lookup[key] = len(clustered["link"])
+            clustered["link"].append(link)
+    if dropped > 0:
+        logging.warning("Dropped %s links with less than 2 nodes after clustering", dropped)
+    return clustered
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    if args is None:
+        args = get_args()
+    aquius = load_json(filepath=args.aquius)
+    if not is_aquius(aquius=aquius, skip_place=True):
+        logging.error("Not an aquius file: %s", args.aquius)
+        return
+    clustered = cluster(aquius=aquius, radius=args.radius)
+    logging.warning("Clustered %s nodes to %s, %s links to %s", len(aquius["node"]),
+                    len(clustered["node"]), len(aquius["link"]), len(clustered["link"]))
+    save_json(data=clustered, filepath=args.output)
+
+
+if __name__ == "__main__":
+    main()
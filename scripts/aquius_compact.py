@@ -0,0 +1,205 @@
+"""
+Python script that compacts an aquius file, without changing its meaning:
+* Nodes and places are reordered along a Hilbert curve, so nearby nodes hold nearby indices
+  (link node lists then repeat similar numbers, which compress well).
+* Link nodes, pickup, setdown and split, and node place, are renumbered to match.
+* Nodes not served by any link, and places of no node, are dropped.
+* Pickup, setdown and split are sorted and unique, and repeated link references dropped.
+* Long property keys are replaced by their short forms (as README Data Structure).
+* Links are sorted by their (renumbered) nodes, links of each block kept in original order.
+* JSON is written without whitespace.
+
+Usage: python aquius_compact.py aquius.json --output compact.json
+See aquius_compact.py -h for further arguments
+"""
+
+import argparse
+import json
+import logging
+from pathlib import Path
+import time
+
+import numpy as np
+
+from _common import (LINK_NODE_KEYS, entry_xy, get_common_args, is_aquius, load_json,
+                     renumber_link, renumber_node, save_json)
+
+
+HILBERT_ORDER = 16  # Bits per axis
+LINK_SHORT = {"block": "b", "circular": "c", "direction": "d", "pickup": "u", "reference": "r",
+              "setdown": "s", "shared": "h", "split": "t"}
+NODE_SHORT = {"place": "p", "reference": "r"}
+PLACE_SHORT = {"population": "p", "reference": "r"}
+
+
+def get_args() -> argparse.Namespace:
+    """Get command line arguments or apply defaults"""
+
+    parser = get_common_args(doc=__doc__)
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=Path,
+        default=Path("compact.json"),
+        help="Output compacted aquius .json filename with path.",
+    )
+    return parser.parse_args()
+
+
+def hilbert_index(xy: np.ndarray, order: int = HILBERT_ORDER) -> np.ndarray:
+    """Returns Hilbert curve distance of each x, y (scaled to their bbox), NaN rows last"""
+
+    valid = ~np.isnan(xy).any(axis=1)
+    index = np.full(len(xy), np.iinfo(np.int64).max, dtype=np.int64)
+    if not valid.any():
+        return index
+    side = 1 << order
+    minimum = xy[valid].min(axis=0)
+    extent = np.maximum(xy[valid].max(axis=0) - minimum, 1e-12)
+    grid = np.minimum(((xy[valid] - minimum) / extent * side).astype(np.int64), side - 1)
+    x_value = grid[:, 0]
+    y_value = grid[:, 1]
+    distance = np.zeros(len(grid), dtype=np.int64)
+    step = side >> 1
+    while step > 0:
+        x_bit = (x_value & step) > 0
+        y_bit = (y_value & step) > 0
+        distance += step * step * ((3 * x_bit) ^ y_bit)
+        # Rotate quadrant, such that the curve is continuous
+        flip = ~y_bit & x_bit
+        x_value = np.where(flip, side - 1 - x_value, x_value)
+        y_value = np.where(flip, side - 1 - y_value, y_value)
+        x_value, y_value = np.where(~y_bit, y_value, x_value), np.where(~y_bit, x_value, y_value)
+        step >>= 1
+    index[valid] = distance
+    return index
+
+
+def shorten(properties: dict, short: dict, long_first: bool) -> dict:
+    """Returns properties with long keys as short, the key here() reads taking precedence"""
+
+    shortened = {}
+    for key, value in properties.items():
+        if key in short and short[key] in properties and not long_first:
+            continue  # Short key read first
+        if key not in short and key in shortened and long_first:
+            continue  # Long key (already shortened) read first
+        shortened[short.get(key, key)] = value
+    return shortened
+
+
+def unique_list(values: list) -> list:
+    """Returns values in original order, excluding repeats"""
+
+    unique = []
+    for value in values:
+        if value not in unique:
+            unique.append(value)
+    return unique
+
+
+def compact(aquius: dict) -> dict:
+    """Returns compacted copy of aquius, raising ValueError if links reference missing nodes"""
+
+    node_count = len(aquius["node"])
+    served = set()
+    for link in aquius["link"]:
+        for node in link[2]:
+            if not isinstance(node, int) or not 0 <= node < node_count:
+                raise ValueError(f"Link references missing node {node}")
+            served.add(node)
+        if len(link) > 3 and isinstance(link[3], dict):
+            for key in LINK_NODE_KEYS:
+                if isinstance(link[3].get(key), list):
+                    served.update(node for node in link[3][key]
+                                  if isinstance(node, int) and 0 <= node < node_count)
+
+    nodes = np.array(sorted(served), dtype=np.int64)
+    nodes = nodes[np.argsort(hilbert_index(entry_xy(aquius["node"])[nodes]), kind="stable")]
+    node_lookup = {int(node): new_id for new_id, node in enumerate(nodes)}
+
+    places = aquius.get("place", [])
+    placed = set()
+    for node in nodes.tolist():
+        properties = aquius["node"][node][2] if len(aquius["node"][node]) > 2 and isinstance(
+            aquius["node"][node][2], dict) else {}
+        place = properties.get("p", properties.get("place"))
+        if isinstance(place, int) and 0 <= place < len(places):
+            placed.add(place)
+    place_ids = np.array(sorted(placed), dtype=np.int64)
+    place_ids = place_ids[np.argsort(hilbert_index(entry_xy(places)[place_ids]), kind="stable")]
+    place_lookup = {int(place): new_id for new_id, place in enumerate(place_ids)}
+
+    compacted = {key: value for key, value in aquius.items()
+                 if key not in ["link", "node", "place"]}
+    compacted["place"] = []
+    for place in place_ids.tolist():
+        entry = list(places[place])
+        if len(entry) > 2 and isinstance(entry[2], dict):
+            entry[2] = shorten(properties=entry[2], short=PLACE_SHORT, long_first=False)
+        compacted["place"].append(entry)
+    compacted["node"] = []
+    for node in nodes.tolist():
+        entry = aquius["node"][node]
+        if len(entry) > 2 and isinstance(entry[2], dict):
+            entry = list(entry)
+            entry[2] = shorten(properties=entry[2], short=NODE_SHORT, long_first=False)
+        compacted["node"].append(renumber_node(node=entry, place_lookup=place_lookup))
+
+    links = []
+    for link in aquius["link"]:
+        link = renumber_link(link=link, node_lookup=node_lookup)
+        properties = shorten(properties=link[3], short=LINK_SHORT, long_first=True)
+        for key in ["u", "s", "t"]:
+            if isinstance(properties.get(key), list):
+                properties[key] = sorted(set(properties[key]))
+        if isinstance(properties.get("r"), list):
+            properties["r"] = unique_list(properties["r"])
+        links.append([link[0], link[1], link[2], properties])
+
+    # Links of each block retain their order (here() counts a block once, as first walked)
+    block_first: dict = {}
+    sort_keys = []
+    for position, link in enumerate(links):
+        block = link[3].get("b")
+        first = position if block is None else block_first.setdefault(json.dumps(block), position)
+        sort_keys.append((links[first][2], links[first][0], first, position))
+    compacted["link"] = [links[position] for position in sorted(
+        range(len(links)), key=lambda position: sort_keys[position])]
+    return compacted
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    if args is None:
+        args = get_args()
+    aquius = load_json(filepath=args.aquius)
+    if not is_aquius(aquius=aquius, skip_place=True):
+        logging.error("Not an aquius file: %s", args.aquius)
+        return
+    try:
+        compacted = compact(aquius=aquius)
+    except ValueError as err:
+        logging.error("Cannot compact %s: %s", args.aquius, err)
+        return
+    save_json(data=compacted, filepath=args.output, compact=True)
+
+    try:
+        sizes = [Path(args.aquius).stat().st_size, Path(args.output).stat().st_size]
+    except OSError:
+        return
+    timings = []
+    for filepath in [args.aquius, args.output]:
+        start = time.perf_counter()
+        load_json(filepath=filepath)
+        timings.append(time.perf_counter() - start)
+    logging.warning("Compacted %s bytes to %s (%.0f%%), parsed in %.3fs not %.3fs",
+                    sizes[0], sizes[1], 100 * sizes[1] / max(1, sizes[0]), timings[1], timings[0])
+
+
+if __name__ == "__main__":
+    main()
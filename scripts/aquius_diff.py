@@ -0,0 +1,362 @@
+"""
+Python script that reports changes in service between two releases of an aquius dataset,
+such as one year and the next, by route, operator and node.
+Links are matched across releases by fingerprint: A stable hash of their products, node
+coordinates (quantized at --precision) in sequence, and direction, circular, pickup, setdown
+and split - not by index, which differs between releases. Links with the same fingerprint are
+summed. Links are then compared by hash join, so time scales linearly with links:
+* Added - fingerprint only in the --compare (new) release.
+* Removed - fingerprint only in the original (old) release.
+* Changed - fingerprint in both, with different service.
+Routes are grouped by operator names and link reference names, service as whole links.
+Operator and node service is shared between operators, as aquius_to_csv.py.
+Services are compared by name (as aquius service), only those in both releases.
+Rows without change are omitted unless --unchanged.
+
+Usage: python aquius_diff.py old.json --compare new.json
+See aquius_diff.py -h for further arguments
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from _common import get_common_args, is_aquius, load_json, quantize
+from aquius_to_csv import encode_names, flatten_links, get_service_columns, group_sum, save_output
+
+
+LINK_FINGERPRINT_KEYS = [("c", "circular"), ("d", "direction")]  # Short, long
+LINK_FINGERPRINT_NODES = [("s", "setdown"), ("t", "split"), ("u", "pickup")]
+
+
+def get_args() -> argparse.Namespace:
+    """Get command line arguments or apply defaults"""
+
+    parser = get_common_args(doc=__doc__)
+    parser.add_argument(
+        "--compare",
+        dest="compare",
+        type=Path,
+        help="Newer aquius .json filename with path, compared to aquius",
+    )
+    parser.add_argument(
+        "--precision",
+        dest="precision",
+        type=int,
+        default=5,
+        help="Decimal places of node coordinates matched (as GTFS To Aquius coordinatePrecision)",
+    )
+    parser.add_argument(
+        "--unchanged",
+        dest="unchanged",
+        action="store_true",
+        help="Include rows without change",
+    )
+    parser.add_argument(
+        "--format",
+        dest="format",
+        nargs="+",
+        type=str,
+        default=["csv"],
+        choices=["csv", "pq"],
+        help="Output file format (csv pq), Parquet replacing filename suffix with .pq",
+    )
+    parser.add_argument(
+        "--route",
+        dest="route",
+        type=Path,
+        default="route_diff.csv",
+        help="Output route change CSV",
+    )
+    parser.add_argument(
+        "--operator",
+        dest="operator",
+        type=Path,
+        default="operator_diff.csv",
+        help="Output operator change CSV",
+    )
+    parser.add_argument(
+        "--node",
+        dest="node",
+        type=Path,
+        default="node_diff.csv",
+        help="Output node change CSV",
+    )
+    return parser.parse_args()
+
+
+def get_property(properties: dict, short: str, long: str):
+    """Returns short, else long, key of properties, else None"""
+
+    return properties.get(short, properties.get(long))
+
+
+def link_fingerprint(product: list, node: np.ndarray, properties: dict, node_keys: np.ndarray,
+                     product_keys: list) -> int:
+    """Returns signed 64-bit blake2b hash of link products, node_keys sequence and properties"""
+
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(json.dumps([product_keys[value] if isinstance(value, int) and 0 <= value < len(
+        product_keys) else value for value in product]).encode())
+    digest.update(node_keys[node].tobytes())
+    for short, long in LINK_FINGERPRINT_KEYS:
+        digest.update(f"|{short}:{json.dumps(get_property(properties, short, long))}".encode())
+    for short, long in LINK_FINGERPRINT_NODES:
+        nodes = get_property(properties, short, long)
+        digest.update(f"|{short}:".encode())
+        if isinstance(nodes, list):
+            nodes = [value for value in nodes if isinstance(value, int) and 0 <= value < len(
+                node_keys)]
+            digest.update(np.unique(node_keys[nodes]).tobytes())
+    return int.from_bytes(digest.digest(), byteorder="little", signed=True)
+
+
+def get_release(inputted: dict, service_columns: dict[str, list[int]], precision: int) -> dict:
+    """
+    Returns columnar release (as aquius_to_csv.flatten_links), adding per link: fingerprint,
+    link_service (whole link), operator and route names, and per link node: node_key
+    """
+
+    release = flatten_links(inputted=inputted, service_columns=service_columns)
+    xy = np.full((len(inputted["node"]), 2), np.nan, dtype=np.float64)
+    names = []
+    for node_id, node in enumerate(inputted["node"]):
+        name = ""
+        if isinstance(node, list) and len(node) >= 2:
+            try:
+                xy[node_id] = [float(node[0]), float(node[1])]
+            except (TypeError, ValueError):
+                pass
+            if len(node) > 2 and isinstance(node[2], dict):
+                reference = get_property(node[2], "r", "reference")
+                if isinstance(reference, list) and reference and isinstance(reference[0], dict):
+                    name = str(reference[0].get("n", ""))
+        names.append(name)
+    node_keys = quantize(x_values=xy[:, 0], y_values=xy[:, 1], precision=precision)
+    release["node_key"] = node_keys[release["node"]]
+    release["node_xy"] = xy
+    release["node_name"] = names
+
+    products = inputted.get("reference", {}).get("product", [])
+    product_keys = [json.dumps(product, sort_keys=True) for product in products]
+    operator_names = [product.get("en-US", "UKNOWN") if isinstance(product, dict) else "UKNOWN"
+                      for product in products]  # As aquius_to_csv
+    release["operator_name"] = [operator_names[product] if 0 <= product < len(
+        operator_names) else "UKNOWN" for product in release["product"].tolist()]
+
+    fingerprints = []
+    routes = []
+    node_start = np.searchsorted(release["node_link"], np.arange(len(release["service"]) + 1))
+    product_start = np.searchsorted(release["product_link"],
+                                    np.arange(len(release["service"]) + 1))
+    link_id = 0
+    for link in inputted["link"]:
+        if not (isinstance(link, list) and len(link) >= 4):
+            continue  # As flatten_links
+        properties = link[3] if isinstance(link[3], dict) else {}
+        fingerprints.append(link_fingerprint(
+            product=link[0], node=release["node"][node_start[link_id]:node_start[link_id + 1]],
+            properties=properties, node_keys=node_keys, product_keys=product_keys))
+        reference = get_property(properties, "r", "reference")
+        route = [str(entry.get("n", "")) for entry in reference if isinstance(entry, dict)] if (
+            isinstance(reference, list)) else []
+        operators = release["operator_name"][product_start[link_id]:product_start[link_id + 1]]
+        routes.append((" | ".join(operators), " | ".join(route)))
+        link_id += 1
+    release["fingerprint"] = np.array(fingerprints, dtype=np.int64)
+    release["route"] = routes
+    release["link_service"] = release["service"] * np.bincount(
+        release["product_link"], minlength=len(release["service"])).reshape(-1, 1)
+    return release
+
+
+def join_links(old: dict, new: dict) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns status of each link of old and of new: 0 unchanged, 1 changed, 2 removed (old) or
+    added (new), links of the same fingerprint summed before comparison
+    """
+
+    summed = []
+    for release in [old, new]:
+        unique, inverse = np.unique(release["fingerprint"], return_inverse=True)
+        summed.append((unique, inverse, group_sum(inverse, weights=release["link_service"],
+                                                  size=len(unique))))
+    # Hash join of old and new fingerprints
+    lookup = dict(zip(summed[1][0].tolist(), range(len(summed[1][0]))))
+    old_match = np.array([lookup.get(fingerprint, -1) for fingerprint in summed[0][0].tolist()],
+                         dtype=np.int64)
+    is_matched = old_match >= 0
+    is_changed = np.zeros(len(old_match), dtype=bool)
+    is_changed[is_matched] = ~np.isclose(summed[0][2][is_matched],
+                                         summed[1][2][old_match[is_matched]]).all(axis=1)
+    old_status = np.where(is_matched, is_changed.astype(np.int8), 2).astype(np.int8)
+    new_status = np.full(len(summed[1][0]), 2, dtype=np.int8)
+    new_status[old_match[is_matched]] = old_status[is_matched]
+    statuses = [old_status[summed[0][1]], new_status[summed[1][1]]]
+    return statuses[0], statuses[1]
+
+
+def compare_groups(old_ids: np.ndarray, old_weights: np.ndarray, new_ids: np.ndarray,
+                   new_weights: np.ndarray, size: int) -> dict[str, np.ndarray]:
+    """Returns old and new service (weights summed by id), and presence of ids in each"""
+
+    return {
+        "old": group_sum(old_ids, weights=old_weights, size=size),
+        "new": group_sum(new_ids, weights=new_weights, size=size),
+        "in_old": np.bincount(old_ids, minlength=size) > 0,
+        "in_new": np.bincount(new_ids, minlength=size) > 0,
+    }
+
+
+def status_name(compared: dict, group: int, link_change: int) -> str:
+    """Returns added, removed, changed or unchanged for group of compare_groups()"""
+
+    if not compared["in_old"][group]:
+        return "added"
+    if not compared["in_new"][group]:
+        return "removed"
+    if link_change > 0 or not np.isclose(compared["old"][group], compared["new"][group]).all():
+        return "changed"
+    return "unchanged"
+
+
+def service_row(compared: dict, group: int, service_names: list[str]) -> dict:
+    """Returns old, new and change of each service of group of compare_groups()"""
+
+    row = {}
+    for column, name in enumerate(service_names):
+        old_value = round(float(compared["old"][group, column]), 2)
+        new_value = round(float(compared["new"][group, column]), 2)
+        row[f"{name}_old"] = old_value
+        row[f"{name}_new"] = new_value
+        row[f"{name}_change"] = round(new_value - old_value, 2)
+    return row
+
+
+def link_counts(old_ids: np.ndarray, old_status: np.ndarray, new_ids: np.ndarray,
+                new_status: np.ndarray, size: int) -> dict[str, np.ndarray]:
+    """Returns counts of links added, removed and changed by group id"""
+
+    return {
+        "links_added": np.bincount(new_ids[new_status == 2], minlength=size),
+        "links_removed": np.bincount(old_ids[old_status == 2], minlength=size),
+        "links_changed": np.bincount(new_ids[new_status == 1], minlength=size),
+    }
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    if args is None:
+        args = get_args()
+    inputs = []
+    for filepath in [args.aquius, args.compare]:
+        inputted = load_json(filepath=filepath)
+        if not is_aquius(inputted):
+            logging.error("Not an aquius file: %s", filepath)
+            return
+        inputs.append(inputted)
+
+    columns = [get_service_columns(inputted=inputted, use_service_index=None)
+               for inputted in inputs]
+    service_names = [name for name in columns[0] if name in columns[1]]
+    if not service_names:
+        logging.error("No service in common between %s and %s", args.aquius, args.compare)
+        return
+    if len(service_names) < max(len(columns[0]), len(columns[1])):
+        logging.warning("Only services in both compared: %s", ", ".join(service_names))
+    old, new = [get_release(inputted=inputted, service_columns={
+        name: release_columns[name] for name in service_names}, precision=args.precision)
+        for inputted, release_columns in zip(inputs, columns)]
+    old_status, new_status = join_links(old=old, new=new)
+    service_columns = [f"{name}_{suffix}" for name in service_names
+                       for suffix in ["old", "new", "change"]]
+    count_columns = ["links_added", "links_removed", "links_changed"]
+
+    # Route
+    route_id, route_names = encode_names([json.dumps(route) for route in old["route"] +
+                                          new["route"]])
+    old_route = route_id[:len(old["route"])]
+    new_route = route_id[len(old["route"]):]
+    compared = compare_groups(old_ids=old_route, old_weights=old["link_service"],
+                              new_ids=new_route, new_weights=new["link_service"],
+                              size=len(route_names))
+    counts = link_counts(old_ids=old_route, old_status=old_status, new_ids=new_route,
+                         new_status=new_status, size=len(route_names))
+    output = []
+    for route, name in enumerate(route_names):
+        change = sum(int(counts[column][route]) for column in count_columns)
+        status = status_name(compared=compared, group=route, link_change=change)
+        if status != "unchanged" or args.unchanged:
+            operator, route_name = json.loads(name)
+            output.append({"operator": operator, "route": route_name, "status": status,
+                           **{column: int(counts[column][route]) for column in count_columns},
+                           **service_row(compared=compared, group=route,
+                                         service_names=service_names)})
+    save_output(filepath=args.route, content=output,
+                columns=["operator", "route", "status"] + count_columns + service_columns,
+                formats=args.format)
+
+    # Operator, service shared between the operators of each link (as aquius_to_csv)
+    operator_id, operator_names = encode_names(old["operator_name"] + new["operator_name"])
+    old_operator = operator_id[:len(old["operator_name"])]
+    new_operator = operator_id[len(old["operator_name"]):]
+    compared = compare_groups(
+        old_ids=old_operator, old_weights=old["service"][old["product_link"]],
+        new_ids=new_operator, new_weights=new["service"][new["product_link"]],
+        size=len(operator_names))
+    counts = link_counts(old_ids=old_operator, old_status=old_status[old["product_link"]],
+                         new_ids=new_operator, new_status=new_status[new["product_link"]],
+                         size=len(operator_names))
+    output = []
+    for operator, name in enumerate(operator_names):
+        change = sum(int(counts[column][operator]) for column in count_columns)
+        status = status_name(compared=compared, group=operator, link_change=change)
+        if status != "unchanged" or args.unchanged:
+            output.append({"operator": name, "status": status,
+                           **{column: int(counts[column][operator]) for column in count_columns},
+                           **service_row(compared=compared, group=operator,
+                                         service_names=service_names)})
+    save_output(filepath=args.operator, content=output,
+                columns=["operator", "status"] + count_columns + service_columns,
+                formats=args.format)
+
+    # Node, by quantized coordinates (as aquius_to_csv, service shared between operators)
+    node_keys, node_id = np.unique(np.concatenate([old["node_key"], new["node_key"]]),
+                                   return_inverse=True)
+    old_node = node_id[:len(old["node_key"])]
+    new_node = node_id[len(old["node_key"]):]
+    compared = compare_groups(
+        old_ids=old_node, old_weights=old["service"][old["node_link"]],
+        new_ids=new_node, new_weights=new["service"][new["node_link"]], size=len(node_keys))
+    # Coordinates and name of each node, from the newer release where present
+    node_source = np.full(len(node_keys), -1, dtype=np.int64)
+    node_release = np.zeros(len(node_keys), dtype=np.int8)
+    node_source[old_node] = old["node"]
+    node_source[new_node] = new["node"]
+    node_release[new_node] = 1
+    output = []
+    for node in range(len(node_keys)):
+        status = status_name(compared=compared, group=node, link_change=0)
+        if node_keys[node] >= 0 and (status != "unchanged" or args.unchanged):
+            release = [old, new][node_release[node]]
+            x_value, y_value = release["node_xy"][node_source[node]].tolist()
+            output.append({"x": x_value, "y": y_value,
+                           "name": release["node_name"][node_source[node]], "status": status,
+                           **service_row(compared=compared, group=node,
+                                         service_names=service_names)})
+    save_output(filepath=args.node, content=output,
+                columns=["x", "y", "name", "status"] + service_columns, formats=args.format)
+    logging.warning("Links: %s added, %s removed, %s changed", int((new_status == 2).sum()),
+                    int((old_status == 2).sum()), int((new_status == 1).sum()))
+
+
+if __name__ == "__main__":
+    main()
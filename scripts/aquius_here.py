@@ -0,0 +1,756 @@
+"""
+Python port of aquius.here() (dist/aquius.js): Answers here queries without a browser,
+returning the same summary (link services, node count, place population) and link, node,
+place and here geometry, or GeoJSON. Options match aquius.here(), as README Here Queries:
+x, y, range (metres), network, service, place, connectivity, geoJSON.
+The dataset is sanitized and parsed once: Node coordinates are held in a KD-tree,
+nodes are indexed to the links that serve them, and link properties are parsed, so each
+query only walks links serving nodes within here.
+
+Usage: python aquius_here.py aquius.json --x -3.7 --y 40.4 --range 1000
+See aquius_here.py -h for further arguments
+"""
+
+import argparse
+from copy import deepcopy
+import json
+import logging
+from math import isnan, pi, sin
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from _common import EARTH_METRES, get_common_args, load_json, save_json, unit_xyz
+from gtfs_to_aquius import js_key_order, js_round
+
+
+SCHEMA_DEFAULT = {
+    # Minimum default structure of each entry, by schema, as here() parseDataObject
+    "0": {
+        "link": [[0], [0], [0], {}],
+        "network": [[0], {"en-US": "Unknown"}, {}],
+        "node": [0, 0, {}],
+        "place": [0, 0, {}],
+        "service": [[0], {"en-US": "Unknown"}, {}]
+    }
+}
+GEOJSON_LAYERS = ["here", "link", "node", "place"]
+
+
+def get_args() -> argparse.Namespace:
+    """Get command line arguments or apply defaults"""
+
+    parser = get_common_args(doc=__doc__)
+    parser.add_argument(
+        "--x",
+        dest="x",
+        type=float,
+        default=None,
+        help="Longitude of here in WGS 84",
+    )
+    parser.add_argument(
+        "--y",
+        dest="y",
+        type=float,
+        default=None,
+        help="Latitude of here in WGS 84",
+    )
+    parser.add_argument(
+        "--range",
+        dest="range",
+        type=float,
+        default=None,
+        help="Distance from here searched for nodes, in metres",
+    )
+    parser.add_argument(
+        "--place",
+        dest="place",
+        nargs="+",
+        type=int,
+        default=None,
+        help="Place indices defining here, in addition to any range",
+    )
+    parser.add_argument(
+        "--network",
+        dest="network",
+        type=int,
+        default=None,
+        help="Network filter index (position in array)",
+    )
+    parser.add_argument(
+        "--service",
+        dest="service",
+        type=int,
+        default=None,
+        help="Service filter index (position in array)",
+    )
+    parser.add_argument(
+        "--connectivity",
+        dest="connectivity",
+        type=float,
+        default=None,
+        help="Factor weighting population by service level",
+    )
+    parser.add_argument(
+        "--geojson",
+        dest="geojson",
+        nargs="+",
+        type=str,
+        default=None,
+        choices=GEOJSON_LAYERS,
+        help="Output layers as GeoJSON (here link node place), else as here()",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=Path,
+        default="here.json",
+        help="Output JSON filename",
+    )
+    return parser.parse_args()
+
+
+def js_typeof(value) -> str:
+    """JavaScript typeof equivalent for JSON-like values (None as undefined)"""
+
+    if value is None:
+        return "undefined"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    return "object"
+
+
+def js_truthy(value) -> bool:
+    """JavaScript truthiness of JSON-like values"""
+
+    if isinstance(value, (list, dict)):
+        return True
+    if isinstance(value, float) and isnan(value):
+        return False
+    return bool(value)
+
+
+def js_number_string(value: Union[int, float]) -> str:
+    """Number toString() equivalent, for common magnitudes"""
+
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e21:
+        return str(int(value))
+    if isinstance(value, float) and 1e-7 <= abs(value) < 1e-4:
+        return np.format_float_positional(value)
+    return repr(value).replace("e-0", "e-")
+
+
+def js_string(value) -> str:
+    """String coercion of JSON-like values, as used for JavaScript object keys"""
+
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return js_number_string(value)
+    if value is None:
+        return "null"
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, separators=(",", ":"))
+
+
+def get_alias(properties: dict, long_key: str, short_key: str, default=None):
+    """Returns long_key else short_key value, as here() aliases link properties"""
+
+    if long_key in properties:
+        return properties[long_key]
+    return properties.get(short_key, default)
+
+
+def sanitize_aquius(aquius: dict) -> dict:
+    """
+    Replaces missing or incomplete structures with defaults, as here() parseDataObject
+    Unlike here(), None (null) is treated as missing, and entries not lists are replaced
+    """
+
+    if not isinstance(aquius, dict):
+        aquius = {}
+    if not isinstance(aquius.get("meta"), dict):
+        aquius["meta"] = {}
+    if js_string(aquius["meta"].get("schema")) not in SCHEMA_DEFAULT:
+        aquius["meta"]["schema"] = "0"
+    defaults = SCHEMA_DEFAULT[js_string(aquius["meta"]["schema"])]
+
+    for key, default in defaults.items():
+        if not isinstance(aquius.get(key), list) or len(aquius[key]) == 0:
+            aquius[key] = [deepcopy(default)]
+
+        for position, line in enumerate(aquius[key]):
+            if not isinstance(line, list):
+                aquius[key][position] = line = deepcopy(default)
+            if len(line) < len(default):
+                for index in range(len(line) - 1, len(default)):
+                    # Replicates here(), which appends from the last existing entry
+                    line.append(deepcopy(default[index]) if index >= 0 else None)
+
+            for index, default_value in enumerate(default):
+                if js_typeof(line[index]) != js_typeof(default_value):
+                    if key in ["node", "place"] and index == 2 and js_typeof(
+                            line[index]) == "number":
+                        line[index] = {"p": line[index]}  # Old non-property structure
+                    elif key == "link" and index in [0, 1] and js_typeof(
+                            line[index]) == "number":
+                        line[index] = [line[index]]  # Old non-array product structure
+                    else:
+                        line[index] = deepcopy(default_value)
+                if isinstance(line[index], list):
+                    default_item = default_value[0] if isinstance(default_value, list) else None
+                    for item_index, item in enumerate(line[index]):
+                        if js_typeof(item) != js_typeof(default_item):
+                            line[index][item_index] = deepcopy(default_item)
+
+    return aquius
+
+
+def to_set(values: list) -> set:
+    """Returns set of the hashable (number or string) values"""
+
+    return {value for value in values if isinstance(value, (int, float, str))}
+
+
+def reference_keys(references: List[dict]) -> List[tuple]:
+    """Returns (key, reference) of link references, key by id, else name, else color"""
+
+    keyed = []
+    for reference in references:
+        if not isinstance(reference, dict):
+            continue
+        for key in ["i", "n", "c"]:
+            if key in reference:
+                keyed.append((js_string(reference[key]), reference))
+                break
+    return keyed
+
+
+def merge_reference(master: dict, add: List[tuple]) -> dict:
+    """Adds link reference_keys() to master, unique by key, first added kept"""
+
+    for key, reference in add:
+        if key not in master:
+            master[key] = reference
+    return master
+
+
+def reference_to_array(reference: dict) -> list:
+    """Returns merge_reference() master as list, sorted by key"""
+
+    return [reference[key] for key in sorted(reference)]
+
+
+class Here:
+    """
+    Parsed aquius dataset answering repeat here queries
+    Dataset is sanitized in place, unless sanitize is False (only safe if already sanitized)
+    """
+
+    def __init__(self, aquius: dict, sanitize: bool = True):
+        self.aquius = sanitize_aquius(aquius) if sanitize else aquius
+        self.has_place = len(self.aquius["place"]) > 0
+        self.levels: Dict[Optional[int], List[float]] = {}
+        self.parse_node()
+        self.parse_link()
+
+    def parse_node(self):
+        """Node coordinates, KD-tree and place lookups"""
+
+        nodes = self.aquius["node"]
+        self.node_xy = np.full((len(nodes), 2), np.nan, dtype=np.float64)
+        self.node_place: List[int] = []  # Place of node, -1 if none, as walkServiceRoutes
+        self.node_place_key: List[tuple] = []  # (has key, p, place), as createLinkChecks
+        for node_id, node in enumerate(nodes):
+            if len(node) > 1 and js_typeof(node[0]) == "number" and js_typeof(
+                    node[1]) == "number":
+                self.node_xy[node_id] = node[:2]
+            properties = node[2] if len(node) > 2 and isinstance(node[2], dict) else {}
+            place_id = properties.get("p", properties.get("place", -1))
+            self.node_place.append(place_id if js_typeof(place_id) == "number" else -1)
+            self.node_place_key.append(("p" in properties or "place" in properties,
+                                        properties.get("p"), properties.get("place")))
+
+        self.tree_node = np.flatnonzero(~np.isnan(self.node_xy).any(axis=1))
+        self.tree = (cKDTree(unit_xyz(self.node_xy[self.tree_node]))
+                     if len(self.tree_node) > 0 else None)
+
+    def parse_link(self):
+        """Link properties parsed once, and node to link incidence"""
+
+        self.link: List[dict] = []
+        incidence_node = []
+        incidence_link = []
+        for link_id, link in enumerate(self.aquius["link"]):
+            properties = link[3] if isinstance(link[3], dict) else {}
+            reference = get_alias(properties, "reference", "r")
+            if isinstance(reference, list) and len(reference) > 0:
+                # As here(), which assigns link products to each reference
+                reference = [{**entry, "p": link[0]} if isinstance(entry, dict) else entry
+                             for entry in reference]
+            else:
+                reference = None
+            pickup = get_alias(properties, "pickup", "u")
+            setdown = get_alias(properties, "setdown", "s")
+            split = get_alias(properties, "split", "t")
+            self.link.append({
+                "product": to_set(link[0]),
+                "shared": [properties[key] for key in ["h", "shared"]
+                           if isinstance(properties.get(key), (int, float))],
+                "node": link[2],
+                "has_pickup": "u" in properties or "pickup" in properties,
+                "has_setdown": "s" in properties or "setdown" in properties,
+                "has_direction": "d" in properties or "direction" in properties,
+                "pickup_list": pickup if isinstance(pickup, list) else None,
+                "setdown_list": setdown if isinstance(setdown, list) else None,
+                "pickup": to_set(pickup) if isinstance(pickup, list) and len(pickup) > 0 else None,
+                "setdown": (to_set(setdown) if isinstance(setdown, list) and len(setdown) > 0
+                            else None),
+                "split": to_set(split) if isinstance(split, list) and len(split) > 0 else None,
+                "circular": len(link[2]) > 1 and js_truthy(
+                    get_alias(properties, "circular", "c", False)),
+                "direction": js_truthy(get_alias(properties, "direction", "d", False)),
+                "reference": None if reference is None else reference_keys(reference),
+                "block": (js_string(get_alias(properties, "block", "b"))
+                          if "b" in properties or "block" in properties else None),
+            })
+            for node_id in set(link[2]):
+                if isinstance(node_id, int) and 0 <= node_id < len(self.aquius["node"]):
+                    incidence_node.append(node_id)
+                    incidence_link.append(link_id)
+
+        self.incidence = sparse.csr_array((
+            np.ones(len(incidence_node), dtype=bool),
+            (np.array(incidence_node, dtype=np.int64), np.array(incidence_link, dtype=np.int64))),
+            shape=(len(self.aquius["node"]), len(self.aquius["link"])))
+
+    def get_levels(self, service: Optional[int]) -> List[float]:
+        """Returns service level of every link for service filter index (None if all)"""
+
+        if service not in self.levels:
+            indices = None if service is None else to_set(self.aquius["service"][service][0])
+            levels = []
+            for link in self.aquius["link"]:
+                if len(link[1]) == 1 and (indices is None or 0 in indices):
+                    levels.append(link[1][0])
+                    continue
+                level = 0
+                for index, value in enumerate(link[1]):
+                    if indices is None or index in indices:
+                        level += value
+                levels.append(level)
+            self.levels[service] = levels
+        return self.levels[service]
+
+    def find_here(self, options: dict) -> np.ndarray:
+        """Returns node indices within here, as createLinkChecks"""
+
+        node_count = len(self.aquius["node"])
+        if "range" in options and "x" in options and "y" in options:
+            if self.tree is None or isnan(options["range"]):
+                return np.zeros(0, dtype=np.int64)
+            angle = min(max(options["range"], 0) / EARTH_METRES, pi)
+            chord = 2 * sin(angle / 2) * (1 + 1e-9) + 1e-12
+            candidate = self.tree_node[np.array(self.tree.query_ball_point(
+                unit_xyz(np.array([[options["x"], options["y"]]], dtype=np.float64))[0],
+                r=chord), dtype=np.int64)]
+            candidate.sort()
+            # Exact test with here() haversine, as the tree is only a filter
+            rad = pi / 180
+            lat = self.node_xy[candidate, 1]
+            lng = self.node_xy[candidate, 0]
+            sin_lat = np.sin((lat - options["y"]) * rad / 2)
+            sin_lng = np.sin((lng - options["x"]) * rad / 2)
+            a_value = (sin_lat * sin_lat + np.cos(options["y"] * rad) * np.cos(lat * rad) *
+                       sin_lng * sin_lng)
+            distance = EARTH_METRES * 2 * np.arctan2(np.sqrt(a_value), np.sqrt(1 - a_value))
+            here = candidate[options["range"] >= distance]
+        else:
+            here = np.arange(node_count, dtype=np.int64)
+
+        if isinstance(options.get("place"), list):
+            places = options["place"]
+            here = here[[not has_key or (p_id is not None and p_id in places) or (
+                place_id is not None and place_id in places)
+                for has_key, p_id, place_id in (self.node_place_key[node_id]
+                                                for node_id in here.tolist())]]
+        return here
+
+    @staticmethod
+    def is_here_ok(link: dict, here: set) -> bool:
+        """At least one node in here that is not setdown only, or if unidirectional, pickup"""
+
+        for node_id in link["node"]:
+            if node_id in here:
+                if not link["has_setdown"]:
+                    return True
+                if link["setdown_list"] is not None and node_id not in link["setdown_list"]:
+                    return True
+                if not link["has_direction"]:
+                    if not link["has_pickup"]:
+                        return True
+                    if link["pickup_list"] is not None and node_id not in link["pickup_list"]:
+                        return True
+        return False
+
+    def query(self, options: Optional[dict] = None) -> dict:
+        """Returns here() output for options (as here(), excluding callback and sanitize)"""
+
+        if not isinstance(options, dict):
+            options = {}
+        for key in ["x", "y", "range"]:
+            if key in options and js_typeof(options[key]) != "number":
+                return {"error": "Here parameters not numeric"}
+
+        raw: dict = {}
+        if "x" in options and "y" in options and "range" in options:
+            raw["here"] = [{"circle": [options["x"], options["y"]], "value": options["range"]}]
+        raw["summary"] = {"link": 0, "node": 0, "place": 0}
+
+        product = None
+        if (js_typeof(options.get("network")) == "number" and
+                0 <= options["network"] < len(self.aquius["network"])):
+            product = to_set(self.aquius["network"][options["network"]][0])
+        service = None
+        if (js_typeof(options.get("service")) == "number" and
+                0 <= options["service"] < len(self.aquius["service"])):
+            service = options["service"]
+        levels = self.get_levels(service=service)
+
+        here_nodes = self.find_here(options=options)
+        here = set(here_nodes.tolist())
+        walk = Walk(here=here, has_place=self.has_place, node_place=self.node_place)
+        # Only links serving here can pass is_here_ok, walked in link order as here()
+        for link_id in np.unique(self.incidence[here_nodes].indices).tolist():
+            link = self.link[link_id]
+            if product is not None:
+                if not link["product"] & product:
+                    continue
+                if any(shared in product for shared in link["shared"]):
+                    continue
+            if not self.is_here_ok(link=link, here=here):
+                continue
+            if levels[link_id] > 0:
+                walk.walk(link=link, level=levels[link_id])
+
+        raw["summary"]["link"] = walk.summary_link
+        raw["link"] = self.path_routes(service_link=walk.service_link)
+        raw["node"] = self.add_node(raw=raw, service_node=walk.service_node)
+        raw["place"] = self.add_place(raw=raw, connect=walk.connect, options=options)
+
+        if not isinstance(options.get("geoJSON"), list):
+            return raw
+        return self.to_geojson(raw=raw, layers=options["geoJSON"])
+
+    def path_routes(self, service_link: Dict[int, Dict[int, dict]]) -> List[dict]:
+        """Builds link polylines of the same service level, as here() pathRoutes"""
+
+        od: Dict[str, List[list]] = {}
+        data: Dict[str, dict] = {}
+        for origin in sorted(service_link):
+            for destination in sorted(service_link[origin]):
+                entry = service_link[origin][destination]
+                key = js_number_string(entry["service"]) + ":" + ":".join(
+                    js_key_order(list(entry["reference"].keys())))
+                if key not in od:
+                    od[key] = []
+                    data[key] = entry
+                od[key].append([origin, destination])
+
+        links = []
+        max_node = len(self.aquius["node"]) - 1
+        for key in js_key_order(list(od.keys())):
+            pairs = od[key]
+            stack = [pairs.pop()]
+            while pairs:
+                pair = pairs.pop()
+                for position, path in enumerate(stack):
+                    # here() compares to the stack length position, not that of the path
+                    last = path[len(stack) - 1] if len(stack) - 1 < len(path) else None
+                    if pair[0] == path[0]:
+                        path.insert(0, pair[1])
+                        break
+                    if pair[1] == path[0]:
+                        path.insert(0, pair[0])
+                        break
+                    if pair[0] == last:
+                        path.append(pair[1])
+                        break
+                    if pair[1] == last:
+                        path.append(pair[0])
+                        break
+                    if position == len(stack) - 1:
+                        stack.append(pair)
+                        break
+            for path in stack:
+                links.append({
+                    "polyline": [[self.aquius["node"][node_id][0], self.aquius["node"][node_id][1]]
+                                 for node_id in path if 0 <= node_id <= max_node],
+                    "value": data[key]["service"],
+                    "link": reference_to_array(data[key]["reference"]),
+                })
+        return links
+
+    def add_node(self, raw: dict, service_node: Dict[int, dict]) -> List[dict]:
+        """Returns node geometry, counting nodes into summary"""
+
+        nodes = []
+        for node_id in sorted(service_node):
+            if node_id < 0 or node_id >= len(self.aquius["node"]):
+                continue
+            raw["summary"]["node"] += 1
+            node = self.aquius["node"][node_id]
+            geometry = {
+                "circle": [node[0], node[1]],
+                "value": service_node[node_id]["service"],
+                "link": reference_to_array(service_node[node_id]["reference"]),
+            }
+            reference = get_alias(node[2], "reference", "r") if isinstance(node[2], dict) else None
+            if isinstance(reference, (list, str)) and len(reference) > 0:
+                geometry["node"] = reference
+            nodes.append(geometry)
+        return nodes
+
+    def add_place(self, raw: dict, connect: Dict[int, float], options: dict) -> List[dict]:
+        """Returns place geometry, counting population into summary"""
+
+        places = []
+        for place_id in js_key_order([js_string(key) for key in connect]):
+            place_id = float(place_id)
+            place_id = int(place_id) if place_id.is_integer() else place_id
+            if place_id >= len(self.aquius["place"]) or not isinstance(place_id, int):
+                continue
+            place = self.aquius["place"][place_id]
+            properties = place[2] if isinstance(place[2], dict) else {}
+            population = properties.get("p", properties.get("population", 0))
+            if js_typeof(population) != "number" or isnan(population):
+                continue
+            if js_typeof(options.get("connectivity")) == "number" and options[
+                    "connectivity"] > 0:
+                population = population * (1 - (1 / (connect[place_id] *
+                                                     options["connectivity"])))
+            population = js_round(population)
+            if population > 0:
+                raw["summary"]["place"] += population
+                geometry = {"circle": [place[0], place[1]], "value": population}
+                reference = get_alias(properties, "r", "reference")
+                if reference is not None:
+                    geometry["place"] = reference
+                places.append(geometry)
+        return places
+
+    @staticmethod
+    def to_geojson(raw: dict, layers: List[str]) -> dict:
+        """Returns raw as a GeoJSON FeatureCollection of layers"""
+
+        features = []
+        for layer in layers:
+            for entry in raw.get(layer, []):
+                if "value" not in entry or ("circle" not in entry and "polyline" not in entry):
+                    continue
+                if "circle" in entry:
+                    geometry = {"type": "Point", "coordinates": entry["circle"]}
+                else:
+                    geometry = {"type": "LineString", "coordinates": list(entry["polyline"])}
+                properties = {"type": layer, "value": entry["value"]}
+                for key in ["link", "node", "place"]:
+                    if key in entry:
+                        properties[key] = entry[key]
+                features.append({"type": "Feature", "geometry": geometry,
+                                 "properties": properties})
+        return {"type": "FeatureCollection", "features": features}
+
+
+class Walk:
+    """Service by node, link and place for one query, as here() walkServiceRoutes"""
+
+    def __init__(self, here: set, has_place: bool, node_place: List[int]):
+        self.here = here
+        self.has_place = has_place
+        self.node_place = node_place
+        self.service_node: Dict[int, dict] = {}
+        self.service_link: Dict[int, Dict[int, dict]] = {}
+        self.block: Dict[str, set] = {}
+        self.connect: Dict[int, float] = {}
+        self.summary_link = 0
+
+    def route(self, link: dict) -> list:
+        """Returns nodes walked, from here if uni-directional"""
+
+        if not link["direction"]:
+            return link["node"]
+        for position, node_id in enumerate(link["node"]):
+            if node_id in self.here:
+                if link["circular"]:
+                    loop = link["node"][:-1]
+                    loop = loop[position:] + loop[:position]
+                    return loop + [loop[0]]
+                return link["node"][position:]
+        return []
+
+    def is_block_counted(self, link: dict, key) -> bool:
+        """True if block already counted key, else records key"""
+
+        if link["block"] is None:
+            return False
+        counted = self.block.setdefault(link["block"], set())
+        if key in counted:
+            return True
+        counted.add(key)
+        return False
+
+    def add_node_service(self, link: dict, node_id: int, level: float):
+        """Adds service at node"""
+
+        if self.is_block_counted(link=link, key=node_id):
+            return
+        if node_id not in self.service_node:
+            self.service_node[node_id] = {"reference": {}, "service": level}
+        else:
+            self.service_node[node_id]["service"] += level
+        if link["reference"] is not None:
+            merge_reference(self.service_node[node_id]["reference"], link["reference"])
+
+    def add_link_service(self, link: dict, from_node: int, to_node: int, level: float):
+        """Adds service between nodes, origin the larger node index"""
+
+        origin, destination = (to_node, from_node) if from_node < to_node else (from_node, to_node)
+        if self.is_block_counted(link=link, key=(origin, destination)):
+            return
+        destinations = self.service_link.setdefault(origin, {})
+        if destination not in destinations:
+            destinations[destination] = {"reference": {}, "service": level}
+        else:
+            destinations[destination]["service"] += level
+        if link["reference"] is not None:
+            merge_reference(destinations[destination]["reference"], link["reference"])
+
+    def walk(self, link: dict, level: float):
+        """Walks one link, adding its service to nodes, links and places"""
+
+        # pylint: disable=too-many-branches,too-many-locals,too-many-statements
+        here = self.here
+        route = self.route(link=link)
+        pickup = link["pickup"]
+        setdown = link["setdown"]
+        split = link["split"]
+        splits = None
+        if split is not None:
+            splits = 1 if any(node_id not in split and node_id in here
+                              for node_id in link["node"]) else 2
+        direction = link["direction"]
+        circular = link["circular"]
+
+        def _in_here(position: int) -> bool:
+            return 0 <= position < len(route) and route[position] in here
+
+        last_index: Optional[int] = len(route) - 1
+        if pickup is not None and len(route) > 0 and route[-1] in pickup:
+            last_index = None  # All pickup, so never walked
+            for position in range(len(route) - 1, -1, -1):
+                if route[position] not in pickup:
+                    last_index = position
+                    break
+        count_summary = not (link["block"] is not None and link["block"] in self.block)
+
+        been_here = False
+        can_arrive = False
+        can_connect = False
+        count_level = 0
+        placed: Dict[int, float] = {}
+        prev_index = -1
+        prev_level = 0
+        for position in range(0 if last_index is None else last_index + 1):
+            this_level = 0
+            node_id = route[position]
+            in_split = splits is None or splits == 2 or node_id in split
+            can_connect = self.has_place and in_split
+            is_here = node_id in here
+            if not been_here and is_here:
+                been_here = True
+
+            if is_here:
+                if ((can_arrive and (pickup is None or node_id not in pickup)) or (
+                        (setdown is None or node_id not in setdown) and position != last_index)):
+                    # Within here, as arrival or departure
+                    if (not direction and ((position == 0 and not _in_here(position + 1)) or (
+                            position == last_index and not _in_here(position - 1))) and
+                            not circular):
+                        this_level = level / 2  # Terminus
+                    else:
+                        this_level = level
+            elif not direction and ((been_here and (pickup is None or node_id not in pickup)) or (
+                    not been_here and (setdown is None or node_id not in setdown))):
+                this_level = level / 2  # Both directions, halves service outside here
+            elif been_here and (pickup is None or node_id not in pickup):
+                this_level = level  # Uni-directional counts full service after here
+
+            if this_level > 0 and in_split and (not circular or position < last_index):
+                self.add_node_service(link=link, node_id=node_id, level=this_level)
+            if count_summary and this_level > count_level:
+                count_level = this_level
+            if not can_arrive and (setdown is None or node_id not in setdown) and (
+                    not direction or is_here):
+                can_arrive = True  # May be counted as arrival at subsequent nodes
+
+            if prev_index != -1 and prev_level > 0 and (
+                    in_split or route[prev_index] in split):
+                if not direction and route[prev_index] in here and (
+                        setdown is None or pickup is None or node_id not in setdown or
+                        node_id not in pickup):
+                    service_level = this_level
+                else:
+                    service_level = prev_level
+                self.add_link_service(link=link, from_node=route[prev_index], to_node=node_id,
+                                      level=service_level)
+            if this_level > 0:
+                prev_level = this_level
+            prev_index = position
+
+            if can_connect and this_level > 0:
+                place_id = (self.node_place[node_id]
+                            if 0 <= node_id < len(self.node_place) else -1)
+                if place_id >= 0 and (place_id not in placed or this_level > placed[place_id]):
+                    placed[place_id] = this_level
+
+        if splits is None or splits == 2:
+            self.summary_link += count_level
+        if can_connect:
+            for place_id, place_level in placed.items():
+                self.connect[place_id] = self.connect.get(place_id, 0) + place_level
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    if args is None:
+        args = get_args()
+    aquius = load_json(filepath=args.aquius)
+    if not aquius:
+        return
+
+    options = {key: getattr(args, key) for key in [
+        "x", "y", "range", "place", "network", "service", "connectivity"]
+        if getattr(args, key) is not None}
+    if args.geojson is not None:
+        options["geoJSON"] = args.geojson
+    output = Here(aquius=aquius).query(options=options)
+    if "error" in output:
+        logging.error("Here query failed: %s", output["error"])
+        return
+    save_json(data=output, filepath=args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,437 @@
+"""
+Python script serving aquius queries over local HTTP, as JSON, using only the standard library
+asyncio server (no outside services). Each dataset is loaded and parsed once, then held in a
+least recently used cache keyed by path and modification time, so edited files are reloaded.
+Responses are also cached, keyed by dataset and normalised query parameters.
+Endpoints (GET, parameters as query string, dataset=filename stem, else the first dataset):
+* /here: As aquius.here() (aquius_here.py): x, y, range, network, service, connectivity,
+  place (comma separated), geoJSON (comma separated layers).
+* /route: Links serving node, optionally only those that can then reach node to, with
+  service for network and service filters: node, to, network, service.
+* /aggregate: Services by operator or node (as aquius_to_csv.py): by, network, service.
+* /dataset: Datasets available.
+
+Usage: python aquius_server.py aquius.json --dataset other.json --port 8000
+See aquius_server.py -h for further arguments
+"""
+
+import argparse
+import asyncio
+from collections import OrderedDict
+from http import HTTPStatus
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+
+from _common import get_common_args, is_aquius, load_json, service_property_name
+from aquius_here import GEOJSON_LAYERS, Here, get_alias
+from aquius_to_csv import (encode_names, flatten_links, get_service_columns, group_sum,
+                           select_network)
+
+
+MAX_REQUEST_BYTES = 65536
+PARAMETERS = {
+    # Accepted parameters of each endpoint, with type: int, float, list of int, list of str
+    "here": {"x": float, "y": float, "range": float, "network": int, "service": int,
+             "connectivity": float, "place": List[int], "geoJSON": List[str]},
+    "route": {"node": int, "to": int, "network": int, "service": int},
+    "aggregate": {"by": str, "network": int, "service": int},
+    "dataset": {},
+}
+
+
+class QueryError(ValueError):
+    """Query cannot be answered, with HTTP status"""
+
+    def __init__(self, message: str, status: HTTPStatus = HTTPStatus.BAD_REQUEST):
+        super().__init__(message)
+        self.status = status
+
+
+def get_args() -> argparse.Namespace:
+    """Get command line arguments or apply defaults"""
+
+    parser = get_common_args(doc=__doc__)
+    parser.add_argument(
+        "--dataset",
+        dest="dataset",
+        nargs="+",
+        type=Path,
+        default=[],
+        help="Further aquius .json files served, addressed by filename stem.",
+    )
+    parser.add_argument(
+        "--host",
+        dest="host",
+        type=str,
+        default="127.0.0.1",
+        help="Host address served.",
+    )
+    parser.add_argument(
+        "--port",
+        dest="port",
+        type=int,
+        default=8000,
+        help="Port served.",
+    )
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        type=int,
+        default=2,
+        help="Maximum parsed datasets held in memory.",
+    )
+    parser.add_argument(
+        "--responses",
+        dest="responses",
+        type=int,
+        default=1024,
+        help="Maximum responses held in memory.",
+    )
+    return parser.parse_args()
+
+
+class Dataset:
+    """Parsed aquius dataset, with aggregates built when first requested"""
+
+    def __init__(self, aquius: dict):
+        self.here = Here(aquius=aquius)
+        self.flat: Dict[Optional[int], Dict[str, np.ndarray]] = {}
+
+    def get_flat(self, service: Optional[int]) -> Tuple[List[str], Dict[str, np.ndarray]]:
+        """Returns service names and flattened links (as aquius_to_csv) for service index"""
+
+        aquius = self.here.aquius
+        if service is None:
+            service_columns = get_service_columns(inputted=aquius, use_service_index=None)
+        else:
+            service_columns = {service_property_name(meta_one=aquius["service"][service][1]):
+                               aquius["service"][service][0]}
+        if service not in self.flat:
+            self.flat[service] = flatten_links(inputted=aquius, service_columns=service_columns)
+        return list(service_columns.keys()), self.flat[service]
+
+    def query_here(self, params: dict) -> dict:
+        """Returns here() output"""
+
+        options = {key: value for key, value in params.items() if key != "geoJSON"}
+        if "geoJSON" in params:
+            unknown = set(params["geoJSON"]) - set(GEOJSON_LAYERS)
+            if unknown:
+                raise QueryError(f"Unknown geoJSON layers: {', '.join(sorted(unknown))}")
+            options["geoJSON"] = params["geoJSON"]
+        output = self.here.query(options=options)
+        if "error" in output:
+            raise QueryError(output["error"])
+        return output
+
+    def query_route(self, params: dict) -> dict:
+        """Returns links serving node (then to), with products, service, nodes and names"""
+
+        here = self.here
+        aquius = here.aquius
+        node_count = len(aquius["node"])
+        for key in ["node", "to"]:
+            if key in params and not 0 <= params[key] < node_count:
+                raise QueryError(f"Node {params[key]} not found", HTTPStatus.NOT_FOUND)
+        if "node" not in params:
+            raise QueryError("Route requires node")
+        self.check_index(params=params)
+        levels = here.get_levels(service=params.get("service"))
+        products = None
+        if "network" in params:
+            products = set(aquius["network"][params["network"]][0])
+        product_names = aquius.get("reference", {}).get("product", [])
+
+        route = []
+        for link_id in here.incidence[[params["node"]]].indices.tolist():
+            link = here.link[link_id]
+            if products is not None and not link["product"] & products:
+                continue
+            if levels[link_id] <= 0:
+                continue
+            nodes = link["node"]
+            if "to" in params:
+                origin = [pos for pos, node_id in enumerate(nodes) if node_id == params["node"]]
+                destination = [pos for pos, node_id in enumerate(nodes)
+                               if node_id == params["to"]]
+                if not destination or (link["direction"] and not link["circular"] and
+                                       min(origin) >= max(destination)):
+                    continue
+            reference = get_alias(aquius["link"][link_id][3], "reference", "r", [])
+            route.append({
+                "link": link_id,
+                "product": [product_names[product_id].get("en-US", product_id)
+                            if product_id < len(product_names) and isinstance(
+                                product_names[product_id], dict) else product_id
+                            for product_id in aquius["link"][link_id][0]],
+                "service": levels[link_id],
+                "direction": link["direction"],
+                "circular": link["circular"],
+                "name": [entry["n"] for entry in reference
+                         if isinstance(entry, dict) and "n" in entry],
+                "node": nodes,
+            })
+        return {"route": route}
+
+    def query_aggregate(self, params: dict) -> dict:
+        """Returns services summed by operator or node, as aquius_to_csv"""
+
+        aquius = self.here.aquius
+        self.check_index(params=params)
+        service_names, flat = self.get_flat(service=params.get("service"))
+        if "network" in params:
+            flat = select_network(inputted=aquius, flat=flat, network=params["network"])
+        by = params.get("by", "operator")
+        if by == "operator":
+            operator_id, operator_names = encode_names([
+                product.get("en-US", "UKNOWN") if isinstance(product, dict) else "UKNOWN"
+                for product in aquius.get("reference", {}).get("product", [])])
+            valid = flat["product"] < len(operator_id)
+            link_operator = operator_id[flat["product"][valid]]
+            operator_service = group_sum(link_operator, weights=flat["service"][
+                flat["product_link"][valid]], size=len(operator_names))
+            return {"operator": [{
+                "operator": name, **dict(zip(service_names, operator_service[operator].tolist()))
+            } for operator, name in enumerate(operator_names)
+                if np.any(operator_service[operator])]}
+        if by == "node":
+            node_count = len(aquius["node"])
+            valid = (flat["node"] >= 0) & (flat["node"] < node_count)
+            node_service = group_sum(flat["node"][valid], weights=flat["service"][
+                flat["node_link"][valid]], size=node_count)
+            return {"node": [{
+                "node": node_id, "x": aquius["node"][node_id][0], "y": aquius["node"][node_id][1],
+                **{name: round(value, 2) for name, value in zip(
+                    service_names, node_service[node_id].tolist())}
+            } for node_id in np.flatnonzero(np.any(node_service, axis=1)).tolist()]}
+        raise QueryError(f"Unknown aggregate by: {by}")
+
+    def check_index(self, params: dict):
+        """Raises QueryError if network or service index is not in dataset"""
+
+        for key in ["network", "service"]:
+            if key in params and not 0 <= params[key] < len(self.here.aquius[key]):
+                raise QueryError(f"{key.title()} {params[key]} not found", HTTPStatus.NOT_FOUND)
+
+
+class DatasetCache:
+    """Least recently used parsed datasets, keyed by path and modification time"""
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self.datasets: OrderedDict[Tuple[str, int], Dataset] = OrderedDict()
+        self.loading: Dict[Tuple[str, int], asyncio.Lock] = {}  # Per key, while loading
+
+    async def get(self, filepath: Path) -> Tuple[Tuple[str, int], Dataset]:
+        """
+        Returns cache key and dataset, loading in a thread if not held. Each key is parsed
+        once, however many requests wait for it, without delaying requests for other keys
+        """
+
+        try:
+            key = (str(filepath.resolve()), filepath.stat().st_mtime_ns)
+        except OSError as err:
+            raise QueryError(f"Cannot load {filepath.name}: {err.strerror}",
+                             HTTPStatus.SERVICE_UNAVAILABLE) from err
+        if key in self.datasets:
+            self.datasets.move_to_end(key)
+            return key, self.datasets[key]
+        lock = self.loading.setdefault(key, asyncio.Lock())
+        async with lock:
+            try:
+                if key in self.datasets:  # Loaded by another request while waiting
+                    self.datasets.move_to_end(key)
+                    return key, self.datasets[key]
+                aquius = await asyncio.to_thread(load_json, filepath)
+                if not is_aquius(aquius=aquius, skip_place=True):
+                    raise QueryError(f"Not an aquius file: {filepath.name}",
+                                     HTTPStatus.SERVICE_UNAVAILABLE)
+                dataset = await asyncio.to_thread(Dataset, aquius)
+                logging.info("Loaded %s", filepath)
+                for stale in [held for held in self.datasets if held[0] == key[0]]:
+                    del self.datasets[stale]
+                self.datasets[key] = dataset
+                while len(self.datasets) > self.capacity:
+                    self.datasets.popitem(last=False)
+                return key, dataset
+            finally:
+                if self.loading.get(key) is lock:
+                    del self.loading[key]
+
+
+class ResponseCache:
+    """Least recently used JSON responses, keyed by dataset key, endpoint and parameters"""
+
+    def __init__(self, capacity: int):
+        self.capacity = max(0, capacity)
+        self.responses: OrderedDict[tuple, bytes] = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        """Returns response, or None if not held"""
+
+        if key not in self.responses:
+            return None
+        self.responses.move_to_end(key)
+        return self.responses[key]
+
+    def put(self, key: tuple, response: bytes):
+        """Holds response, discarding the least recently used beyond capacity"""
+
+        if self.capacity == 0:
+            return
+        self.responses[key] = response
+        while len(self.responses) > self.capacity:
+            self.responses.popitem(last=False)
+
+
+def to_number(value: str, as_type: type) -> Union[int, float]:
+    """Returns value as int or float, integral floats as int, else raises QueryError"""
+
+    try:
+        number = float(value)
+    except ValueError as err:
+        raise QueryError(f"Not numeric: {value}") from err
+    if as_type is int:
+        if not number.is_integer():
+            raise QueryError(f"Not an integer: {value}")
+        return int(number)
+    return int(number) if number.is_integer() else number
+
+
+def normalise_params(endpoint: str, query: str) -> dict:
+    """
+    Returns parameters of endpoint parsed from query string to types, ignoring others
+    Equivalent queries (e.g. range=1000.0 or range=1e3, place=2,1 or place=1,2) normalise alike
+    """
+
+    params = {}
+    for key, value in parse_qsl(query, keep_blank_values=False):
+        if key not in PARAMETERS[endpoint]:
+            continue
+        as_type = PARAMETERS[endpoint][key]
+        if as_type == List[int]:
+            params[key] = sorted(set(to_number(entry, int) for entry in value.split(",")
+                                     if entry.strip()))
+        elif as_type == List[str]:
+            params[key] = [entry.strip() for entry in value.split(",") if entry.strip()]
+        elif as_type is str:
+            params[key] = value.strip()
+        else:
+            params[key] = to_number(value, as_type)
+    return params
+
+
+def params_key(params: dict) -> tuple:
+    """Returns hashable key of normalised parameters"""
+
+    return tuple(sorted((key, tuple(value) if isinstance(value, list) else value)
+                        for key, value in params.items()))
+
+
+class Server:
+    """Serves queries of datasets (keyed by filename stem) as JSON over HTTP"""
+
+    def __init__(self, filepaths: List[Path], cache: int, responses: int):
+        self.filepaths: Dict[str, Path] = {}
+        for filepath in filepaths:
+            if filepath.stem in self.filepaths:
+                logging.warning("Dataset %s already served, skipped %s", filepath.stem, filepath)
+                continue
+            self.filepaths[filepath.stem] = filepath
+        self.datasets = DatasetCache(capacity=cache)
+        self.responses = ResponseCache(capacity=responses)
+
+    async def respond(self, target: str) -> Tuple[HTTPStatus, bytes]:
+        """Returns status and JSON body for request target (path and query)"""
+
+        split = urlsplit(target)
+        endpoint = split.path.strip("/")
+        if endpoint not in PARAMETERS:
+            raise QueryError(f"Unknown endpoint: {split.path}", HTTPStatus.NOT_FOUND)
+        if endpoint == "dataset":
+            return HTTPStatus.OK, json.dumps({"dataset": list(self.filepaths.keys())}).encode()
+
+        name = dict(parse_qsl(split.query)).get("dataset", next(iter(self.filepaths), ""))
+        if name not in self.filepaths:
+            raise QueryError(f"Unknown dataset: {name}", HTTPStatus.NOT_FOUND)
+        params = normalise_params(endpoint=endpoint, query=split.query)
+        dataset_key, dataset = await self.datasets.get(filepath=self.filepaths[name])
+        key = (dataset_key, endpoint, params_key(params))
+        body = self.responses.get(key)
+        if body is None:
+            answer = getattr(dataset, f"query_{endpoint}")
+            body = json.dumps(await asyncio.to_thread(answer, params)).encode()
+            self.responses.put(key, body)
+        return HTTPStatus.OK, body
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answers one HTTP request per connection"""
+
+        status = HTTPStatus.OK
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            method, target, _ = request.split(b"\r\n", 1)[0].decode("latin-1").split(" ", 2)
+            if method != "GET":
+                raise QueryError(f"Method not allowed: {method}", HTTPStatus.METHOD_NOT_ALLOWED)
+            status, body = await self.respond(target=target)
+        except QueryError as err:
+            status = err.status
+            body = json.dumps({"error": str(err)}).encode()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            status = HTTPStatus.BAD_REQUEST
+            body = json.dumps({"error": "Bad request"}).encode()
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logging.error("Query failed: %s", err)
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+            body = json.dumps({"error": "Query failed"}).encode()
+
+        try:
+            writer.write((f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                          "Content-Type: application/json\r\n"
+                          f"Content-Length: {len(body)}\r\n"
+                          "Access-Control-Allow-Origin: *\r\n"
+                          "Connection: close\r\n\r\n").encode("latin-1") + body)
+            await writer.drain()
+        except ConnectionError as err:
+            logging.warning("Cannot respond: %s", err)
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int):
+        """Serves until cancelled"""
+
+        server = await asyncio.start_server(self.handle, host=host, port=port,
+                                            limit=MAX_REQUEST_BYTES)
+        logging.warning("Serving %s on http://%s:%s", ", ".join(self.filepaths), host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    if args is None:
+        args = get_args()
+    filepaths = ([] if args.aquius is None else [args.aquius]) + list(args.dataset)
+    if not filepaths:
+        logging.error("No aquius file to serve")
+        return
+    server = Server(filepaths=filepaths, cache=args.cache, responses=args.responses)
+    try:
+        asyncio.run(server.serve(host=args.host, port=args.port))
+    except KeyboardInterrupt:
+        pass
+    except OSError as err:
+        logging.error("Cannot serve on %s:%s: %s", args.host, args.port, err)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,490 @@
+"""
+Python script that sweeps here() summaries (link services, node count, place population,
+optionally factored by --connectivity) across every node, or a grid of points: --grid 1000
+Each point is summarised for every combination of network and service filter, for example:
+--network 0 1 --service 0 2, with combinations processed in parallel: --workers 4
+With the default --range 0, each node is its own here, and all nodes are summarised in one
+vectorized pass over the node to link incidence: Pairs of nodes and places within each link
+are enumerated with numpy and accumulated as scipy sparse matrices. Links with pickup,
+setdown, split or block, and nodes sharing coordinates, are walked exactly as aquius_here.py.
+Otherwise (a range, or a grid) each point is queried as aquius_here.py.
+Summaries match aquius.here() at each point, to floating point precision.
+
+Usage: python aquius_sweep.py aquius.json
+Add --format csv pq to output to one or both of CSV or Parquet
+See aquius_sweep.py -h for further arguments
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import logging
+from math import cos, radians
+import os
+from os import getcwd
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from _common import EARTH_METRES, get_common_args, is_aquius, load_json, unit_xyz, use_arrow
+from aquius_here import Here, Walk, js_typeof
+
+
+_HERE: Optional[Here] = None  # Dataset of each worker process
+
+
+def get_args() -> argparse.Namespace:
+    """Get command line arguments or apply defaults"""
+
+    parser = get_common_args(doc=__doc__)
+    parser.add_argument(
+        "--output",
+        dest="output",
+        help="Output directory root. Defaults to working directory.",
+        type=Path,
+        default=getcwd(),
+    )
+    parser.add_argument(
+        "--format",
+        dest="format",
+        nargs="+",
+        type=str,
+        default=["pq"],
+        choices=["csv", "pq"],
+        help="Output file format (csv pq), defaults to Parquet.",
+    )
+    parser.add_argument(
+        "--network",
+        dest="network",
+        nargs="+",
+        type=int,
+        default=None,
+        help="Network filter indices (positions in array), else all links.",
+    )
+    parser.add_argument(
+        "--service",
+        dest="service",
+        nargs="+",
+        type=int,
+        default=None,
+        help="Service filter indices (positions in array), else all services.",
+    )
+    parser.add_argument(
+        "--connectivity",
+        dest="connectivity",
+        type=float,
+        default=None,
+        help="Factor weighting population by service level, as aquius.here().",
+    )
+    parser.add_argument(
+        "--range",
+        dest="range",
+        type=float,
+        default=0.,
+        help="Distance from each point searched for nodes, in metres.",
+    )
+    parser.add_argument(
+        "--grid",
+        dest="grid",
+        type=float,
+        default=None,
+        help="Grid spacing in metres, covering all nodes, else each node is a point.",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        default=os.cpu_count(),
+        type=int,
+        help="Number of filter combinations (or point chunks) processed at the same time.",
+    )
+    parser.add_argument(
+        "--batch",
+        dest="batch",
+        type=int,
+        default=10000000,
+        help="Maximum pairs evaluated at once, lower to reduce memory use.",
+    )
+    parser.add_argument(
+        "--sweep",
+        dest="sweep",
+        type=str,
+        default="sweep",
+        help="Filename slug for sweep.",
+    )
+    return parser.parse_args()
+
+
+def group_pairs(a_link: np.ndarray, b_link: np.ndarray, link_count: int,
+                batch: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Yields (a, b) index arrays of every pair of a and b entries with the same link, in batches
+    a_link and b_link must be sorted
+    """
+
+    a_count = np.bincount(a_link, minlength=link_count)
+    b_count = np.bincount(b_link, minlength=link_count)
+    a_start = np.cumsum(a_count) - a_count
+    b_start = np.cumsum(b_count) - b_count
+    link_pairs = a_count * b_count
+    batch_id = np.cumsum(link_pairs) // max(1, batch)
+    for this_batch in np.unique(batch_id[link_pairs > 0]):
+        links = np.flatnonzero(batch_id == this_batch)  # Contiguous, as are their entries
+        a_index = np.arange(a_start[links[0]], a_start[links[-1]] + a_count[links[-1]])
+        repeats = b_count[a_link[a_index]]
+        pair_a = np.repeat(a_index, repeats)
+        rank = np.arange(len(pair_a)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        yield pair_a, b_start[a_link[pair_a]] + rank
+
+
+def link_filter(here: Here, network: Optional[int], service: Optional[int]) -> np.ndarray:
+    """Returns service level of each link, 0 if excluded by network filter"""
+
+    levels = np.array(here.get_levels(service=service), dtype=np.float64)
+    if network is None or not 0 <= network < len(here.aquius["network"]):
+        return levels
+    products = set(value for value in here.aquius["network"][network][0]
+                   if isinstance(value, (int, float)))
+    for link_id, link in enumerate(here.link):
+        if not link["product"] & products or any(
+                shared in products for shared in link["shared"]):
+            levels[link_id] = 0
+    return levels
+
+
+def is_simple(link: dict, node_count: int) -> bool:
+    """True if link can be vectorized: No pickup, setdown, split or block, valid nodes"""
+
+    if (link["has_pickup"] or link["has_setdown"] or link["split"] is not None or
+            link["block"] is not None or len(link["node"]) < 2):
+        return False
+    if link["circular"] and link["node"][0] != link["node"][-1]:
+        return False
+    return all(isinstance(node_id, int) and 0 <= node_id < node_count
+               for node_id in link["node"])
+
+
+def place_population(here: Here) -> np.ndarray:
+    """Returns population of each place, NaN if not numeric, as here() addPlace"""
+
+    population = np.full(len(here.aquius["place"]), np.nan, dtype=np.float64)
+    for place_id, place in enumerate(here.aquius["place"]):
+        properties = place[2] if isinstance(place[2], dict) else {}
+        value = properties.get("p", properties.get("population", 0))
+        if js_typeof(value) == "number":
+            population[place_id] = value
+    return population
+
+
+def sweep_nodes(here: Here, network: Optional[int], service: Optional[int],
+                connectivity: Optional[float], batch: int = 10000000) -> Dict[str, np.ndarray]:
+    """
+    Returns here() summary link, node and place of every node as here (range 0), as arrays
+    Nodes without coordinates summarise as zero
+    """
+
+    # pylint: disable=too-many-locals,too-many-statements
+    node_count = len(here.aquius["node"])
+    place_count = len(here.aquius["place"])
+    levels = link_filter(here=here, network=network, service=service)
+    has_xy = ~np.isnan(here.node_xy).any(axis=1)
+
+    simple = np.array([levels[link_id] > 0 and is_simple(link=link, node_count=node_count)
+                       for link_id, link in enumerate(here.link)], dtype=bool)
+    node_link = []
+    node = []
+    for link_id in np.flatnonzero(simple).tolist():
+        node_link += [link_id] * len(here.link[link_id]["node"])
+        node += here.link[link_id]["node"]
+    node_link = np.array(node_link, dtype=np.int64)
+    node = np.array(node, dtype=np.int64)
+    link_length = np.array([len(link["node"]) for link in here.link], dtype=np.int64)
+    link_start = np.cumsum(link_length * simple) - link_length * simple
+    position = np.arange(len(node)) - link_start[node_link]
+    length = link_length[node_link]
+    direction = np.array([link["direction"] for link in here.link], dtype=bool)
+    circular = np.array([link["circular"] for link in here.link], dtype=bool)
+
+    # Node groups: Each unique node of each link, which may be here
+    key, group = np.unique(node_link * max(1, node_count) + node, return_inverse=True)
+    g_link = key // max(1, node_count)
+    g_node = key % max(1, node_count)
+    g_first = np.full(len(key), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(g_first, group, position)
+    g_last = np.full(len(key), -1, dtype=np.int64)
+    np.maximum.at(g_last, group, position)
+    # Bi-directional terminus: An end of route not adjoining another visit to the same node
+    following = np.where(position + 1 < length, np.roll(node, -1), -1)
+    preceding = np.where(position > 0, np.roll(node, 1), -1)
+    terminus = (((position == 0) & (following != node)) |
+                ((position == length - 1) & (preceding != node)))
+    g_middle = np.bincount(group, weights=~terminus, minlength=len(key)) > 0
+    g_length = link_length[g_link]
+    g_level = levels[g_link]
+    g_direction = direction[g_link]
+    g_circular = circular[g_link]
+    g_count = np.where(
+        g_direction,
+        np.where(g_circular | (g_first < g_length - 1), g_level, 0.),
+        np.where(g_circular | g_middle, g_level, g_level / 2))
+
+    summary_link = np.bincount(g_node, weights=g_count, minlength=node_count)
+    reach_rows: List[np.ndarray] = []
+    reach_cols: List[np.ndarray] = []
+    connect_rows: List[np.ndarray] = []
+    connect_cols: List[np.ndarray] = []
+    connect_data: List[np.ndarray] = []
+
+    # Node reaches node: All of a link, unless uni-directional (from first visit on)
+    for origin, destination in group_pairs(a_link=g_link, b_link=g_link,
+                                           link_count=len(here.link), batch=batch):
+        keep = ~g_direction[origin] | g_circular[origin] | (
+            (g_first[origin] < g_length[origin] - 1) & (g_last[destination] >= g_first[origin]))
+        reach_rows.append(g_node[origin][keep])
+        reach_cols.append(g_node[destination][keep])
+
+    # Node connects place: Level at here's own place is the link count level
+    node_place = np.array(here.node_place, dtype=np.float64)
+    valid_place = (node_place >= 0) & (node_place < place_count) & (node_place % 1 == 0)
+    place_of_node = np.where(valid_place, node_place, -1).astype(np.int64)
+    is_placed = place_of_node[node] >= 0
+    p_key, p_group = np.unique(node_link[is_placed] * max(1, place_count) +
+                               place_of_node[node][is_placed], return_inverse=True)
+    p_link = p_key // max(1, place_count)
+    p_place = p_key % max(1, place_count)
+    p_last = np.full(len(p_key), -1, dtype=np.int64)
+    np.maximum.at(p_last, p_group, position[is_placed])
+    for origin, destination in group_pairs(a_link=g_link, b_link=p_link,
+                                           link_count=len(here.link),
+                                           batch=batch) if here.has_place else []:
+        is_own = p_place[destination] == place_of_node[g_node[origin]]
+        value = np.where(
+            g_direction[origin],
+            np.where(g_circular[origin] | ((g_first[origin] < g_length[origin] - 1) & (
+                p_last[destination] >= g_first[origin])), g_level[origin], 0.),
+            np.where(is_own, g_count[origin], g_level[origin] / 2))
+        keep = value > 0
+        connect_rows.append(g_node[origin][keep])
+        connect_cols.append(p_place[destination][keep])
+        connect_data.append(value[keep])
+
+    # Exact walk of other links, and nodes sharing coordinates (so sharing here)
+    _, xy_inverse, xy_count = np.unique(here.node_xy, axis=0, return_inverse=True,
+                                        return_counts=True)
+    shared_xy = has_xy & (xy_count[xy_inverse.reshape(-1)] > 1)
+    complex_link = np.flatnonzero((levels > 0) & ~simple)
+    complex_incidence = sparse.csr_array(here.incidence[:, complex_link])
+    complex_incidence.sort_indices()  # Walked in link order, as here()
+    complex_node = np.flatnonzero(np.diff(complex_incidence.indptr))
+    exact: Dict[int, dict] = {}
+    for node_id in np.union1d(complex_node, np.flatnonzero(shared_xy)).tolist():
+        if not has_xy[node_id]:
+            continue
+        if shared_xy[node_id]:
+            exact[node_id] = here.query({
+                "x": float(here.node_xy[node_id, 0]), "y": float(here.node_xy[node_id, 1]),
+                "range": 0, **({} if network is None else {"network": network}),
+                **({} if service is None else {"service": service}),
+                **({} if connectivity is None else {"connectivity": connectivity}),
+            })["summary"]
+            continue
+        walk = Walk(here={node_id}, has_place=here.has_place, node_place=here.node_place)
+        for link_id in complex_link[complex_incidence.indices[
+                complex_incidence.indptr[node_id]:complex_incidence.indptr[node_id + 1]]].tolist():
+            if Here.is_here_ok(link=here.link[link_id], here=walk.here):
+                walk.walk(link=here.link[link_id], level=levels[link_id])
+        summary_link[node_id] += walk.summary_link
+        reached = [other for other in walk.service_node if 0 <= other < node_count]
+        reach_rows.append(np.full(len(reached), node_id, dtype=np.int64))
+        reach_cols.append(np.array(reached, dtype=np.int64))
+        connected = [(place_id, value) for place_id, value in walk.connect.items()
+                     if isinstance(place_id, int) and place_id < place_count]
+        connect_rows.append(np.full(len(connected), node_id, dtype=np.int64))
+        connect_cols.append(np.array([entry[0] for entry in connected], dtype=np.int64))
+        connect_data.append(np.array([entry[1] for entry in connected], dtype=np.float64))
+
+    reach = sparse.coo_array((
+        np.ones(sum(len(rows) for rows in reach_rows), dtype=np.int8),
+        (np.concatenate(reach_rows or [np.zeros(0, dtype=np.int64)]),
+         np.concatenate(reach_cols or [np.zeros(0, dtype=np.int64)]))),
+        shape=(node_count, node_count)).tocsr()
+    reach.sum_duplicates()
+    summary_node = np.diff(reach.indptr)
+
+    connect = sparse.coo_array((
+        np.concatenate(connect_data or [np.zeros(0)]),
+        (np.concatenate(connect_rows or [np.zeros(0, dtype=np.int64)]),
+         np.concatenate(connect_cols or [np.zeros(0, dtype=np.int64)]))),
+        shape=(node_count, place_count)).tocsr()
+    connect.sum_duplicates()
+    population = place_population(here=here)[connect.indices]
+    if connectivity is not None and connectivity > 0:
+        population = population * (1 - (1 / (connect.data * connectivity)))
+    population = np.floor(population + 0.5)  # As Math.round()
+    population = np.where(population > 0, population, 0)  # NaN excluded
+    summary_place = sparse.csr_array((population, connect.indices, connect.indptr),
+                                     shape=connect.shape).sum(axis=1)
+
+    summary_link[~has_xy] = 0
+    summary_node[~has_xy] = 0
+    summary_place[~has_xy] = 0
+    for node_id, summary in exact.items():
+        summary_link[node_id] = summary["link"]
+        summary_node[node_id] = summary["node"]
+        summary_place[node_id] = summary["place"]
+    return {"link": summary_link, "node": summary_node, "place": summary_place}
+
+
+def query_options(network: Optional[int], service: Optional[int],
+                  connectivity: Optional[float]) -> dict:
+    """Returns here() filter options, omitting those not set"""
+
+    options = {}
+    if network is not None:
+        options["network"] = network
+    if service is not None:
+        options["service"] = service
+    if connectivity is not None:
+        options["connectivity"] = connectivity
+    return options
+
+
+def sweep_points(here: Here, points: np.ndarray, search: float, options: dict) -> Dict[
+        str, np.ndarray]:
+    """Returns here() summary link, node and place of each point (x, y) within search metres"""
+
+    summary = {key: np.zeros(len(points), dtype=np.float64) for key in ["link", "node", "place"]}
+    for point_id, (x_value, y_value) in enumerate(points.tolist()):
+        result = here.query({**options, "x": x_value, "y": y_value, "range": search})["summary"]
+        for key, value in result.items():
+            summary[key][point_id] = value
+    return summary
+
+
+def grid_points(here: Here, spacing: float, search: float) -> np.ndarray:
+    """Returns (x, y) of a regular grid covering all nodes, only those within search of a node"""
+
+    node_xy = here.node_xy[here.tree_node]
+    if len(node_xy) == 0 or spacing <= 0:
+        return np.zeros((0, 2), dtype=np.float64)
+    minimum = node_xy.min(axis=0)
+    maximum = node_xy.max(axis=0)
+    y_step = spacing / 111320  # Metres per degree latitude
+    x_step = y_step / max(0.01, cos(radians((minimum[1] + maximum[1]) / 2)))
+    x_grid, y_grid = np.meshgrid(np.arange(minimum[0], maximum[0] + x_step, x_step),
+                                 np.arange(minimum[1], maximum[1] + y_step, y_step))
+    points = np.stack([x_grid.ravel(), y_grid.ravel()], axis=1)
+    # Points beyond any node are empty, so excluded with one tree query for all points
+    distance, _ = here.tree.query(unit_xyz(points))
+    angle = min(max(search, 0) / EARTH_METRES, np.pi)
+    return points[distance <= 2 * np.sin(angle / 2) * (1 + 1e-9) + 1e-12]
+
+
+def init_worker(filepath: Path):
+    """Loads dataset once per worker process"""
+
+    global _HERE  # pylint: disable=global-statement
+    _HERE = Here(load_json(filepath=filepath))
+
+
+def run_task(task: dict) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """Returns task with summaries, in worker process"""
+
+    if task["points"] is None:
+        return task, sweep_nodes(here=_HERE, network=task["network"], service=task["service"],
+                                 connectivity=task["connectivity"], batch=task["batch"])
+    return task, sweep_points(here=_HERE, points=task["points"], search=task["range"],
+                              options=query_options(network=task["network"],
+                                                    service=task["service"],
+                                                    connectivity=task["connectivity"]))
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    # pylint: disable=too-many-locals
+    global _HERE  # pylint: disable=global-statement
+    if args is None:
+        args = get_args()
+    aquius = load_json(filepath=args.aquius)
+    if not is_aquius(aquius=aquius, skip_place=True):
+        logging.error("Not an aquius file: %s", args.aquius)
+        return
+    _HERE = Here(aquius)
+
+    networks = args.network if args.network else [None]
+    services = args.service if args.service else [None]
+    for network in networks:
+        if network is not None and not 0 <= network < len(_HERE.aquius["network"]):
+            logging.warning("Network %s not found, so unfiltered", network)
+    for service in services:
+        if service is not None and not 0 <= service < len(_HERE.aquius["service"]):
+            logging.warning("Service %s not found, so all services", service)
+
+    node_mode = args.grid is None
+    if node_mode:
+        points = _HERE.node_xy
+        point_ids = np.arange(len(points))
+    else:
+        points = grid_points(here=_HERE, spacing=args.grid, search=args.range)
+        point_ids = np.arange(len(points))
+    # Without range, nodes sweep in one pass per filter, else points are split across workers
+    workers = max(1, args.workers or 1)
+    chunks = [None] if node_mode and args.range == 0 else np.array_split(
+        point_ids, max(1, min(len(point_ids), workers * 4)))
+    tasks = []
+    for network, service in product(networks, services):
+        network = network if network is None or 0 <= network < len(
+            _HERE.aquius["network"]) else None
+        service = service if service is None or 0 <= service < len(
+            _HERE.aquius["service"]) else None
+        for chunk in chunks:
+            tasks.append({
+                "network": network, "service": service, "connectivity": args.connectivity,
+                "range": args.range, "batch": args.batch, "chunk": chunk,
+                "points": None if chunk is None else points[chunk],
+            })
+
+    if workers == 1 or len(tasks) == 1:
+        results = [run_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=init_worker,
+                                 initargs=(args.aquius,)) as executor:
+            results = list(executor.map(run_task, tasks))
+
+    frames = []
+    for task, summary in results:
+        chunk = point_ids if task["chunk"] is None else task["chunk"]
+        frames.append(pd.DataFrame({
+            "point": chunk,
+            "x": points[chunk, 0],
+            "y": points[chunk, 1],
+            "network": pd.array([task["network"]] * len(chunk), dtype="Int64"),
+            "service": pd.array([task["service"]] * len(chunk), dtype="Int64"),
+            "link": np.round(summary["link"], 2),
+            "node": summary["node"].astype(np.int64),
+            "place": summary["place"].astype(np.int64),
+        }))
+    sweep = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    slug = args.sweep
+    try:
+        Path(args.output).mkdir(parents=True, exist_ok=True)
+        if "csv" in args.format:
+            sweep.to_csv(Path(args.output, f"{slug}.csv"), index=False)
+        if "pq" in args.format:
+            if use_arrow():
+                sweep.to_parquet(Path(args.output, f"{slug}.pq"), index=False)
+            else:
+                logging.error("Parquet output requires pyarrow")
+    except IOError as err:
+        logging.error("Cannot write %s to %s: %s", slug, args.output, err)
+
+
+if __name__ == "__main__":
+    main()
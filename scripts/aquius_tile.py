@@ -0,0 +1,155 @@
+"""
+Python script that splits an aquius dataset into spatial tiles, so a viewer need only load
+the tiles covering its view, as _common.load_aquius_bbox(). Tiles are a regular grid of
+--size degrees. Each tile holds:
+* The nodes within the tile.
+* Links serving any of those nodes, with all their nodes (so links are complete).
+* Only the places referenced by those nodes.
+Entries are indexed within each tile, with their original indices under "id", such that
+tiles can be stitched back into one dataset. A small index file holds the bbox and file of
+each tile, and all other aquius keys (meta, network, service, reference and so on).
+Nodes without coordinates are only held with the links that serve them.
+
+Usage: python aquius_tile.py aquius.json --size 0.5
+See aquius_tile.py -h for further arguments
+"""
+
+import argparse
+import logging
+from math import floor
+from os import getcwd
+from pathlib import Path
+
+from _common import (DATASET_KEYS, LINK_NODE_KEYS, get_common_args, is_aquius, load_json,
+                     renumber_link, renumber_node, save_json)
+
+
+def get_args() -> argparse.Namespace:
+    """Get command line arguments or apply defaults"""
+
+    parser = get_common_args(doc=__doc__)
+    parser.add_argument(
+        "--output",
+        dest="output",
+        help="Output directory root. Defaults to working directory.",
+        type=Path,
+        default=getcwd(),
+    )
+    parser.add_argument(
+        "--size",
+        dest="size",
+        type=float,
+        default=0.5,
+        help="Tile width and height in degrees.",
+    )
+    parser.add_argument(
+        "--tile",
+        dest="tile",
+        type=str,
+        default="tile",
+        help="Filename slug for tiles, index is slug_index.json.",
+    )
+    return parser.parse_args()
+
+
+def link_nodes(link: list, node_count: int) -> set:
+    """Returns valid node indices of link route, and pickup, setdown and split"""
+
+    nodes = set(link[2])
+    if len(link) > 3 and isinstance(link[3], dict):
+        for key in LINK_NODE_KEYS:
+            if isinstance(link[3].get(key), list):
+                nodes.update(link[3][key])
+    return {node for node in nodes if isinstance(node, int) and 0 <= node < node_count}
+
+
+def node_cells(aquius: dict, size: float) -> dict[tuple, list[int]]:
+    """Returns (column, row) tile cell: node indices within, nodes without coordinates skipped"""
+
+    cells: dict[tuple, list[int]] = {}
+    for node_id, node in enumerate(aquius["node"]):
+        if (isinstance(node, list) and len(node) >= 2 and isinstance(node[0], (int, float)) and
+                isinstance(node[1], (int, float)) and not isinstance(node[0], bool) and
+                not isinstance(node[1], bool)):
+            cells.setdefault((floor(node[0] / size), floor(node[1] / size)), []).append(node_id)
+    return cells
+
+
+def node_place(node: list, place_count: int):
+    """Returns place index of node, else None"""
+
+    if len(node) < 3 or not isinstance(node[2], dict):
+        return None
+    place = node[2].get("p", node[2].get("place"))
+    if isinstance(place, int) and 0 <= place < place_count:
+        return place
+    return None
+
+
+def build_tiles(aquius: dict, size: float, slug: str) -> tuple[dict, dict[str, dict]]:
+    """Returns index and filename: tile dataset"""
+
+    node_count = len(aquius["node"])
+    place_count = len(aquius.get("place", []))
+    nodes = [link_nodes(link=link, node_count=node_count) for link in aquius["link"]]
+    node_link: list[list[int]] = [[] for _ in range(node_count)]
+    for link_id, link_node in enumerate(nodes):
+        for node in link_node:
+            node_link[node].append(link_id)
+
+    index = {key: value for key, value in aquius.items() if key not in DATASET_KEYS}
+    index["tile"] = []
+    tiles = {}
+    for (column, row), cell_nodes in sorted(node_cells(aquius=aquius, size=size).items()):
+        link_ids = sorted(set(link_id for node in cell_nodes for link_id in node_link[node]))
+        node_ids = sorted(set(cell_nodes).union(*[nodes[link_id] for link_id in link_ids]))
+        place_ids = sorted(set(node_place(node=aquius["node"][node], place_count=place_count)
+                               for node in node_ids) - {None})
+        node_lookup = {node: local_id for local_id, node in enumerate(node_ids)}
+        place_lookup = {place: local_id for local_id, place in enumerate(place_ids)}
+        filename = f"{slug}_{column}_{row}.json"
+        tiles[filename] = {
+            "id": {"link": link_ids, "node": node_ids, "place": place_ids},
+            "link": [renumber_link(link=aquius["link"][link_id], node_lookup=node_lookup)
+                     for link_id in link_ids],
+            "node": [renumber_node(node=aquius["node"][node], place_lookup=place_lookup)
+                     for node in node_ids],
+            "place": [aquius["place"][place] for place in place_ids],
+        }
+        index["tile"].append({
+            "file": filename,
+            "bbox": [column * size, row * size, (column + 1) * size, (row + 1) * size],
+            "node": len(cell_nodes),
+        })
+    return index, tiles
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    if args is None:
+        args = get_args()
+    aquius = load_json(filepath=args.aquius)
+    if not is_aquius(aquius=aquius, skip_place=True):
+        logging.error("Not an aquius file: %s", args.aquius)
+        return
+    if args.size <= 0:
+        logging.error("Tile size must be positive: %s", args.size)
+        return
+
+    index, tiles = build_tiles(aquius=aquius, size=args.size, slug=args.tile)
+    try:
+        Path(args.output).mkdir(parents=True, exist_ok=True)
+    except IOError as err:
+        logging.error("Cannot write to %s: %s", args.output, err)
+        return
+    for filename, tile in tiles.items():
+        save_json(data=tile, filepath=Path(args.output, filename))
+    save_json(data=index, filepath=Path(args.output, f"{args.tile}_index.json"))
+
+
+if __name__ == "__main__":
+    main()
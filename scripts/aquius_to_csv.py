@@ -6,6 +6,10 @@ Python script that extracts data from aquius files to CSV, including:
 - nodes, including termini (start or end) services and total dwell minutes
 One service index (position in array) per extraction,
 defaults to first, but can be set using: --index 0
+Alternatively --all extracts every service (as defined in aquius service) in one pass,
+writing one column per service, named after the service
+Optionally limited to links of one network filter: --network 0
+Output as CSV and/or Parquet (same filename, .pq suffix): --format csv pq
 
 Usage: python aquius_to_csv.py aquius.json
 See aquius_to_csv.py -h for further arguments
@@ -14,8 +18,12 @@ See aquius_to_csv.py -h for further arguments
 import argparse
 import logging
 from pathlib import Path
+from typing import Optional
 
-from _common import get_common_args, is_aquius, load_json, save_to_csv
+import numpy as np
+
+from _common import (get_common_args, is_aquius, load_json, save_to_csv, service_property_name,
+                     use_arrow)
 
 
 def get_args() -> argparse.Namespace:
@@ -29,6 +37,28 @@ def get_args() -> argparse.Namespace:
         type=int,
         help='Service index (position in array)',
     )
+    parser.add_argument(
+        '--all',
+        dest='all',
+        action='store_true',
+        help='Extract all services as columns, ignoring --index',
+    )
+    parser.add_argument(
+        '--network',
+        dest='network',
+        default=None,
+        type=int,
+        help='Network filter index (position in array), else all links',
+    )
+    parser.add_argument(
+        '--format',
+        dest='format',
+        nargs='+',
+        type=str,
+        default=['csv'],
+        choices=['csv', 'pq'],
+        help='Output file format (csv pq), Parquet replacing filename suffix with .pq',
+    )
     parser.add_argument(
         '--operator',
         dest='operator',
@@ -64,110 +94,309 @@ def get_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def main():
-    """Core script entrypoint"""
+def get_service_columns(inputted: dict, use_service_index: Optional[int]) -> dict[str, list[int]]:
+    """
+    Returns column name: service indices (positions in link service array) summed
+    Single use_service_index, else all aquius service definitions
+    """
+
+    if use_service_index is not None:
+        return {'services': [use_service_index]}
+
+    columns: dict[str, list[int]] = {}
+    for meta in inputted['service']:
+        if (not isinstance(meta, list) or len(meta) < 2 or not isinstance(meta[0], list) or
+                not isinstance(meta[1], dict) or len(meta[1]) == 0):
+            logging.warning("Skipped bad service structure: %s", meta)
+            continue
+        columns[service_property_name(meta_one=meta[1])] = meta[0]
+    if not columns:
+        logging.warning("No service defined, using first service index")
+        columns['services'] = [0]
+    return columns
+
+
+def flatten_links(inputted: dict, service_columns: dict[str, list[int]]) -> dict[str, np.ndarray]:
+    """
+    Flattens valid links into integer id arrays, keys:
+    service (link x service_columns, shared equally if multi-operator), product_link, product,
+    node_link, node, node_position (0 start, 1 end, else 2), dwell (0 if none)
+    """
+
+    link_service = []
+    service = []
+    product_link = []
+    product = []
+    node_link = []
+    node = []
+    node_position = []
+    dwell = []
+
+    for link in inputted['link']:
+        if isinstance(link, list) and len(link) >= 4:
+            # product, service, nodes, e.g.
+            # [[147],[498],[1030,2069,280,5989,12,165,291,23,1008,807,210,2133,1116], {...}} ]
+            link_id = len(service)
+            link_service.append(link[1])
+            service.append(len(link[0]))
+            product_link += [link_id] * len(link[0])
+            product += link[0]
+            node_link += [link_id] * len(link[2])
+            node += link[2]
+            positions = [2] * len(link[2])
+            if positions:
+                positions[-1] = 1
+                positions[0] = 0
+            node_position += positions
+            link_dwell = link[3].get('w') if isinstance(link[3], dict) else None
+            if isinstance(link_dwell, list) and len(link_dwell) == len(link[2]):
+                dwell += link_dwell
+            else:
+                dwell += [0] * len(link[2])
+
+    # Link x service index array, padded with zero
+    positions = max([len(values) for values in link_service] + [
+        max(indices, default=-1) + 1 for indices in service_columns.values()])
+    link_service_array = np.zeros((len(link_service), positions), dtype=np.float64)
+    for link_id, values in enumerate(link_service):
+        link_service_array[link_id, :len(values)] = values
+    # Service index x column (sum of indices) array
+    column_array = np.zeros((positions, len(service_columns)), dtype=np.float64)
+    for column, indices in enumerate(service_columns.values()):
+        for index in indices:
+            column_array[index, column] += 1
+
+    return {
+        'service': (link_service_array @ column_array) / np.array(
+            service, dtype=np.float64).reshape(-1, 1),
+        'product_link': np.array(product_link, dtype=np.int64),
+        'product': np.array(product, dtype=np.int64),
+        'node_link': np.array(node_link, dtype=np.int64),
+        'node': np.array(node, dtype=np.int64),
+        'node_position': np.array(node_position, dtype=np.int8),
+        'dwell': np.array(dwell, dtype=np.float64),
+    }
+
+
+def network_bitmap(inputted: dict) -> np.ndarray:
+    """Returns product x network boolean array, True if product is member of network"""
+
+    product_count = max([len(inputted.get('reference', {}).get('product', []))] + [
+        max(network[0], default=-1) + 1 for network in inputted['network']
+        if isinstance(network, list) and len(network) > 0 and isinstance(network[0], list)])
+    bitmap = np.zeros((product_count, len(inputted['network'])), dtype=bool)
+    for network_id, network in enumerate(inputted['network']):
+        if isinstance(network, list) and len(network) > 0 and isinstance(network[0], list):
+            bitmap[network[0], network_id] = True
+    return bitmap
+
+
+def mask_links(flat: dict[str, np.ndarray], keep: np.ndarray) -> dict[str, np.ndarray]:
+    """Returns flat (as flatten_links) with only links where keep, link ids renumbered"""
+
+    link_id = np.cumsum(keep) - 1
+    product_keep = keep[flat['product_link']]
+    node_keep = keep[flat['node_link']]
+    return {
+        'service': flat['service'][keep],
+        'product_link': link_id[flat['product_link'][product_keep]],
+        'product': flat['product'][product_keep],
+        'node_link': link_id[flat['node_link'][node_keep]],
+        'node': flat['node'][node_keep],
+        'node_position': flat['node_position'][node_keep],
+        'dwell': flat['dwell'][node_keep],
+    }
 
-    arguments = get_args()
-    use_service_index = getattr(arguments, 'index')
+
+def select_network(inputted: dict, flat: dict[str, np.ndarray],
+                   network: int) -> dict[str, np.ndarray]:
+    """Returns flat limited to links with any product in network (index)"""
+
+    bitmap = network_bitmap(inputted=inputted)
+    if network < 0 or network >= bitmap.shape[1]:
+        logging.warning("Network %s not found, using all links", network)
+        return flat
+    valid = flat['product'] < bitmap.shape[0]
+    in_network = np.zeros(len(flat['product']), dtype=bool)
+    in_network[valid] = bitmap[flat['product'][valid], network]
+    keep = np.bincount(flat['product_link'], weights=in_network,
+                       minlength=len(flat['service'])) > 0
+    return mask_links(flat=flat, keep=keep)
+
+
+def save_output(filepath: Path, content: list[dict], columns: list, formats: list[str]):
+    """Save content to filepath as each format, Parquet with suffix .pq"""
+
+    if 'csv' in formats:
+        save_to_csv(filepath=filepath, content=content, columns=columns)
+    if 'pq' in formats:
+        if not use_arrow():
+            logging.error("Parquet output requires pyarrow")
+            return
+        import pyarrow as pa  # pylint: disable=import-outside-toplevel
+        import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+        try:
+            pq.write_table(pa.table({column: [row.get(column) for row in content]
+                                     for column in columns}),
+                           Path(filepath).with_suffix('.pq'))
+        except (IOError, pa.ArrowException) as err:
+            logging.error("Cannot write %s: %s", Path(filepath).with_suffix('.pq'), err)
+
+
+def encode_names(names: list[str]) -> tuple[np.ndarray, list[str]]:
+    """Returns id array (one per name) and unique names indexed by id"""
+
+    lookup: dict[str, int] = {}
+    ids = np.array([lookup.setdefault(name, len(lookup)) for name in names], dtype=np.int64)
+    return ids, list(lookup.keys())
+
+
+def group_sum(ids: np.ndarray, weights: np.ndarray, size: int) -> np.ndarray:
+    """Sums rows of weights (one column per service) by ids, returning size rows"""
+
+    return np.stack([np.bincount(ids, weights=weights[:, column], minlength=size)
+                     for column in range(weights.shape[1])], axis=1).reshape(size, weights.shape[1])
+
+
+def first_order(ids: np.ndarray) -> np.ndarray:
+    """Returns unique ids in order of first appearance"""
+
+    unique, first = np.unique(ids, return_index=True)
+    return unique[np.argsort(first, kind='stable')]
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    arguments = get_args() if args is None else args
+    use_service_index = None if getattr(arguments, 'all', False) else getattr(arguments, 'index')
     inputted = load_json(filepath=getattr(arguments, 'aquius'))
     if not is_aquius(inputted):
         logging.error("Not an aquius file: %s", arguments.aquius)
         return
 
-    operator_place_service: dict[str: dict[str: float]] = {}  # Operator: {place: services}
-    operator_service: dict[str, float] = {}  # Operator: service
-    place_data: dict[str, list] = {}  # Place: [x, y]
-    node_data: dict[str, list] = {}  # Node: [x, y, name, code, services, services_termini, dwells]
+    service_columns = get_service_columns(inputted=inputted, use_service_index=use_service_index)
+    service_names = list(service_columns.keys())
+    flat = flatten_links(inputted=inputted, service_columns=service_columns)
+    if getattr(arguments, 'network', None) is not None:
+        flat = select_network(inputted=inputted, flat=flat, network=arguments.network)
+    formats = getattr(arguments, 'format', ['csv'])
+    node_count = len(inputted['node'])
 
+    # Names are encoded to integer ids, only mapped back to names at output
+    operator_id, operator_names = encode_names([
+        product.get('en-US', 'UKNOWN') if isinstance(product, dict) else 'UKNOWN'
+        for product in inputted['reference']['product']])  # Assumes language
+    is_node = np.zeros(node_count, dtype=bool)
+    node_names: list[str] = []
+    node_codes: list[str] = []
     for node_id, node in enumerate(inputted['node']):
+        name_readable = ""
+        name_code = ""
         if isinstance(node, list) and len(node) >= 3 and isinstance(node[2], dict):
-            name_readable = ""
-            name_code = ""
+            is_node[node_id] = True
             ref = node[2].get("r")
             if isinstance(ref, list):
                 if len(ref) > 0 and isinstance(ref[0], dict):
                     name_readable = ref[0].get("n", "")
                 if len(ref) > 1 and isinstance(ref[1], dict):
                     name_code = ref[1].get("n", "")
-            node_data[node_id] = [node[0], node[1], name_readable, name_code, 0, 0, 0]
+        node_names.append(name_readable)
+        node_codes.append(name_code)
+    # e.g. [-2.177,53.85,{"p":2310,"r":[{"n":"E05005268"}]}]
+    place_id, place_names = encode_names(node_names)
 
-    for link in inputted['link']:
-        if isinstance(link, list) and len(link) >= 4:
-            # product, service, nodes, e.g.
-            # [[147],[498],[1030,2069,280,5989,12,165,291,23,1008,807,210,2133,1116], {...}} ]
-            # Shared equally if multi-operator:
-            service_total = link[1][use_service_index] / len(link[0])
-            for operator_id in link[0]:
-                operator_name = inputted['reference']['product'][operator_id].get(
-                    'en-US', 'UKNOWN')  # Assumes language
-                operator_service[operator_name] = (
-                    service_total + operator_service.get(operator_name, 0))
-                if operator_name not in operator_place_service:
-                    operator_place_service[operator_name] = {}
-                for place_id in link[2]:
-                    # e.g. [-2.177,53.85,{"p":2310,"r":[{"n":"E05005268"}]}]
-                    place_name = inputted['node'][place_id][2]['r'][0]['n']
-                    if place_name not in place_data:
-                        place_data[place_name] = [
-                            inputted['node'][place_id][0], inputted['node'][place_id][1]]
-                    operator_place_service[operator_name][place_name] = (
-                        service_total + operator_place_service[operator_name].get(place_name, 0))
-            dwell = None
-            if isinstance(link[3], dict):
-                dwell = link[3].get("w")
-                if not isinstance(dwell, list) or len(dwell) != len(link[2]):
-                    dwell = None
-            for index, node in enumerate(link[2]):
-                if node in node_data:
-                    node_data[node][4] = node_data[node][4] + service_total
-                    if index in (0, (len(link[2]) - 1)):  # Start or end of route
-                        node_data[node][5] = node_data[node][5] + service_total
-                    if dwell is not None:
-                        node_data[node][6] = node_data[node][6] + dwell[index]
+    # Operator
+    link_operator = operator_id[flat['product']]
+    operator_service = group_sum(
+        link_operator, weights=flat['service'][flat['product_link']], size=len(operator_names))
+    operator_order = first_order(link_operator)
+
+    # Operator-place: Each node of each link, repeated for each operator of that link
+    product_count = np.bincount(flat['product_link'], minlength=len(flat['service']))
+    product_start = np.cumsum(product_count) - product_count
+    repeats = product_count[flat['node_link']]
+    pair_node = np.repeat(np.arange(len(flat['node'])), repeats)
+    pair_rank = np.arange(len(pair_node)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    pair_operator = link_operator[product_start[flat['node_link'][pair_node]] + pair_rank]
+    pair_place = place_id[flat['node'][pair_node]]
+    pair_key, pair_first, pair_inverse = np.unique(
+        pair_operator * len(place_names) + pair_place, return_index=True, return_inverse=True)
+    pair_service = group_sum(pair_inverse, weights=flat['service'][
+        flat['node_link'][pair_node]], size=len(pair_key))
+    operator_rank = np.zeros(len(operator_names), dtype=np.int64)
+    operator_rank[operator_order] = np.arange(len(operator_order))
+    pair_order = np.lexsort((pair_first, operator_rank[pair_key // max(1, len(place_names))]))
+
+    # Place: First node of each place name, as walked by links
+    served_node = flat['node'][pair_node]
+    place_first = np.full(len(place_names), -1, dtype=np.int64)
+    place_first[pair_place[::-1]] = served_node[::-1]  # Last assignment wins, so reversed
+    place_order = first_order(pair_place)
+
+    # Node
+    node_mask = is_node[flat['node']]
+    link_node = flat['node'][node_mask]
+    link_node_service = flat['service'][flat['node_link'][node_mask]]
+    node_service = group_sum(link_node, weights=link_node_service, size=node_count)
+    termini = flat['node_position'][node_mask] < 2  # Start or end of route
+    node_termini = group_sum(
+        link_node[termini], weights=link_node_service[termini], size=node_count)
+    node_dwell = np.bincount(link_node, weights=flat['dwell'][node_mask], minlength=node_count)
 
     output: list[dict] = []
-    output_columns = ['operator', 'services']
-    for operator, services in operator_service.items():
+    output_columns = ['operator'] + service_names
+    for operator in operator_order:
         output.append({
-            'operator': operator,
-            'services': services
+            'operator': operator_names[operator],
+            **dict(zip(service_names, operator_service[operator].tolist()))
         })
-    save_to_csv(filepath=getattr(arguments, 'operator'), content=output, columns=output_columns)
+    save_output(filepath=getattr(arguments, 'operator'), content=output, columns=output_columns,
+                formats=formats)
 
     output: list[dict] = []
     output_columns = ['place', 'x', 'y']
-    for place, values in place_data.items():
+    for place in place_order:
         output.append({
-            'place': place,
-            'x': values[0],
-            'y': values[1]
+            'place': place_names[place],
+            'x': inputted['node'][place_first[place]][0],
+            'y': inputted['node'][place_first[place]][1]
         })
-    save_to_csv(filepath=getattr(arguments, 'place'), content=output, columns=output_columns)
+    save_output(filepath=getattr(arguments, 'place'), content=output, columns=output_columns,
+                formats=formats)
 
     output: list[dict] = []
-    output_columns = ['operator', 'place', 'services']
-    for operator, values in operator_place_service.items():
-        for place, services in values.items():
-            output.append({
-                'operator': operator,
-                'place': place,
-                'services': services
-            })
-    save_to_csv(filepath=getattr(arguments, 'service'), content=output, columns=output_columns)
+    output_columns = ['operator', 'place'] + service_names
+    for pair in pair_order:
+        output.append({
+            'operator': operator_names[pair_key[pair] // len(place_names)],
+            'place': place_names[pair_key[pair] % len(place_names)],
+            **dict(zip(service_names, pair_service[pair].tolist()))
+        })
+    save_output(filepath=getattr(arguments, 'service'), content=output, columns=output_columns,
+                formats=formats)
 
     output: list[dict] = []
-    output_columns = ['x', 'y', 'name', 'code', 'services', 'services_termini', 'dwell_minutes']
-    for _, values in node_data.items():
+    termini_names = [f'{name}_termini' for name in service_names]
+    output_columns = ['x', 'y', 'name', 'code'] + service_names + termini_names + [
+        'dwell_minutes']
+    for node_id in np.flatnonzero(is_node):
         output.append({
-            'x': values[0],
-            'y': values[1],
-            'name': str(values[2]),
-            'code': str(values[3]),
-            'services': round(values[4], 2),
-            'services_termini': round(values[5], 2),
-            'dwell_minutes': round(values[6], 2),
+            'x': inputted['node'][node_id][0],
+            'y': inputted['node'][node_id][1],
+            'name': str(node_names[node_id]),
+            'code': str(node_codes[node_id]),
+            **{name: round(value, 2) for name, value in zip(
+                service_names, node_service[node_id].tolist())},
+            **{name: round(value, 2) for name, value in zip(
+                termini_names, node_termini[node_id].tolist())},
+            'dwell_minutes': round(float(node_dwell[node_id]), 2),
         })
-    save_to_csv(filepath=getattr(arguments, 'node'), content=output, columns=output_columns)
+    save_output(filepath=getattr(arguments, 'node'), content=output, columns=output_columns,
+                formats=formats)
 
 
 if __name__ == '__main__':
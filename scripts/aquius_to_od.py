@@ -0,0 +1,367 @@
+"""
+Python script that builds a sparse place x place matrix of direct services from aquius links,
+output as origin-destination triples (origin and destination place index, services),
+plus a connectivity summary per place (places and population directly connected).
+Each link connects every place it serves to every place later on its route, subject to:
+* direction (or d) - Links are otherwise bi-directional, half of service in each direction.
+* circular (or c) - Every place on the loop connects to every other.
+* pickup (or u) and setdown (or s) - Board only and alight only nodes, which swap roles
+  in the reverse direction of bi-directional links.
+* block (or b) - Links in the same block are counted once per origin-destination pair.
+Split (or t) portions are counted in full. Places connect once per link, whatever the
+number of nodes the link serves within each place. Journeys within the same place are excluded.
+One service (position in aquius service array) per run, defaults to first: --service 0
+Optionally limited to links of one network filter: --network 0
+
+Usage: python aquius_to_od.py aquius.json
+Add --format csv pq to output to one or both of CSV or Parquet
+See aquius_to_od.py -h for further arguments
+"""
+
+import argparse
+import logging
+from os import getcwd
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from _common import get_common_args, is_aquius, load_json
+from aquius_to_csv import get_service_columns, network_bitmap
+
+
+def get_args() -> argparse.Namespace:
+    """Get command line arguments or apply defaults"""
+
+    parser = get_common_args(doc=__doc__)
+    parser.add_argument(
+        "--output",
+        dest="output",
+        help="Output directory root. Defaults to working directory.",
+        type=Path,
+        default=getcwd(),
+    )
+    parser.add_argument(
+        "--format",
+        dest="format",
+        nargs="+",
+        type=str,
+        default=["pq"],
+        choices=["csv", "pq"],
+        help="Output file format (csv pq), defaults to Parquet.",
+    )
+    parser.add_argument(
+        "--service",
+        dest="service",
+        type=int,
+        default=0,
+        help="Position in aquius service array of the service analysed.",
+    )
+    parser.add_argument(
+        "--network",
+        dest="network",
+        type=int,
+        default=None,
+        help="Network filter index (position in array), else all links.",
+    )
+    parser.add_argument(
+        "--batch",
+        dest="batch",
+        type=int,
+        default=10000000,
+        help="Maximum place pairs evaluated at once, lower to reduce memory use.",
+    )
+    parser.add_argument(
+        "--od",
+        dest="od",
+        type=str,
+        default="od",
+        help="Filename slug for origin-destination triples.",
+    )
+    parser.add_argument(
+        "--connectivity",
+        dest="connectivity",
+        type=str,
+        default="connectivity",
+        help="Filename slug for connectivity by place.",
+    )
+    return parser.parse_args()
+
+
+def get_link_property(link_dict: dict, keys: list[str], default=None):
+    """Returns first of keys (long and short forms) found in link_dict, else default"""
+
+    for key in keys:
+        if key in link_dict:
+            return link_dict[key]
+    return default
+
+
+def node_places(aquius: dict) -> np.ndarray:
+    """Returns place index of each node, -1 if none"""
+
+    place_count = len(aquius["place"])
+    places = np.full(len(aquius["node"]), -1, dtype=np.int64)
+    for node_id, node in enumerate(aquius["node"]):
+        if isinstance(node, list) and len(node) >= 3 and isinstance(node[2], dict):
+            place_id = get_link_property(link_dict=node[2], keys=["p", "place"])
+            if isinstance(place_id, int) and 0 <= place_id < place_count:
+                places[node_id] = place_id
+    return places
+
+
+def flatten_od_links(aquius: dict, service_indices: list[int],
+                     network: Optional[int]) -> dict[str, np.ndarray]:
+    """
+    Flattens links with service into arrays, keys:
+    level, direction, circular, block (-1 if none) - one per link
+    node_link, position, node, board (not setdown), alight (not pickup) - one per node
+    """
+
+    in_network: Optional[np.ndarray] = None
+    if network is not None:
+        bitmap = network_bitmap(inputted=aquius)
+        if 0 <= network < bitmap.shape[1]:
+            in_network = bitmap[:, network]
+        else:
+            logging.warning("Network %s not found, using all links", network)
+
+    blocks: dict = {}
+    level = []
+    direction = []
+    circular = []
+    block = []
+    node_link = []
+    position = []
+    node = []
+    board = []
+    alight = []
+
+    for link in aquius["link"]:
+        if not isinstance(link, list) or len(link) < 4 or not isinstance(link[3], dict):
+            continue
+        if in_network is not None and not any(0 <= product < len(in_network) and
+                                              in_network[product] for product in link[0]):
+            continue
+        shared = get_link_property(link_dict=link[3], keys=["h", "shared"])
+        if isinstance(shared, int) and (in_network is None or (
+                0 <= shared < len(in_network) and in_network[shared])):
+            continue  # Parent product is included (all are without network), so counted there
+        link_level = sum(link[1][index] for index in service_indices if index < len(link[1]))
+        if link_level <= 0:
+            continue
+
+        nodes = link[2]
+        is_circular = bool(get_link_property(link_dict=link[3], keys=["c", "circular"],
+                                             default=False)) and len(nodes) > 1
+        if is_circular:
+            nodes = nodes[:-1]  # Start and end node repeated
+        pickup = set(get_link_property(link_dict=link[3], keys=["u", "pickup"], default=[]))
+        setdown = set(get_link_property(link_dict=link[3], keys=["s", "setdown"], default=[]))
+        link_block = get_link_property(link_dict=link[3], keys=["b", "block"])
+
+        link_id = len(level)
+        level.append(link_level)
+        direction.append(bool(get_link_property(link_dict=link[3], keys=["d", "direction"],
+                                                default=False)))
+        circular.append(is_circular)
+        block.append(-1 if link_block is None else blocks.setdefault(link_block, len(blocks)))
+        node_link += [link_id] * len(nodes)
+        position += range(len(nodes))
+        node += nodes
+        board += [node_id not in setdown for node_id in nodes]
+        alight += [node_id not in pickup for node_id in nodes]
+
+    return {
+        "level": np.array(level, dtype=np.float64),
+        "direction": np.array(direction, dtype=bool),
+        "circular": np.array(circular, dtype=bool),
+        "block": np.array(block, dtype=np.int64),
+        "node_link": np.array(node_link, dtype=np.int64),
+        "position": np.array(position, dtype=np.int64),
+        "node": np.array(node, dtype=np.int64),
+        "board": np.array(board, dtype=bool),
+        "alight": np.array(alight, dtype=bool),
+    }
+
+
+def link_place_groups(flat: dict[str, np.ndarray], places: np.ndarray,
+                      place_count: int) -> dict[str, np.ndarray]:
+    """
+    Reduces nodes to unique link-place groups, ordered by link, keys:
+    link, place, first_board and last_alight (positions on route, forward direction)
+    Where no such node, positions are int64 max or -1 respectively, so comparisons fail
+    """
+
+    valid = (flat["node"] >= 0) & (flat["node"] < len(places))
+    valid[valid] = places[flat["node"][valid]] >= 0
+    node_place = places[flat["node"][valid]]
+    key, group = np.unique(flat["node_link"][valid] * place_count + node_place,
+                           return_inverse=True)
+    position = flat["position"][valid]
+    board = flat["board"][valid]
+    alight = flat["alight"][valid]
+    never = np.iinfo(np.int64).max
+
+    # Reverse boarding is forward alighting (not pickup), reverse alighting forward boarding
+    first_board = np.full(len(key), never, dtype=np.int64)
+    np.minimum.at(first_board, group[board], position[board])
+    last_alight = np.full(len(key), -1, dtype=np.int64)
+    np.maximum.at(last_alight, group[alight], position[alight])
+
+    return {
+        "link": key // place_count,
+        "place": key % place_count,
+        "first_board": first_board,
+        "last_alight": last_alight,
+    }
+
+
+def pair_batches(group_link: np.ndarray, link_count: int, batch: int):
+    """Yields (group, partner) index arrays of every group pair within each link, in batches"""
+
+    groups = np.bincount(group_link, minlength=link_count)
+    group_start = np.cumsum(groups) - groups
+    link_pairs = groups * groups
+    batch_id = np.cumsum(link_pairs) // max(1, batch)
+    for this_batch in np.unique(batch_id[link_pairs > 0]):
+        links = np.flatnonzero(batch_id == this_batch)  # Contiguous, as are their groups
+        group = np.arange(group_start[links[0]], group_start[links[-1]] + groups[links[-1]])
+        # Each group of link repeated once for each group of link
+        repeats = groups[group_link[group]]
+        pair_group = np.repeat(group, repeats)
+        rank = np.arange(len(pair_group)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        yield pair_group, group_start[group_link[pair_group]] + rank
+
+
+def build_od(aquius: dict, service: int, network: Optional[int],
+             batch: int = 10000000) -> sparse.csr_array:
+    """Returns sparse place x place csr_array of direct services, origin rows"""
+
+    service_columns = list(get_service_columns(inputted=aquius, use_service_index=None).values())
+    if service < 0 or service >= len(service_columns):
+        logging.warning("Service %s not found, using first", service)
+        service = 0
+    place_count = len(aquius["place"])
+    flat = flatten_od_links(aquius=aquius, service_indices=service_columns[service],
+                            network=network)
+    groups = link_place_groups(flat=flat, places=node_places(aquius=aquius),
+                               place_count=max(1, place_count))
+
+    matrix = sparse.csr_array((place_count, place_count), dtype=np.float64)
+    block_triples: list[tuple[np.ndarray, ...]] = []
+    for origin, destination in pair_batches(group_link=groups["link"],
+                                            link_count=len(flat["level"]), batch=batch):
+        link = groups["link"][origin]
+        forward = groups["first_board"][origin] < groups["last_alight"][destination]
+        reverse = groups["last_alight"][origin] > groups["first_board"][destination]
+        # Circular: Any boarding in origin and alighting in destination, round the loop
+        circular_forward = ((groups["first_board"][origin] < np.iinfo(np.int64).max) &
+                            (groups["last_alight"][destination] >= 0))
+        circular_reverse = ((groups["last_alight"][origin] >= 0) &
+                            (groups["first_board"][destination] < np.iinfo(np.int64).max))
+        is_circular = flat["circular"][link]
+        is_direction = flat["direction"][link]
+        forward = np.where(is_circular, circular_forward, forward)
+        reverse = np.where(is_circular, circular_reverse, reverse) & ~is_direction
+        share = np.where(is_direction, 1., 0.5)
+        value = flat["level"][link] * share * (forward.astype(np.float64) + reverse)
+
+        keep = (value > 0) & (groups["place"][origin] != groups["place"][destination])
+        in_block = keep & (flat["block"][link] >= 0)
+        keep &= ~in_block
+        matrix += sparse.coo_array((value[keep], (
+            groups["place"][origin][keep], groups["place"][destination][keep])),
+            shape=(place_count, place_count)).tocsr()
+        if np.any(in_block):
+            block_triples.append((flat["block"][link][in_block],
+                                  groups["place"][origin][in_block],
+                                  groups["place"][destination][in_block], value[in_block]))
+
+    if block_triples:
+        # Each block counts the largest value of its links for each origin-destination
+        block, origin, destination, value = [np.concatenate(part) for part in zip(*block_triples)]
+        key, inverse = np.unique(np.stack([block, origin, destination]), axis=1,
+                                 return_inverse=True)
+        block_value = np.zeros(key.shape[1], dtype=np.float64)
+        np.maximum.at(block_value, inverse.reshape(-1), value)
+        matrix += sparse.coo_array((block_value, (key[1], key[2])),
+                                   shape=(place_count, place_count)).tocsr()
+
+    matrix.sum_duplicates()
+    return matrix
+
+
+def place_properties(aquius: dict) -> tuple[list[str], np.ndarray]:
+    """Returns name and population of each place"""
+
+    names: list[str] = []
+    population = np.zeros(len(aquius["place"]), dtype=np.float64)
+    for place_id, place in enumerate(aquius["place"]):
+        name = ""
+        if isinstance(place, list) and len(place) >= 3 and isinstance(place[2], dict):
+            for key in ["p", "population"]:
+                if isinstance(place[2].get(key), (int, float)):
+                    population[place_id] = place[2][key]
+                    break
+            ref = get_link_property(link_dict=place[2], keys=["r", "reference"])
+            if isinstance(ref, list) and len(ref) > 0 and isinstance(ref[0], dict):
+                name = ref[0].get("n", "")
+        names.append(name)
+    return names, population
+
+
+def build_connectivity(matrix: sparse.csr_array, aquius: dict) -> pd.DataFrame:
+    """Returns dataframe of places, population and services directly connected from each place"""
+
+    names, population = place_properties(aquius=aquius)
+    connected = matrix.copy()
+    connected.data = np.ones_like(connected.data)
+    return pd.DataFrame({
+        "place": np.arange(matrix.shape[0]),
+        "name": names,
+        "population": population,
+        "places": connected.sum(axis=1).astype(np.int64),
+        "population_connected": connected @ population,
+        "services": np.round(matrix.sum(axis=1), 2),
+    })
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    if args is None:
+        args = get_args()
+    aquius = load_json(filepath=args.aquius)
+    if not is_aquius(aquius=aquius):
+        logging.error("Not an aquius file: %s", args.aquius)
+        return
+
+    matrix = build_od(aquius=aquius, service=args.service, network=args.network,
+                      batch=args.batch)
+    triples = matrix.tocoo()
+    od_df = pd.DataFrame({
+        "origin": triples.row.astype(np.int64),
+        "destination": triples.col.astype(np.int64),
+        "services": np.round(triples.data, 2),
+    }).sort_values(by=["origin", "destination"])
+    connectivity_df = build_connectivity(matrix=matrix, aquius=aquius)
+
+    for (df, slug) in [(od_df, args.od), (connectivity_df, args.connectivity)]:
+        try:
+            Path(args.output).mkdir(parents=True, exist_ok=True)
+            if "csv" in args.format:
+                df.to_csv(Path(args.output, f"{slug}.csv"), index=False)
+            if "pq" in args.format:
+                df.to_parquet(Path(args.output, f"{slug}.pq"), index=False)
+        except IOError as err:
+            logging.error("Cannot write %s to %s: %s", slug, args.output, err)
+
+
+if __name__ == "__main__":
+    main()
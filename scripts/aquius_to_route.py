@@ -32,7 +32,7 @@ import numpy as np
 import geopandas as gpd
 from haversine import haversine, Unit
 
-from _common import get_common_args, is_aquius, load_json, use_arrow
+from _common import get_common_args, is_aquius, load_json, service_property_name, use_arrow
 
 
 WGS84CRS = "EPSG:4326"
@@ -351,12 +351,6 @@ def add_service_to_properties(
     return properties
 
 
-def service_property_name(meta_one: List[dict]) -> str:
-    """Returns name for a meta service [1] entry, in English else first available"""
-
-    return meta_one.get("en-US", next(iter(meta_one)))
-
-
 def route_analysis(properties: dict, node_list: List[int], aquius: dict, args: argparse.Namespace,
                    km_max_stage_allowed: Optional[float] = None) -> tuple[dict, List[tuple]]:
     """
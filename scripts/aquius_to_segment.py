@@ -0,0 +1,191 @@
+"""
+Python script that reduces aquius links to segments: Unique pairs of adjoining nodes,
+regardless of direction, such that each section of corridor is reported once.
+Each segment includes:
+* Services summed for each aquius service (period), one column per service.
+* Product (operator) split of services, for one service: --product_service 0
+  (multi-product links are shared equally, as aquius_to_csv.py).
+* Haversine length in km, measured once per segment.
+Optionally limited to links of one network filter: --network 0
+
+Usage: python aquius_to_segment.py aquius.json
+Add --format csv gpkg pq to output to one or more of CSV, GeoPackage, or GeoParquet
+See aquius_to_segment.py -h for further arguments
+"""
+
+import argparse
+import logging
+from os import getcwd
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import geopandas as gpd
+from haversine import haversine_vector, Unit
+import shapely
+
+from _common import get_common_args, is_aquius, load_json, use_arrow
+from aquius_to_csv import flatten_links, get_service_columns, group_sum, select_network
+
+
+WGS84CRS = "EPSG:4326"
+
+
+def get_args() -> argparse.Namespace:
+    """Get command line arguments or apply defaults"""
+
+    parser = get_common_args(doc=__doc__)
+    parser.add_argument(
+        "--output",
+        dest="output",
+        help="Output directory root. Defaults to working directory.",
+        type=Path,
+        default=getcwd(),
+    )
+    parser.add_argument(
+        "--format",
+        dest="format",
+        nargs="+",
+        type=str,
+        default=["pq"],
+        choices=["csv", "gpkg", "pq"],
+        help="Output file format (csv gpkg pq), defaults to GeoParquet.",
+    )
+    parser.add_argument(
+        "--product_service",
+        dest="product_service",
+        type=int,
+        default=0,
+        help="Position in aquius service array of the service split by product.",
+    )
+    parser.add_argument(
+        "--network",
+        dest="network",
+        type=int,
+        default=None,
+        help="Network filter index (position in array), else all links.",
+    )
+    parser.add_argument(
+        "--segment",
+        dest="segment",
+        type=str,
+        default="segment",
+        help="Filename slug for segment.",
+    )
+    return parser.parse_args()
+
+
+def product_names(aquius: dict, product_count: int, taken: list[str]) -> list[str]:
+    """Returns column name for each product, in product order, unique including taken"""
+
+    names: list[str] = []
+    for product_id in range(product_count):
+        product = aquius.get("reference", {}).get("product", [])
+        name = None
+        if product_id < len(product) and isinstance(product[product_id], dict):
+            name = product[product_id].get("en-US", next(iter(product[product_id].values()), None))
+        name = f"product_{product_id}" if not isinstance(name, str) or not name else name
+        while name in names or name in taken:
+            name = f"{name}_{product_id}"
+        names.append(name)
+    return names
+
+
+def build_segment(aquius: dict, network: Optional[int], product_service: int) -> gpd.GeoDataFrame:
+    """Returns gdf of unique undirected node pairs with services, product split and km"""
+
+    service_columns = get_service_columns(inputted=aquius, use_service_index=None)
+    service_names = list(service_columns.keys())
+    flat = flatten_links(inputted=aquius, service_columns=service_columns)
+    if network is not None:
+        flat = select_network(inputted=aquius, flat=flat, network=network)
+    if product_service < 0 or product_service >= len(service_names):
+        logging.warning("Product service %s not found, using first", product_service)
+        product_service = 0
+
+    # Nodes without coordinates are skipped, so segments join the nodes either side
+    node_count = len(aquius["node"])
+    coordinates = np.full((node_count, 2), np.nan, dtype=np.float64)
+    for node_id, node in enumerate(aquius["node"]):
+        if (isinstance(node, list) and len(node) >= 2 and
+                isinstance(node[0], (int, float)) and isinstance(node[1], (int, float))):
+            coordinates[node_id] = node[:2]
+    is_valid = ((flat["node"] >= 0) & (flat["node"] < node_count))
+    is_valid[is_valid] = ~np.isnan(coordinates[flat["node"][is_valid], 0])
+    node = flat["node"][is_valid]
+    node_link = flat["node_link"][is_valid]
+
+    # Segment: Each adjoining node pair within a link, ordered low node id first
+    is_pair = (node_link[1:] == node_link[:-1]) & (node[1:] != node[:-1])
+    segment_link = node_link[:-1][is_pair]
+    segment_a = np.minimum(node[:-1], node[1:])[is_pair]
+    segment_b = np.maximum(node[:-1], node[1:])[is_pair]
+
+    # Sparse adjacency: Only node pairs served are held, keyed a * node_count + b
+    edge_key, edge_id = np.unique(segment_a * node_count + segment_b, return_inverse=True)
+    edge_a = edge_key // max(1, node_count)
+    edge_b = edge_key % max(1, node_count)
+
+    # Link services are shared by product, so sum of link products restores the link total
+    product_count = np.bincount(flat["product_link"], minlength=len(flat["service"]))
+    link_service = flat["service"] * product_count.reshape(-1, 1)
+    edge_service = group_sum(edge_id, weights=link_service[segment_link], size=len(edge_key))
+
+    products = max(int(flat["product"].max(initial=-1)) + 1,
+                   len(aquius.get("reference", {}).get("product", [])))
+    link_product = np.zeros((len(flat["service"]), products), dtype=np.float64)
+    np.add.at(link_product, (flat["product_link"], flat["product"]),
+              flat["service"][flat["product_link"], product_service])
+    edge_product = group_sum(edge_id, weights=link_product[segment_link], size=len(edge_key))
+
+    km = haversine_vector(coordinates[edge_a][:, ::-1], coordinates[edge_b][:, ::-1],
+                          unit=Unit.KILOMETERS) if len(edge_key) > 0 else np.zeros(0)
+
+    columns = {
+        "node_a": edge_a,
+        "node_b": edge_b,
+        "km": np.round(km, 3),
+    }
+    for position, name in enumerate(service_names):
+        columns[name] = np.round(edge_service[:, position], 2)
+    for position, name in enumerate(product_names(
+            aquius=aquius, product_count=products, taken=list(columns.keys()))):
+        if np.any(edge_product[:, position]):
+            columns[name] = np.round(edge_product[:, position], 2)
+
+    return gpd.GeoDataFrame(columns, geometry=shapely.linestrings(
+        np.stack([coordinates[edge_a], coordinates[edge_b]], axis=1).reshape(-1, 2, 2)),
+        crs=WGS84CRS)
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    if args is None:
+        args = get_args()
+    aquius = load_json(filepath=args.aquius)
+    if not is_aquius(aquius=aquius, skip_place=True):
+        logging.error("Not an aquius file: %s", args.aquius)
+        return
+
+    gdf = build_segment(aquius=aquius, network=args.network,
+                        product_service=args.product_service)
+    slug = args.segment
+    try:
+        Path(args.output).mkdir(parents=True, exist_ok=True)
+        if "csv" in args.format:
+            gdf.to_csv(Path(args.output, f"{slug}.csv"), index=False)
+        if "gpkg" in args.format:
+            gdf.to_file(Path(args.output, f"{slug}.gpkg"), layer=slug,
+                        driver="GPKG", index=False, use_arrow=use_arrow())
+        if "pq" in args.format:
+            gdf.to_parquet(Path(args.output, f"{slug}.pq"), index=False)
+    except IOError as err:
+        logging.error("Cannot write %s to %s: %s", slug, args.output, err)
+
+
+if __name__ == "__main__":
+    main()
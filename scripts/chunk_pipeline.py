@@ -0,0 +1,327 @@
+"""
+Python script that processes each chunk from gtfs_chunker.py in parallel, then reduces
+the results into single outputs. Stages:
+- aquius: gtfs_to_aquius.py per chunk, merged into one Aquius file (as merge_aquius.py)
+- csv: as aquius, plus aquius_to_csv.py per chunk, with operator, place, service and node
+  CSVs summed across chunks (the merged Aquius file is also written)
+Chunks are read from the chunker manifest (else any .zip in the directory).
+Failed chunks are retried. Progress is recorded, so rerunning the same command resumes,
+skipping chunks already complete whose source has not changed (by manifest sha256),
+and that were processed with the same config content (by sha256) and --index.
+Outputs are only reduced once every chunk is complete.
+
+Usage: chunk_pipeline.py chunk_directory --config config.json --stage csv
+See chunk_pipeline.py -h for further arguments
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from _common import load_csv, load_json, save_json, save_to_csv
+import aquius_to_csv
+import gtfs_to_aquius
+from merge_aquius import load_aquius, merge
+
+
+CSV_OUTPUTS = ["operator", "place", "service", "node"]
+PROGRESS_FILENAME = "pipeline_progress.json"
+
+
+def get_args() -> argparse.Namespace:
+    """Get command line arguments or apply defaults"""
+
+    class ArgparseFormatter(
+        argparse.ArgumentDefaultsHelpFormatter,
+        argparse.RawTextHelpFormatter
+    ):
+        """Formatter supports both defaults and help"""
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=ArgparseFormatter)
+    parser.add_argument(
+        "input",
+        nargs="?",
+        type=Path,
+        help="Directory of chunks (and manifest) output by gtfs_chunker.py",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=Path,
+        default=None,
+        help="Output directory. Defaults to the input directory",
+    )
+    parser.add_argument(
+        "--stage",
+        dest="stage",
+        choices=["aquius", "csv"],
+        default="aquius",
+        help="Per-chunk processing, see above",
+    )
+    parser.add_argument(
+        "--config",
+        dest="config",
+        type=Path,
+        default=None,
+        help="GTFS To Aquius config.json, shared by all chunks",
+    )
+    parser.add_argument(
+        "--index",
+        dest="index",
+        default=0,
+        type=int,
+        help="Service index (position in array) for csv stage",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        default=os.cpu_count(),
+        type=int,
+        help="Number of chunks processed at the same time",
+    )
+    parser.add_argument(
+        "--retry",
+        dest="retry",
+        default=2,
+        type=int,
+        help="Number of times a failed chunk is retried",
+    )
+    parser.add_argument(
+        "--fresh",
+        dest="fresh",
+        action="store_true",
+        help="Ignore recorded progress, processing all chunks again",
+    )
+    return parser.parse_args()
+
+
+def get_chunks(directory: Path) -> Dict[str, Optional[str]]:
+    """Returns chunk filename: sha256 (None if no manifest), in order"""
+
+    manifests = sorted(directory.glob("*_manifest.json"))
+    if manifests:
+        manifest = load_json(filepath=manifests[0])
+        chunks = {entry["file"]: entry.get("sha256") for entry in manifest.get("chunks", [])
+                  if "file" in entry}
+        if chunks:
+            return chunks
+    return {path.name: None for path in sorted(directory.glob("*.zip"))}
+
+
+def chunk_outputs(chunk: str, output: Path, stage: str) -> Dict[str, Path]:
+    """Returns output name: filename expected of chunk at stage"""
+
+    stem = Path(chunk).stem
+    outputs = {"aquius": Path(output, f"{stem}.json")}
+    if stage == "csv":
+        for name in CSV_OUTPUTS:
+            outputs[name] = Path(output, stem, f"{name}.csv")
+    return outputs
+
+
+def process_chunk(chunk: Path, output: Path, stage: str, config: Optional[Path],
+                  index: int) -> str:
+    """Processes one chunk at stage, raising IOError if outputs are not written"""
+
+    outputs = chunk_outputs(chunk=chunk.name, output=output, stage=stage)
+    for path in outputs.values():
+        path.unlink(missing_ok=True)  # Partial output from any prior failure
+
+    gtfs_to_aquius.main(argparse.Namespace(
+        input=chunk,
+        config=config,
+        output=outputs["aquius"],
+        config_auto=None,
+        memory=512,
+    ))
+
+    if stage == "csv":
+        Path(output, chunk.stem).mkdir(parents=True, exist_ok=True)
+        aquius_to_csv.main(argparse.Namespace(
+            aquius=outputs["aquius"],
+            index=index,
+            **{name: outputs[name] for name in CSV_OUTPUTS},
+        ))
+
+    missing = [str(path) for path in outputs.values() if not path.is_file()]
+    if missing:
+        raise IOError(f"Not written: {', '.join(missing)}")
+    return chunk.name
+
+
+def run_settings(args: argparse.Namespace) -> dict:
+    """Returns settings recorded with chunk progress: config content sha256 and index"""
+
+    config = None
+    if args.config is not None:
+        digest = hashlib.sha256()
+        with open(args.config, mode="rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        config = digest.hexdigest()
+    return {"config": config, "index": args.index}
+
+
+def run_chunks(args: argparse.Namespace, pending: List[str], progress: dict,
+               progress_path: Path, chunks: Dict[str, Optional[str]],
+               settings: dict) -> List[str]:
+    """Processes pending chunks across a process pool, returning any failed"""
+
+    failed = []
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            futures = {executor.submit(
+                process_chunk, Path(args.input, chunk), args.output, args.stage, args.config,
+                args.index): chunk for chunk in pending}
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    future.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception as err:  # pylint: disable=broad-except
+                    logging.warning("Chunk %s failed: %s", chunk, err)
+                    failed.append(chunk)
+                    continue
+                progress[chunk] = {"sha256": chunks[chunk], "stage": args.stage, **settings}
+                save_json(data=progress, filepath=progress_path)
+                logging.info("Chunk %s complete", chunk)
+    except BrokenProcessPool as err:
+        # Typically a worker killed for lack of memory: Retry all chunks not yet recorded
+        logging.warning("Process pool failed: %s", err)
+        failed = [chunk for chunk in pending if chunk not in progress]
+    return failed
+
+
+def is_complete(chunk: str, sha256: Optional[str], progress: dict,
+                args: argparse.Namespace, settings: dict) -> bool:
+    """
+    True if chunk was previously completed at this (or a later) stage, with the same
+    run_settings() (index only if stage csv), outputs intact
+    """
+
+    record = progress.get(chunk)
+    if not isinstance(record, dict) or record.get("sha256") != sha256:
+        return False
+    if "config" not in record or record["config"] != settings["config"]:
+        return False
+    if args.stage == "csv" and (record.get("stage") != "csv" or
+                                "index" not in record or record["index"] != settings["index"]):
+        return False
+    return all(path.is_file() for path in chunk_outputs(
+        chunk=chunk, output=args.output, stage=args.stage).values())
+
+
+def reduce_aquius(chunks: List[str], output: Path):
+    """Merges chunk Aquius files"""
+
+    paths = [chunk_outputs(chunk=chunk, output=output, stage="aquius")["aquius"]
+             for chunk in chunks]
+    save_json(data=merge(inputs=load_aquius(paths=sorted(paths, key=lambda path: path.name))),
+              filepath=Path(output, "aquius.json"))
+
+
+def reduce_csv(chunks: List[str], output: Path):
+    """Sums chunk operator, place, service and node CSVs"""
+
+    operator: Dict[str, float] = {}
+    place: Dict[str, dict] = {}
+    service: Dict[tuple, float] = {}
+    node: Dict[tuple, dict] = {}
+
+    for chunk in chunks:
+        outputs = chunk_outputs(chunk=chunk, output=output, stage="csv")
+        for row in load_csv(filepath=outputs["operator"]):
+            operator[row["operator"]] = operator.get(row["operator"], 0) + float(row["services"])
+        for row in load_csv(filepath=outputs["place"]):
+            if row["place"] not in place:
+                place[row["place"]] = row
+        for row in load_csv(filepath=outputs["service"]):
+            key = (row["operator"], row["place"])
+            service[key] = service.get(key, 0) + float(row["services"])
+        for row in load_csv(filepath=outputs["node"]):
+            key = (row["x"], row["y"])
+            if key not in node:
+                node[key] = {"x": row["x"], "y": row["y"], "name": row["name"],
+                             "code": row["code"], "services": 0, "services_termini": 0,
+                             "dwell_minutes": 0}
+            for column in ["services", "services_termini", "dwell_minutes"]:
+                node[key][column] += float(row[column])
+
+    save_to_csv(filepath=Path(output, "operator.csv"),
+                content=[{"operator": key, "services": value} for key, value in operator.items()],
+                columns=["operator", "services"])
+    save_to_csv(filepath=Path(output, "place.csv"), content=list(place.values()),
+                columns=["place", "x", "y"])
+    save_to_csv(filepath=Path(output, "service.csv"),
+                content=[{"operator": key[0], "place": key[1], "services": value}
+                         for key, value in service.items()],
+                columns=["operator", "place", "services"])
+    for row in node.values():
+        for column in ["services", "services_termini", "dwell_minutes"]:
+            row[column] = round(row[column], 2)
+    save_to_csv(filepath=Path(output, "node.csv"), content=list(node.values()),
+                columns=["x", "y", "name", "code", "services", "services_termini",
+                         "dwell_minutes"])
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    if args is None:
+        args = get_args()
+    if args.input is None or not Path(args.input).is_dir():
+        logging.error("Input %s is not a directory", args.input)
+        return
+    if args.output is None:
+        args.output = args.input
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+
+    chunks = get_chunks(directory=Path(args.input))
+    if not chunks:
+        logging.error("No chunks found in %s", args.input)
+        return
+
+    try:
+        settings = run_settings(args=args)
+    except IOError as err:
+        logging.error("Cannot load %s: %s", args.config, err)
+        return
+    progress_path = Path(args.output, PROGRESS_FILENAME)
+    progress = {}
+    if not args.fresh and progress_path.is_file():
+        progress = load_json(filepath=progress_path)
+    pending = [chunk for chunk, sha256 in chunks.items()
+               if not is_complete(chunk=chunk, sha256=sha256, progress=progress, args=args,
+                                  settings=settings)]
+    for chunk in pending:
+        progress.pop(chunk, None)
+    logging.info("%s of %s chunks to process", len(pending), len(chunks))
+
+    for attempt in range(max(0, args.retry) + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            logging.warning("Retrying %s chunks (attempt %s)", len(pending), attempt + 1)
+        pending = run_chunks(args=args, pending=pending, progress=progress,
+                             progress_path=progress_path, chunks=chunks, settings=settings)
+
+    if pending:
+        logging.error("Chunks failed, rerun to resume: %s", ", ".join(pending))
+        return
+
+    reduce_aquius(chunks=list(chunks.keys()), output=args.output)
+    if args.stage == "csv":
+        reduce_csv(chunks=list(chunks.keys()), output=args.output)
+
+
+if __name__ == "__main__":
+    main()
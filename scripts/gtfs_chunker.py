@@ -9,19 +9,40 @@ A better approach would be to split data by operator.
 Note chunking does not respect GTFS blocks (one block may span multiple chunks),
 so this script will not reliably handle all blocks.
 
+Rows of stop_times.txt are expected to be grouped by trip_id. If a trip_id is found
+to recur after another trip has started, chunks written so far are discarded and
+stop_times.txt is instead external merge sorted by trip_id and stop_sequence,
+holding no more than --memory megabytes of rows in memory before spilling runs to disk.
+Use --sort to skip straight to sorting when input is known to be unsorted.
+
+A manifest {stem}_manifest.json lists each chunk's trip and line count, byte size,
+agency and route ids, and a SHA-256 hash of its content (stable between re-runs).
+With --index, {stem}_trip_index.csv records the chunk, uncompressed byte offset,
+and line count of each trip within the source stop_times.txt (grouped input only).
+
 Usage: gtfs_chunker.py gtfs.zip --noshapes
 See gtfs_chunker.py -h for further arguments
 """
 
 import argparse
+from contextlib import ExitStack
 import csv
+import hashlib
+import heapq
 from io import TextIOWrapper
+import json
+import logging
 from os import getcwd
 from pathlib import Path
-from tempfile import SpooledTemporaryFile
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import zipfile
 
 
+class UnsortedError(Exception):
+    """Raised when stop_times.txt rows are found not to be grouped by trip_id"""
+
+
 def main(args=None):
     """
     Entry point: Start here
@@ -59,14 +80,29 @@ Defaults to 15 million, typically just over 1GB of stop_times.txt."""
             action="store_true",
             help="Remove shapes.txt (not required for schedule analysis)."
         )
+        parser.add_argument(
+            "--sort",
+            dest="sort",
+            action="store_true",
+            help="""Always external sort stop_times.txt by trip_id and stop_sequence.
+Otherwise sorting only happens once stop_times.txt is found not grouped by trip_id."""
+        )
+        parser.add_argument(
+          "--memory",
+          dest="memory",
+          default=512,
+          type=int,
+          help="""Approximate megabytes of stop_times.txt rows held in memory while sorting.
+Larger values create fewer temporary runs on disk."""
+        )
+        parser.add_argument(
+            "--index",
+            dest="index",
+            action="store_true",
+            help="Write byte offset index of trip starts in the source stop_times.txt."
+        )
         args = parser.parse_args()
 
-    line_num = 0  # Current line of stop_times.txt
-    trip_col = 0  # Column index of stop_times.txt trip_id
-    trip_id = None  # Current trip_id
-    file_num = 1  # Current output file index
-    header = None  # stop_times.txt header line
-
     if not zipfile.is_zipfile(args.input):
         raise IOError("Input is not a zip file.")
 
@@ -75,47 +111,262 @@ Defaults to 15 million, typically just over 1GB of stop_times.txt."""
         if "stop_times.txt" not in inputted.namelist():
             raise IOError("No stop_times.txt in input.")
 
-        with inputted.open("stop_times.txt") as stop_times:
-            reader = csv.reader(TextIOWrapper(stop_times, "utf-8"))
-
-            with SpooledTemporaryFile(mode="r+", encoding="utf-8", newline="") as temp:
-                writer = csv.writer(temp, delimiter=",", quoting=csv.QUOTE_MINIMAL)
-
-                for line in reader:
-                    line_num += 1
-
-                    if line_num == 1:
-                        if "trip_id" not in line:
-                            raise IOError("No trip_id in input stop_times.txt.")
-
-                        trip_col = line.index("trip_id")
-                        header = line
-                        writer.writerow(header)
-
-                    elif (
-                        line_num >= (file_num * args.chunk)
-                        and line[trip_col] != trip_id
-                    ):
-                        sub_write(temp, file_num, args.output, inputted,
-                                  args.noshapes, Path(args.input).stem)
-                        # Reset temp:
-                        temp.seek(0)
-                        temp.truncate()
-                        writer.writerow(header)
-                        file_num += 1
-                        trip_id = line[trip_col]
-                        writer.writerow(line)
+        trip_route, route_agency = get_trip_lookups(inputted=inputted)
+        manifest = {
+            "source": Path(args.input).name,
+            "chunk": args.chunk,
+            "sorted": False,  # True if stop_times.txt required external sorting
+            "index": None,
+            "chunks": [],
+        }
+        index_path = Path(args.output, f"{Path(args.input).stem}_trip_index.csv")
 
+        if not getattr(args, "sort", False):
+            try:
+                with inputted.open("stop_times.txt") as stop_times:
+                    if getattr(args, "index", False):
+                        lines = OffsetLines(binary=stop_times)
+                        manifest["chunks"] = chunk(
+                            csv.reader(lines), args=args, inputted=inputted,
+                            check_sorted=True, trip_route=trip_route, lines=lines,
+                            index_path=index_path)
+                        manifest["index"] = index_path.name
                     else:
-                        trip_id = line[trip_col]
-                        writer.writerow(line)
+                        manifest["chunks"] = chunk(
+                            csv.reader(TextIOWrapper(stop_times, "utf-8")), args=args,
+                            inputted=inputted, check_sorted=True, trip_route=trip_route)
+            except UnsortedError as err:
+                logging.warning("%s, restarting with external sort", err)
+                if getattr(args, "index", False):
+                    logging.warning("Trip index not written: Offsets only index grouped input")
+                index_path.unlink(missing_ok=True)
+                manifest["sorted"] = True
+
+        if getattr(args, "sort", False) or manifest["sorted"]:
+            manifest["sorted"] = True
+            with inputted.open("stop_times.txt") as stop_times:
+                manifest["chunks"] = chunk(
+                    sort_stop_times(csv.reader(TextIOWrapper(stop_times, "utf-8")),
+                                    memory=getattr(args, "memory", 512)),
+                    args=args, inputted=inputted, check_sorted=False, trip_route=trip_route)
+
+    for entry in manifest["chunks"]:
+        entry["agency_id"] = sorted(set(
+            route_agency.get(route_id, "") for route_id in entry["route_id"]))
+
+    with open(Path(args.output, f"{Path(args.input).stem}_manifest.json"),
+              mode="w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=1)
+
+
+class OffsetLines:
+    """Iterates decoded lines of a binary stream, offset being the byte position reached"""
+
+    def __init__(self, binary, encoding: str = "utf-8"):
+        self.binary = binary
+        self.encoding = encoding
+        self.offset = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        line = self.binary.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode(self.encoding)
+
+
+def get_trip_lookups(inputted: zipfile.ZipFile) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """Returns trips.txt trip_id: route_id and routes.txt route_id: agency_id"""
+
+    trip_route: Dict[str, str] = {}
+    route_agency: Dict[str, str] = {}
+    route_ids: Dict[str, str] = {}  # Shares one string per route_id across trips
+
+    if "routes.txt" in inputted.namelist():
+        with inputted.open("routes.txt") as routes:
+            for row in csv.DictReader(TextIOWrapper(routes, "utf-8-sig")):
+                route_agency[row.get("route_id", "")] = row.get("agency_id", "")
+    if "" in route_agency.values() and "agency.txt" in inputted.namelist():
+        # agency_id is optional where only one agency exists
+        with inputted.open("agency.txt") as agency:
+            agencies = list(csv.DictReader(TextIOWrapper(agency, "utf-8-sig")))
+        if len(agencies) == 1:
+            for route_id, agency_id in route_agency.items():
+                if agency_id == "":
+                    route_agency[route_id] = agencies[0].get("agency_id", "")
+
+    if "trips.txt" in inputted.namelist():
+        with inputted.open("trips.txt") as trips:
+            for row in csv.DictReader(TextIOWrapper(trips, "utf-8-sig")):
+                route_id = route_ids.setdefault(row.get("route_id", ""), row.get("route_id", ""))
+                trip_route[row.get("trip_id", "")] = route_id
+
+    return trip_route, route_agency
+
+
+def chunk(reader: Iterable[list], args, inputted: zipfile.ZipFile, check_sorted: bool,
+          trip_route: Dict[str, str], lines: Optional[OffsetLines] = None,
+          index_path: Optional[Path] = None) -> List[dict]:
+    """
+    Write reader (stop_times.txt rows, header first) into chunked GTFS archives,
+    returning a manifest entry per archive
+    If check_sorted, raises UnsortedError (having removed any archives written)
+    as soon as a trip_id recurs after a different trip_id
+    If lines (that underlying reader) and index_path, writes the byte offset of each trip start
+    """
+
+    line_num = 0  # Current line of stop_times.txt
+    trip_col = 0  # Column index of stop_times.txt trip_id
+    trip_id = None  # Current trip_id
+    file_num = 1  # Current output file index
+    header = None  # stop_times.txt header line
+    finished_trips = set()  # Hashes of trip_id already passed, if check_sorted
+    written: List[dict] = []  # Manifest entry per archive written
+    current = {"trips": 0, "lines": 0, "route_id": set()}  # Current archive content
+    next_offset = 0  # Byte offset of the next row, if lines
+    trip_start = [0, 0]  # Byte offset and line_num of trip_id start, if lines
+
+    with ExitStack() as stack:
+        temp = stack.enter_context(
+            SpooledTemporaryFile(mode="r+", encoding="utf-8", newline=""))
+        writer = csv.writer(temp, delimiter=",", quoting=csv.QUOTE_MINIMAL)
+        index_writer = None
+        if lines is not None and index_path is not None:
+            Path(args.output).mkdir(parents=True, exist_ok=True)
+            index_writer = csv.writer(stack.enter_context(
+                open(index_path, mode="w", encoding="utf-8", newline="")))
+            index_writer.writerow(["trip_id", "chunk", "offset", "lines"])
+
+        for line in reader:
+            line_num += 1
+            offset = next_offset
+            if lines is not None:
+                next_offset = lines.offset
+
+            if line_num == 1:
+                if "trip_id" not in line:
+                    raise IOError("No trip_id in input stop_times.txt.")
+
+                trip_col = line.index("trip_id")
+                header = line
+                writer.writerow(header)
+                continue
+
+            if line[trip_col] != trip_id:
+                if check_sorted:
+                    # Hash collisions merely cause an unnecessary sort:
+                    if hash(line[trip_col]) in finished_trips:
+                        for entry in written:
+                            Path(args.output, entry["file"]).unlink(missing_ok=True)
+                        raise UnsortedError(
+                            f"stop_times.txt trip_id {line[trip_col]} recurs at line {line_num}")
+                    finished_trips.add(hash(trip_id))
+
+                if index_writer is not None and trip_id is not None:
+                    index_writer.writerow([trip_id, file_num, trip_start[0],
+                                           line_num - trip_start[1]])
+                    trip_start = [offset, line_num]
+
+                if line_num >= (file_num * args.chunk):
+                    written.append(sub_write(temp, file_num, args.output, inputted,
+                                             args.noshapes, Path(args.input).stem, current))
+                    # Reset temp:
+                    temp.seek(0)
+                    temp.truncate()
+                    writer.writerow(header)
+                    file_num += 1
+                    current = {"trips": 0, "lines": 0, "route_id": set()}
+
+                current["trips"] += 1
+                current["route_id"].add(trip_route.get(line[trip_col], ""))
+                if trip_id is None:
+                    trip_start = [offset, line_num]
+
+            trip_id = line[trip_col]
+            current["lines"] += 1
+            writer.writerow(line)
+
+        # Finally
+        if index_writer is not None and trip_id is not None:
+            index_writer.writerow([trip_id, file_num, trip_start[0],
+                                   line_num + 1 - trip_start[1]])
+        written.append(sub_write(temp, file_num, args.output, inputted,
+                                 args.noshapes, Path(args.input).stem, current))
 
-                # Finally
-                sub_write(temp, file_num, args.output, inputted,
-                          args.noshapes, Path(args.input).stem)
+    return written
 
-def sub_write(temp, file_num, output, inputted, noshapes, stem):
-    """Write GTFS"""
+
+def sort_stop_times(reader: Iterator[list], memory: int) -> Iterator[list]:
+    """
+    External merge sort of reader (stop_times.txt rows) by trip_id then stop_sequence
+    Yields header then sorted rows, spilling sorted runs of about memory megabytes to disk
+    """
+
+    header = next(reader, None)
+    if header is None:
+        return
+    if "trip_id" not in header:
+        raise IOError("No trip_id in input stop_times.txt.")
+    yield header
+    trip_col = header.index("trip_id")
+    sequence_col = header.index("stop_sequence") if "stop_sequence" in header else None
+
+    def _key(row: list) -> tuple:
+        """Sort key, tolerating missing or non-integer stop_sequence"""
+
+        if sequence_col is None:
+            return (row[trip_col], 0)
+        try:
+            return (row[trip_col], int(row[sequence_col]))
+        except (IndexError, ValueError):
+            return (row[trip_col], 0)
+
+    budget = max(1, memory) * 1024 * 1024
+    with TemporaryDirectory() as temp_dir:
+        runs: List[Path] = []
+        rows: List[list] = []
+        size = 0  # Approximate bytes held in rows
+
+        for row in reader:
+            rows.append(row)
+            size += 64 + sum(len(field) + 49 for field in row)  # CPython object overheads
+            if size >= budget:
+                runs.append(write_run(rows=rows, key=_key, temp_dir=temp_dir, run=len(runs)))
+                rows = []
+                size = 0
+
+        if not runs:  # Fitted in memory
+            rows.sort(key=_key)
+            yield from rows
+            return
+        if rows:
+            runs.append(write_run(rows=rows, key=_key, temp_dir=temp_dir, run=len(runs)))
+            rows = []
+        logging.info("Merging %s sorted runs of stop_times.txt", len(runs))
+
+        files = [open(run, mode="r", encoding="utf-8", newline="") for run in runs]
+        try:
+            yield from heapq.merge(*[csv.reader(file) for file in files], key=_key)
+        finally:
+            for file in files:
+                file.close()
+
+
+def write_run(rows: List[list], key, temp_dir: str, run: int) -> Path:
+    """Sort rows by key and write to a temporary CSV run, returning its path"""
+
+    rows.sort(key=key)
+    filename = Path(temp_dir, f"run_{run}.csv")
+    with open(filename, mode="w", encoding="utf-8", newline="") as file:
+        csv.writer(file, delimiter=",", quoting=csv.QUOTE_MINIMAL).writerows(rows)
+    return filename
+
+
+def sub_write(temp, file_num, output, inputted, noshapes, stem, content):
+    """Write GTFS, returning its manifest entry, content being trips, lines and route_id"""
 
     Path(output).mkdir(parents=True, exist_ok=True)
     filename = Path(output, f"{stem}_{file_num}.zip")
@@ -126,19 +377,38 @@ def sub_write(temp, file_num, output, inputted, noshapes, stem):
         compression=zipfile.ZIP_DEFLATED
     ) as gtfs:
 
+        # Hash of content, not archive, since archive timestamps change between runs:
+        content_hash = hashlib.sha256()
+
         for name in inputted.namelist():
 
             if name == "stop_times.txt":
                 temp.seek(0)
+                data = temp.read()
                 gtfs.writestr(
                     name,
-                    temp.read()
+                    data
                 )
+                data = data.encode("utf-8")
             elif not noshapes or name != "shapes.txt":
+                data = inputted.read(name)
                 gtfs.writestr(
                     name,
-                    inputted.read(name)
+                    data
                 )
+            else:
+                continue
+            content_hash.update(name.encode("utf-8"))
+            content_hash.update(data)
+
+    return {
+        "file": filename.name,
+        "trips": content["trips"],
+        "lines": content["lines"],
+        "bytes": filename.stat().st_size,
+        "route_id": sorted(content["route_id"]),
+        "sha256": content_hash.hexdigest(),
+    }
 
 if __name__ == "__main__":
     main()
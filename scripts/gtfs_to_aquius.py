@@ -0,0 +1,1298 @@
+"""
+Python script that converts a GTFS archive (zip or directory) into an Aquius file,
+following GTFS To Aquius (dist/gtfs.js) and accepting the same config.json.
+Unlike gtfs.js, stop_times.txt is streamed one trip at a time, each trip merged straight
+into its link, so memory depends on the number of stops, trips and unique links,
+not the size of stop_times.txt. Large feeds (such as BODS) need not be chunked.
+
+stop_times.txt is expected grouped by trip_id. If not, it is external merge sorted
+(as gtfs_chunker.py) holding no more than --memory megabytes of rows in memory.
+
+Supported config keys match the GTFS To Aquius README, including networkFilter,
+serviceFilter, coordinatePrecision and allowDuration. Not supported (use gtfs.js):
+allowBlock, allowCabotage, allowSplit, stopPlace and GeoJSON boundaries -
+add places afterwards with place_from_gis.py or place_from_csv.py.
+Stops are grouped into nodes only by shared coordinates at coordinatePrecision.
+
+Usage: gtfs_to_aquius.py gtfs.zip --config config.json --output aquius.json
+See gtfs_to_aquius.py -h for further arguments
+"""
+
+import argparse
+from contextlib import contextmanager
+import csv
+from datetime import date, datetime, timedelta
+from io import TextIOWrapper
+import logging
+from math import atan2, cos, floor, pi, sin, sqrt
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+import zipfile
+
+from _common import load_json, save_json
+from gtfs_chunker import UnsortedError, sort_stop_times
+
+
+DEFAULT_CONFIG = {
+    "agencyPrefix": "",
+    "allowBlock": False,
+    "allowDuration": False,
+    "allowDwell": False,
+    "allowCabotage": False,
+    "allowCode": True,
+    "allowColor": True,
+    "allowDuplication": False,
+    "allowHeadsign": False,
+    "allowName": True,
+    "allowNoc": False,
+    "allowRoute": True,
+    "allowRouteLong": False,
+    "allowRouteUrl": True,
+    "allowSplit": False,
+    "allowStopUrl": True,
+    "allowWaypoint": True,
+    "allowZeroCoordinate": True,
+    "codeAsStopId": False,
+    "coordinatePrecision": 5,
+    "duplicationRouteOnly": True,
+    "fromDate": "",
+    "inGeojson": True,
+    "isCircular": [],
+    "meta": {"schema": "0"},
+    "mirrorLink": True,
+    "modeInclude": [],
+    "networkFilter": {"type": "agency"},
+    "nodeGeojson": {},
+    "option": {},
+    "populationProperty": "population",
+    "placeNameProperty": "name",
+    "productOverride": {},
+    "routeExclude": [],
+    "routeInclude": [],
+    "routeOverride": {},
+    "serviceFilter": {},
+    "servicePer": 1,
+    "splitMinimumJoin": 2,
+    "stopExclude": [],
+    "stopInclude": [],
+    "stopOverride": {},
+    "stopPlace": False,
+    "toDate": "",
+    "translation": {},
+}
+UNSUPPORTED_CONFIG = ["allowBlock", "allowCabotage", "allowSplit", "stopPlace"]
+
+MODE_LOOKUP = {
+    "0": {"en-US": "Tram"},
+    "1": {"en-US": "Metro"},
+    "2": {"en-US": "Rail"},
+    "3": {"en-US": "Bus"},
+    "4": {"en-US": "Ferry"},
+    "5": {"en-US": "Cable car"},
+    "6": {"en-US": "Cable car"},
+    "7": {"en-US": "Funicular"},
+    "100": {"en-US": "Rail"},
+    "101": {"en-US": "High speed rail"},
+    "102": {"en-US": "Long distance rail"},
+    "103": {"en-US": "Inter-regional rail"},
+    "105": {"en-US": "Sleeper rail"},
+    "106": {"en-US": "Regional rail"},
+    "107": {"en-US": "Tourist rail"},
+    "108": {"en-US": "Rail shuttle"},
+    "109": {"en-US": "Suburban rail"},
+    "200": {"en-US": "Coach"},
+    "201": {"en-US": "International coach"},
+    "202": {"en-US": "National coach"},
+    "204": {"en-US": "Regional coach"},
+    "208": {"en-US": "Commuter coach"},
+    "400": {"en-US": "Urban rail"},
+    "401": {"en-US": "Metro"},
+    "402": {"en-US": "Underground"},
+    "405": {"en-US": "Monorail"},
+    "700": {"en-US": "Bus"},
+    "701": {"en-US": "Regional bus"},
+    "702": {"en-US": "Express bus"},
+    "704": {"en-US": "Local bus"},
+    "800": {"en-US": "Trolleybus"},
+    "900": {"en-US": "Tram"},
+    "1000": {"en-US": "Water"},
+    "1300": {"en-US": "Telecabin"},
+    "1400": {"en-US": "Funicular"},
+    "1501": {"en-US": "Shared taxi"},
+    "1700": {"en-US": "Other"},
+    "1701": {"en-US": "Cable car"},
+    "1702": {"en-US": "Horse-drawn"},
+}
+DAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+WILDCARD = "[*]"
+
+
+def get_args() -> argparse.Namespace:
+    """Get command line arguments or apply defaults"""
+
+    class ArgparseFormatter(
+        argparse.ArgumentDefaultsHelpFormatter,
+        argparse.RawTextHelpFormatter
+    ):
+        """Formatter supports both defaults and help"""
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=ArgparseFormatter)
+    parser.add_argument(
+        "input",
+        nargs="?",
+        type=Path,
+        help="GTFS zip filename, or directory of GTFS .txt files",
+    )
+    parser.add_argument(
+        "--config",
+        dest="config",
+        type=Path,
+        default=None,
+        help="GTFS To Aquius config.json, defaults to config.json within an input directory",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=Path,
+        default=Path("aquius.json"),
+        help="Output Aquius .json filename with path",
+    )
+    parser.add_argument(
+        "--config_auto",
+        dest="config_auto",
+        type=Path,
+        default=None,
+        help="Optional filename to write the config with defaults applied (as config.auto)",
+    )
+    parser.add_argument(
+        "--memory",
+        dest="memory",
+        type=int,
+        default=512,
+        help="Approximate megabytes of stop_times.txt rows held in memory if sorting is required",
+    )
+    return parser.parse_args()
+
+
+class GtfsSource:
+    """GTFS text files read from a zip archive or a directory"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.archive: Optional[zipfile.ZipFile] = None
+        if self.path.is_file() and zipfile.is_zipfile(self.path):
+            self.archive = zipfile.ZipFile(self.path, mode="r")
+            self.names = {Path(name).stem: name for name in self.archive.namelist()
+                          if name.endswith(".txt")}
+        elif self.path.is_dir():
+            self.names = {child.stem: child.name for child in self.path.glob("*.txt")}
+        else:
+            raise IOError(f"{path} is neither a zip file nor a directory")
+
+    def has(self, slug: str) -> bool:
+        """True if GTFS file slug (name without .txt) exists"""
+
+        return slug in self.names
+
+    @contextmanager
+    def rows(self, slug: str) -> Iterator[Tuple[Dict[str, int], Iterator[List[str]]]]:
+        """
+        Yields header (column: position) and iterator of trimmed rows of GTFS file slug
+        Rows whose length differs from the header are skipped, as gtfs.js
+        """
+
+        if self.archive is not None:
+            file = TextIOWrapper(self.archive.open(self.names[slug]), "utf-8-sig", newline="")
+        else:
+            file = open(Path(self.path, self.names[slug]), mode="r", encoding="utf-8-sig",
+                        newline="")
+        try:
+            reader = csv.reader(file)
+            header_row = [value.strip() for value in next(reader, [])]
+            header = {column: position for position, column in enumerate(header_row)}
+
+            def _rows() -> Iterator[List[str]]:
+                for row in reader:
+                    if len(row) == len(header_row):
+                        yield [value.strip() for value in row]
+
+            yield header, _rows()
+        finally:
+            file.close()
+
+    @contextmanager
+    def raw_rows(self, slug: str) -> Iterator[Iterator[List[str]]]:
+        """Yields csv.reader over GTFS file slug, header included and untrimmed"""
+
+        if self.archive is not None:
+            file = TextIOWrapper(self.archive.open(self.names[slug]), "utf-8-sig", newline="")
+        else:
+            file = open(Path(self.path, self.names[slug]), mode="r", encoding="utf-8-sig",
+                        newline="")
+        try:
+            yield csv.reader(file)
+        finally:
+            file.close()
+
+    def table(self, slug: str) -> Tuple[Dict[str, int], List[List[str]]]:
+        """Returns header and all rows of a (small) GTFS file slug, empty if missing"""
+
+        if not self.has(slug):
+            return {}, []
+        with self.rows(slug) as (header, rows):
+            return header, list(rows)
+
+    def close(self):
+        """Close any archive"""
+
+        if self.archive is not None:
+            self.archive.close()
+
+
+def parse_config(config: dict) -> dict:
+    """Returns config with defaults for missing or mistyped keys, as gtfs.js parseConfig"""
+
+    def _is_number(value) -> bool:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    parsed = {}
+    for key, default in DEFAULT_CONFIG.items():
+        if key in config and (type(config[key]) is type(default) or (
+                _is_number(default) and _is_number(config[key]))):
+            parsed[key] = config[key]
+        else:
+            parsed[key] = json_copy(default)
+    for key in UNSUPPORTED_CONFIG:
+        if parsed[key]:
+            logging.warning("Config %s is not supported by this script, use gtfs.js", key)
+    return parsed
+
+
+def json_copy(value: Union[dict, list, str, int, float, bool]):
+    """Copy of JSON-like value (defaults must not be mutated)"""
+
+    if isinstance(value, dict):
+        return {key: json_copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [json_copy(item) for item in value]
+    return value
+
+
+def gtfs_date(value: str) -> Optional[date]:
+    """GTFS YYYYMMDD to date, None on failure"""
+
+    try:
+        return datetime.strptime(value[:8], "%Y%m%d").date()
+    except (TypeError, ValueError):
+        return None
+
+
+def gtfs_seconds(value: str) -> int:
+    """GTFS HH:MM:SS to seconds after midnight, 0 on failure (as gtfs.js)"""
+
+    parts = value.split(":")
+    if len(parts) != 3:
+        return 0
+    try:
+        return int(parts[0]) * 3600 + int(parts[1]) * 60 + int(parts[2])
+    except ValueError:
+        return 0
+
+
+def js_round(value: float) -> int:
+    """Math.round equivalent (halves round up)"""
+
+    return int(floor(value + 0.5))
+
+
+def haversine_metres(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Earth distance, as gtfs.js haversineDistance"""
+
+    rad = pi / 180
+    sin_lat = sin((lat2 - lat1) * rad / 2)
+    sin_lng = sin((lng2 - lng1) * rad / 2)
+    a_value = sin_lat * sin_lat + cos(lat1 * rad) * cos(lat2 * rad) * sin_lng * sin_lng
+    return 6371000 * 2 * atan2(sqrt(a_value), sqrt(1 - a_value))
+
+
+def default_dates(config: dict, source: GtfsSource) -> dict:
+    """Sets config fromDate and toDate, as gtfs.js defaultDates"""
+
+    offset = timedelta(days=6)
+    min_date: Optional[date] = None
+    max_date: Optional[date] = None
+
+    header, calendar = source.table("calendar")
+    if "start_date" in header and "end_date" in header and calendar:
+        for row in calendar:
+            start = gtfs_date(row[header["start_date"]]) or date(1970, 1, 1)
+            end = gtfs_date(row[header["end_date"]]) or date(1970, 1, 1)
+            min_date = start if min_date is None else min(min_date, start)
+            max_date = end if max_date is None else max(max_date, end)
+    else:
+        header, calendar_dates = source.table("calendar_dates")
+        if "date" in header:
+            for row in calendar_dates:
+                the_date = gtfs_date(row[header["date"]]) or date(1970, 1, 1)
+                min_date = the_date if min_date is None else min(min_date, the_date)
+                max_date = the_date if max_date is None else max(max_date, the_date)
+
+    use_start = gtfs_date(config["fromDate"]) if config["fromDate"] else None
+    use_end = gtfs_date(config["toDate"]) if config["toDate"] else None
+    if use_end is not None and use_start is None:
+        use_start = use_end - offset
+    if use_start is None:
+        use_start = date.today()
+    if use_end is None:
+        use_end = use_start + offset
+
+    if min_date is not None and max_date is not None and (
+            use_start < min_date or use_end > max_date):
+        if (max_date - min_date) < offset:
+            use_start, use_end = min_date, max_date
+        else:
+            middle = min_date + (max_date - min_date) / 2
+            use_start, use_end = middle - offset / 2, middle + offset / 2
+
+    config["fromDate"] = use_start.strftime("%Y%m%d")
+    config["toDate"] = use_end.strftime("%Y%m%d")
+    return config
+
+
+def build_header(aquius: dict, config: dict, source: GtfsSource) -> dict:
+    """Adds meta, translation and option to aquius, as gtfs.js buildHeader"""
+
+    config["meta"]["schema"] = "0"
+    if "name" not in config["meta"]:
+        config["meta"]["name"] = {}
+    header, feed_info = source.table("feed_info")
+    if "en-US" not in config["meta"]["name"]:
+        name = ""
+        if "feed_publisher_name" in header and feed_info:
+            name = feed_info[0][header["feed_publisher_name"]] + " "
+        name += f"({config['fromDate']}"
+        if config["fromDate"] != config["toDate"]:
+            name += f"-{config['toDate']}"
+        config["meta"]["name"]["en-US"] = name + ")"
+    if "url" not in config["meta"] and "feed_publisher_url" in header and feed_info:
+        config["meta"]["url"] = feed_info[0][header["feed_publisher_url"]]
+    aquius["meta"] = config["meta"]
+
+    if "en-US" not in config["translation"]:
+        config["translation"]["en-US"] = {}
+    if "link" not in config["translation"]["en-US"]:
+        if config["servicePer"] == 1:
+            config["translation"]["en-US"]["link"] = "Daily Services"
+        elif config["servicePer"] == 7:
+            config["translation"]["en-US"]["link"] = "Weekly Services"
+        else:
+            config["translation"]["en-US"]["link"] = f"Services per {config['servicePer']} Days"
+    aquius["translation"] = config["translation"]
+
+    with source.rows("stops") as (header, rows):
+        first = next(rows, None)
+    if first is not None:
+        try:
+            x_value = float(first[header["stop_lon"]])
+            y_value = float(first[header["stop_lat"]])
+        except (KeyError, ValueError):
+            x_value, y_value = 0., 0.
+        if "c" not in config["option"] or "k" not in config["option"]:
+            config["option"].update({"c": x_value, "k": y_value, "m": 12})
+        if "x" not in config["option"] or "y" not in config["option"]:
+            config["option"].update({"x": x_value, "y": y_value, "z": 10})
+    aquius["option"] = config["option"]
+
+    return aquius
+
+
+def js_key_order(keys: List[str]) -> List[str]:
+    """Keys in JavaScript object order: integer-like ascending, then as inserted"""
+
+    integers = [key for key in keys if key.isdigit() and (key == "0" or key[0] != "0")]
+    return sorted(integers, key=int) + [key for key in keys if key not in set(integers)]
+
+
+def build_network(aquius: dict, config: dict, source: GtfsSource) -> Dict[str, int]:
+    """Adds product references and network to aquius, returning GTFS code: product index"""
+
+    network_filter = config["networkFilter"]
+    if network_filter.get("type") not in ["agency", "mode"]:
+        network_filter["type"] = "agency"
+    if "reference" not in network_filter:
+        network_filter["reference"] = {}
+    product_index: Dict[str, int] = {}
+    aquius["reference"] = {"product": []}
+
+    agency_header, agency = source.table("agency")
+    if network_filter["type"] == "mode":
+        header, routes = source.table("routes")
+        if "route_type" in header:
+            for route in routes:
+                mode = route[header["route_type"]]
+                if mode in product_index:
+                    continue
+                product_index[mode] = len(product_index)
+                if mode not in network_filter["reference"]:
+                    network_filter["reference"][mode] = json_copy(MODE_LOOKUP.get(mode, {}))
+                aquius["reference"]["product"].append(network_filter["reference"][mode])
+    else:
+        column = agency_header.get("agency_id", agency_header.get("agency_name"))
+        if column is not None:
+            for row in agency:
+                code = row[column]
+                if code == "" or code in product_index:
+                    continue
+                product_index[code] = len(product_index)
+                if code not in network_filter["reference"]:
+                    network_filter["reference"][code] = {"en-US": (
+                        config["agencyPrefix"] + agency_name(row, agency_header, config))}
+                aquius["reference"]["product"].append(network_filter["reference"][code])
+        if not product_index:  # Fallback
+            product_index["agency"] = 0
+            network_filter["reference"]["agency"] = {}
+            aquius["reference"]["product"].append({})
+
+    if not isinstance(network_filter.get("network"), list):
+        codes = js_key_order(list(product_index.keys()))
+        if network_filter["type"] == "mode":
+            network_filter["network"] = [[codes, {"en-US": "All modes"}]]
+            if len(codes) > 1:
+                for code in codes:
+                    network_filter["network"].append(
+                        [[code], json_copy(MODE_LOOKUP.get(code, {"en-US": f"Mode #{code}"}))])
+        else:
+            network_filter["network"] = [[codes, {"en-US": "All operators"}]]
+            if len(codes) > 1:
+                for code in codes:
+                    name = code
+                    if "agency_id" in agency_header and "agency_name" in agency_header:
+                        for row in agency:
+                            if row[agency_header["agency_id"]] == code:
+                                name = config["agencyPrefix"] + agency_name(
+                                    row, agency_header, config)
+                                break
+                    network_filter["network"].append([[code], {"en-US": name}])
+
+    aquius["network"] = []
+    for definition in network_filter["network"]:
+        if (isinstance(definition, list) and len(definition) > 1 and
+                isinstance(definition[0], list) and isinstance(definition[1], dict)):
+            aquius["network"].append([
+                [product_index[code] for code in definition[0] if code in product_index],
+                definition[1], {}])
+
+    return product_index
+
+
+def agency_name(row: List[str], header: Dict[str, int], config: dict) -> str:
+    """Agency name (else id) of agency.txt row, with any NOC appended"""
+
+    name = row[header["agency_name"]] if "agency_name" in header else row[header["agency_id"]]
+    if config["allowNoc"] and "agency_noc" in header:
+        name += f" [{row[header['agency_noc']]}]"
+    return name
+
+
+def build_service(aquius: dict, config: dict) -> List[dict]:
+    """Adds service to aquius, returning period definitions (one whole period if none)"""
+
+    service_filter = config["serviceFilter"]
+    aquius["service"] = []  # Empty unlike gtfs.js, but as expected by other scripts
+    if service_filter.get("type") != "period":
+        return [{}]
+
+    if not isinstance(service_filter.get("period"), list) or not service_filter["period"]:
+        weekdays = DAYS[:5]
+        service_filter["period"] = [
+            {"name": {"en-US": "Typical day"}},
+            {"day": weekdays, "name": {"en-US": "Typical weekday"}},
+            {"day": weekdays, "name": {"en-US": "Weekday early"}, "time": [{"end": "10:00:00"}]},
+            {"day": weekdays, "name": {"en-US": "Weekday 10:00-17:00"},
+             "time": [{"start": "10:00:00", "end": "17:00:00"}]},
+            {"day": weekdays, "name": {"en-US": "Weekday evening"},
+             "time": [{"start": "17:00:00"}]},
+            {"day": ["saturday"], "name": {"en-US": "Saturday"}},
+            {"day": ["sunday"], "name": {"en-US": "Sunday"}},
+        ]
+
+    for position, period in enumerate(service_filter["period"]):
+        if "name" not in period:
+            period["name"] = {"en-US": f"Period {position}"}
+        aquius["service"].append([[position], period["name"], {}])
+
+    return service_filter["period"]
+
+
+def add_to_reference(aquius: dict, key: str, value: str, lookup: Dict[str, Dict[str, int]]) -> int:
+    """Returns index of value in aquius reference key, adding it if new"""
+
+    if key not in lookup:
+        lookup[key] = {}
+        aquius["reference"][key] = []
+    if value not in lookup[key]:
+        lookup[key][value] = len(aquius["reference"][key])
+        aquius["reference"][key].append(value)
+    return lookup[key][value]
+
+
+def url_with_wildcard(url: str, codes: List[str]) -> Tuple[str, Optional[str]]:
+    """Replaces the last of the first code found in url by the [*] wildcard, returning code used"""
+
+    if url.rfind(WILDCARD) != -1:
+        return url, None
+    for code in codes:
+        position = url.rfind(code)
+        if position != -1:
+            return url[:position] + WILDCARD + url[position + len(code):], code
+    return url, None
+
+
+def add_node_reference(node: list, properties: dict):
+    """Adds properties to node references unless an existing reference already contains them"""
+
+    references = node[2].setdefault("r", [])
+    for reference in references:
+        if all(key in reference and reference[key] == value for key, value in properties.items()):
+            return
+    references.append(properties)
+
+
+def build_node(aquius: dict, config: dict, source: GtfsSource,
+               reference_lookup: Dict[str, Dict[str, int]]) -> Dict[str, int]:
+    """Adds node to aquius, returning GTFS stop_id: node index"""
+
+    precision = 10 ** config["coordinatePrecision"]
+    stop_exclude = set(config["stopExclude"])
+    stop_include = set(config["stopInclude"])
+    override = config["stopOverride"]
+    node_coord: Dict[Tuple[float, float], int] = {}
+    node_lookup: Dict[str, int] = {}
+    aquius["node"] = []
+
+    def _coord(value) -> float:
+        try:
+            return floor(float(value) * precision + 0.5) / precision
+        except (TypeError, ValueError):
+            return 0
+
+    def _add_stop(row: List[str], header: Dict[str, int]):
+        stop_id = row[header["stop_id"]]
+        if stop_id in override and "x" in override[stop_id] and "y" in override[stop_id]:
+            coords = (_coord(override[stop_id]["x"]), _coord(override[stop_id]["y"]))
+        else:
+            coords = (_coord(row[header["stop_lon"]]), _coord(row[header["stop_lat"]]))
+        if coords == (0, 0):
+            if not config["allowZeroCoordinate"]:
+                return
+            override.setdefault(stop_id, {}).update({"x": 0, "y": 0})
+        if coords not in node_coord:
+            node_coord[coords] = len(aquius["node"])
+            aquius["node"].append([coords[0], coords[1], {}])
+        node_lookup[stop_id] = node_coord[coords]
+        add_node_properties(aquius=aquius, config=config, row=row, header=header,
+                            node=aquius["node"][node_coord[coords]],
+                            reference_lookup=reference_lookup)
+
+    with source.rows("stops") as (header, rows):
+        stops = [row for row in rows if row[header["stop_id"]] != "" and (
+            row[header["stop_id"]] not in stop_exclude) and (
+            not stop_include or row[header["stop_id"]] in stop_include)]
+    if "location_type" in header and "parent_station" in header:
+        # Parent stations first, as gtfs.js, although children retain their own coordinates
+        for row in stops:
+            if row[header["location_type"]] == "1":
+                _add_stop(row=row, header=header)
+    for row in stops:
+        _add_stop(row=row, header=header)
+
+    return node_lookup
+
+
+def add_node_properties(aquius: dict, config: dict, row: List[str], header: Dict[str, int],
+                        node: list, reference_lookup: Dict[str, Dict[str, int]]):
+    """Adds name, URL and code references of stops.txt row to node"""
+
+    stop_id = row[header["stop_id"]]
+    override = config["stopOverride"].get(stop_id, {})
+    properties = {}
+
+    if config["allowName"]:
+        name = override.get("stop_name", row[header["stop_name"]] if "stop_name" in header else "")
+        if name != "":
+            properties["n"] = name
+
+    if config["allowStopUrl"]:
+        url = override.get("stop_url", row[header["stop_url"]] if "stop_url" in header else "")
+        if url != "":
+            codes = [row[header["stop_code"]]] if "stop_code" in header else []
+            url, code = url_with_wildcard(url=url, codes=codes + [stop_id])
+            if code is not None:
+                properties["i"] = code
+            properties["u"] = add_to_reference(
+                aquius=aquius, key="url", value=url, lookup=reference_lookup)
+
+    if properties:
+        add_node_reference(node=node, properties=properties)
+
+    if config["allowCode"]:
+        if config["codeAsStopId"]:
+            code = stop_id
+        else:
+            code = override.get("stop_code",
+                                row[header["stop_code"]] if "stop_code" in header else "")
+        if code != "":
+            add_node_reference(node=node, properties={"n": code})
+
+
+def service_calendar(source: GtfsSource, dates: List[date]) -> Dict[str, set]:
+    """Returns service_id: set of dates (within dates) served"""
+
+    calendar: Dict[str, set] = {}
+    date_set = set(dates)
+
+    header, rows = source.table("calendar")
+    if "service_id" in header:
+        for row in rows:
+            start = gtfs_date(row[header["start_date"]]) if "start_date" in header else None
+            end = gtfs_date(row[header["end_date"]]) if "end_date" in header else None
+            start = start or date(1970, 1, 1)
+            end = end or date(1970, 1, 1)
+            for the_date in dates:
+                day = DAYS[the_date.weekday()]
+                if start <= the_date <= end and day in header and row[header[day]] == "1":
+                    calendar.setdefault(row[header["service_id"]], set()).add(the_date)
+
+    header, rows = source.table("calendar_dates")
+    if all(column in header for column in ["service_id", "date", "exception_type"]):
+        for row in rows:
+            the_date = gtfs_date(row[header["date"]])
+            if the_date not in date_set:
+                continue
+            service_id = row[header["service_id"]]
+            served = calendar.setdefault(service_id, set())
+            if row[header["exception_type"]] == "1":
+                served.add(the_date)
+            elif row[header["exception_type"]] == "2" and the_date in served:
+                served.discard(the_date)
+                if not served:
+                    del calendar[service_id]
+
+    return calendar
+
+
+def build_route(aquius: dict, config: dict, source: GtfsSource, product_index: Dict[str, int],
+                route_ids: set, reference_lookup: Dict[str, Dict[str, int]]) -> Dict[str, tuple]:
+    """Returns route_id: (product, reference dict or None) for route_ids, as gtfs.js createRoutes"""
+
+    routes: Dict[str, tuple] = {}
+    network_type = config["networkFilter"]["type"]
+    header, rows = source.table("routes")
+
+    for route in rows:
+        route_id = route[header["route_id"]]
+        if route_id not in route_ids:
+            continue
+        mode = route[header["route_type"]] if "route_type" in header else None
+        if config["modeInclude"] and mode not in config["modeInclude"]:
+            continue
+
+        agency_id = route[header["agency_id"]] if "agency_id" in header else None
+        if network_type == "agency" and agency_id in config["productOverride"]:
+            product_override = config["productOverride"][agency_id]
+        elif network_type == "mode" and mode in config["productOverride"]:
+            product_override = config["productOverride"][mode]
+        else:
+            product_override = {}
+        route_override = config["routeOverride"].get(route_id, {})
+        reference = {"slug": ""}  # Slug is a temporary unique reference
+
+        name = ""
+        if config["allowRoute"]:
+            name = route_override.get("route_short_name", route[header["route_short_name"]]
+                                      if "route_short_name" in header else "")
+        if config["allowRouteLong"]:
+            long_name = route_override.get("route_long_name", route[header["route_long_name"]]
+                                           if "route_long_name" in header else "")
+            name = f"{name}: {long_name}" if name != "" else long_name
+        if name != "":
+            reference["n"] = name
+            reference["slug"] += name
+
+        if config["allowColor"]:
+            for (column, key) in [("route_color", "c"), ("route_text_color", "t")]:
+                color = route_override.get(column, product_override.get(
+                    column, route[header[column]] if column in header else ""))
+                if len(color) != 6:
+                    continue
+                color = f"#{color}"
+                add_to_reference(aquius=aquius, key="color", value=color, lookup=reference_lookup)
+                if key == "t" and reference.get("c") == reference_lookup["color"][color]:
+                    color = "#000000" if color.lower() == "#ffffff" else "#ffffff"
+                reference[key] = add_to_reference(
+                    aquius=aquius, key="color", value=color, lookup=reference_lookup)
+                reference["slug"] += color
+
+        if config["allowRouteUrl"]:
+            url = route_override.get("route_url", route[header["route_url"]]
+                                     if "route_url" in header else "")
+            if url != "":
+                code = None
+                if "n" in reference:
+                    url, code = url_with_wildcard(url=url, codes=[reference["n"]])
+                if code is None:
+                    url, code = url_with_wildcard(url=url, codes=[route_id])
+                    if code is not None:
+                        reference["i"] = route_id
+                reference["u"] = add_to_reference(
+                    aquius=aquius, key="url", value=url, lookup=reference_lookup)
+                reference["slug"] += url
+
+        if network_type == "agency":
+            product = product_index.get(agency_id, 0) if agency_id is not None else 0
+        else:
+            product = product_index.get(mode, 0)
+        routes[route_id] = (product, reference if len(reference) > 1 else None)
+
+    return routes
+
+
+class Periods:
+    """Service periods (serviceFilter) applied to trip calendars and times"""
+
+    def __init__(self, periods: List[dict], dates: List[date], service_per: Union[int, float]):
+        self.day_factor: List[List[date]] = []  # Dates analysed by period
+        self.time_factor: List[List[list]] = []  # [start, optional end] by period
+        self.service_per = service_per
+        for period in periods:
+            if "day" in period:
+                self.day_factor.append([the_date for day in period["day"]
+                                        for the_date in dates if DAYS[the_date.weekday()] == day])
+            else:
+                self.day_factor.append(dates)
+            if "time" in period:
+                times = []
+                for time in period["time"]:
+                    times.append([gtfs_seconds(time.get("start", "00:00:00"))])
+                    if "end" in time:
+                        times[-1].append(gtfs_seconds(time["end"]))
+                self.time_factor.append(times)
+            else:
+                self.time_factor.append([[0]])
+        self.calendar_cache: Dict[int, List[float]] = {}
+
+    def is_all_day(self, position: int) -> bool:
+        """True if period position has no time criteria"""
+
+        return self.time_factor[position] == [[0]]
+
+    def calendar_service(self, calendar_id: int, calendar: set) -> List[float]:
+        """Service by period for a calendar (shared by all trips using that service_id)"""
+
+        if calendar_id not in self.calendar_cache:
+            service = []
+            for dates in self.day_factor:
+                if dates:
+                    served = sum(1 for the_date in dates if the_date in calendar)
+                    service.append((served / len(dates)) * self.service_per)
+                else:
+                    service.append(0)
+            self.calendar_cache[calendar_id] = service
+        return self.calendar_cache[calendar_id]
+
+    def trip_service(self, service: List[float], start: Optional[int],
+                     end: Optional[int]) -> Tuple[List[float], List[bool]]:
+        """Returns service and in-period flags of a timetabled trip, by its mid-journey time"""
+
+        service = service.copy()
+        in_periods = []
+        time = None
+        if start is not None and end is not None:
+            time = ((end - start) / 2) + start
+        for position, times in enumerate(self.time_factor):
+            in_period = False
+            if service[position] != 0:
+                if self.is_all_day(position):
+                    in_period = True
+                elif time is not None:
+                    in_period = any(time > band[0] and (len(band) == 1 or time < band[1])
+                                    for band in times)
+                if not in_period:
+                    service[position] = 0
+            in_periods.append(in_period)
+        return service, in_periods
+
+    def frequency_service(self, service: List[float], frequencies: List[tuple]) -> List[float]:
+        """Returns service of a frequencies.txt trip, given (start, end, headway) rows"""
+
+        factor = [0.] * len(service)
+        for (start, end, headway) in frequencies:
+            if end < start:
+                end += 86400  # Spans midnight
+            if headway <= 0 or end == start:
+                continue
+            for position, times in enumerate(self.time_factor):
+                if service[position] == 0:
+                    continue
+                if self.is_all_day(position):
+                    factor[position] += (end - start) / headway
+                    continue
+                for band in times:
+                    if band[0] < end and (len(band) == 1 or start < band[1]):
+                        proportion = 1
+                        if band[0] > start:
+                            proportion -= (band[0] - start) / (end - start)
+                        if len(band) > 1 and band[1] < end:
+                            proportion -= (end - band[1]) / (end - start)
+                        factor[position] += (end - start) * proportion / headway
+        return [value * factor[position] for position, value in enumerate(service)]
+
+
+class LinkBuilder:
+    """Merges trips into links as they are streamed"""
+
+    def __init__(self, aquius: dict, config: dict):
+        self.aquius = aquius
+        self.config = config
+        self.link: Dict[tuple, dict] = {}  # Link key: link content
+        self.circular = set(config["isCircular"])
+
+    def is_circular(self, route_id: str, nodes: List[int]) -> bool:
+        """Circular logic as gtfs.js (excluding blocks)"""
+
+        if self.config["isCircular"]:
+            return route_id in self.circular
+        if len(nodes) < 5 or nodes[0] != nodes[-1]:
+            return False
+        node_a = self.aquius["node"][nodes[1]]
+        node_b = self.aquius["node"][nodes[-2]]
+        return haversine_metres(node_a[1], node_a[0], node_b[1], node_b[0]) > 200
+
+    @staticmethod
+    def merge_duration(minutes_a: List[float], minutes_b: List[float]) -> List[float]:
+        """Crude average of durations, ignoring zeros, as gtfs.js mergeDuration"""
+
+        duration = []
+        for position, value in enumerate(minutes_a):
+            if position >= len(minutes_b):
+                break
+            if minutes_b[position] == 0:
+                duration.append(value)
+            elif value == 0:
+                duration.append(minutes_b[position])
+            else:
+                duration.append(js_round((value + minutes_b[position]) / 2))
+        return duration
+
+    def add(self, route_id: str, product: int, references: List[dict], nodes: List[int],
+            dwells: List[float], service: List[float], minutes: Optional[List[float]],
+            setdown: List[int], pickup: List[int], order: int):
+        """Merge one trip into its forward, else mirrored, link. Order is trips.txt position"""
+
+        node_count: Dict[int, int] = {}
+        for node in nodes:
+            node_count[node] = node_count.get(node, 0) + 1
+        setdown = sorted(setdown, key=str)  # Sorted as gtfs.js (string sort)
+        pickup = sorted(pickup, key=str)
+        forward = (tuple(nodes), product, tuple(setdown), tuple(pickup))
+        backward = (tuple(reversed(nodes)), product, tuple(pickup), tuple(setdown))
+
+        if forward in self.link:
+            target = self.link[forward]
+        elif self.config["mirrorLink"] and backward in self.link:
+            target = self.link[backward]
+            target.pop("direction", None)
+        else:
+            target = None
+
+        if target is not None:
+            target["order"] = min(target["order"], order)
+            target["service"] = [value + service[position]
+                                 for position, value in enumerate(target["service"])
+                                 if position < len(service)]
+            if "minutes" in target and minutes is not None:
+                target["minutes"] = self.merge_duration(target["minutes"], minutes)
+            if self.config["allowDwell"]:
+                target["dwells"] = self.merge_duration(target["dwells"], dwells)
+        else:
+            target = {
+                "direction": 1,
+                "order": order,
+                "product": product,
+                "route": nodes,
+                "service": service,
+                "dwells": dwells,
+                "reference": [],
+                "referenceLookup": set(),
+            }
+            if minutes is not None:
+                target["minutes"] = minutes
+            for (key, values) in [("setdown", setdown), ("pickup", pickup)]:
+                unique = [node for node in values if node_count.get(node) == 1]
+                if unique:
+                    target[key] = unique
+            if self.is_circular(route_id=route_id, nodes=nodes):
+                target["circular"] = 1
+            self.link[forward] = target
+
+        for reference in references:
+            if reference["slug"] not in target["referenceLookup"]:
+                target["reference"].append(reference)
+                target["referenceLookup"].add(reference["slug"])
+
+    def build(self):
+        """Writes aquius link, in descending order of service"""
+
+        links = []
+        for content in self.link.values():
+            line = [[content["product"]], [round_service(value) for value in content["service"]],
+                    content["route"], {}]
+            if not self.config["allowWaypoint"] and "pickup" in content and "setdown" in content:
+                for node in reversed(content["pickup"].copy()):
+                    if node in content["setdown"]:
+                        line[2] = [route_node for route_node in line[2] if route_node != node]
+                        content["pickup"].remove(node)
+                        content["setdown"].remove(node)
+                for key in ["pickup", "setdown"]:
+                    if not content[key]:
+                        del content[key]
+            if content["reference"]:
+                line[3]["r"] = [{key: value for key, value in reference.items() if key != "slug"}
+                                for reference in content["reference"]]
+            for (key, short) in [("circular", "c"), ("direction", "d"), ("pickup", "u"),
+                                 ("setdown", "s"), ("minutes", "m")]:
+                if key in content:
+                    line[3][short] = content[key]
+            if self.config["allowDwell"]:
+                line[3]["w"] = content["dwells"]
+            links.append((-sum(line[1]), content["order"], line))
+        # Equal service ordered by trips.txt (as gtfs.js), not the order stop_times.txt was read
+        links.sort(key=lambda link: link[:2])
+        self.aquius["link"] = [link[2] for link in links]
+
+
+def round_service(value: float) -> Union[int, float]:
+    """Service to 1 significant figure below 10, else truncated integer (as gtfs.js)"""
+
+    if value < 10:
+        value = float(f"{value:.1g}")
+    else:
+        value = int(value)
+    if value == int(value):
+        return int(value)
+    return value
+
+
+def load_trip(config: dict, source: GtfsSource, calendar: Dict[str, set],
+              route_ids: List[str]) -> Dict[str, tuple]:
+    """
+    Returns trip_id: (route index, calendar index, headsign reference or None, order),
+    for trips with service in the period analysed, compactly encoded
+    route_ids is extended with each route_id used, indexed by route index
+    """
+
+    route_exclude = set(config["routeExclude"])
+    route_include = set(config["routeInclude"])
+    route_index: Dict[str, int] = {}
+    calendar_index = {service_id: position for position, service_id in enumerate(calendar)}
+    headsign_cache: Dict[str, dict] = {}
+    trip: Dict[str, tuple] = {}
+
+    with source.rows("trips") as (header, rows):
+        for order, row in enumerate(rows):
+            route_id = row[header["route_id"]]
+            service_id = row[header["service_id"]]
+            if (service_id not in calendar or route_id in route_exclude or
+                    (route_include and route_id not in route_include)):
+                continue
+            if route_id not in route_index:
+                route_index[route_id] = len(route_ids)
+                route_ids.append(route_id)
+            headsign = None
+            if config["allowHeadsign"] and "trip_headsign" in header:
+                name = row[header["trip_headsign"]]
+                if name == "" and "trip_short_name" in header:
+                    name = row[header["trip_short_name"]]
+                if name != "":
+                    headsign = headsign_cache.setdefault(name, {"n": name, "slug": name})
+            trip[row[header["trip_id"]]] = (
+                route_index[route_id], calendar_index[service_id], headsign, order)
+
+    return trip
+
+
+def load_frequencies(source: GtfsSource, trip: Dict[str, tuple]) -> Dict[str, List[tuple]]:
+    """Returns trip_id: list of (start, end, headway) seconds"""
+
+    frequencies: Dict[str, List[tuple]] = {}
+    header, rows = source.table("frequencies")
+    if all(column in header for column in ["trip_id", "start_time", "end_time", "headway_secs"]):
+        for row in rows:
+            if row[header["trip_id"]] not in trip:
+                continue
+            try:
+                headway = int(row[header["headway_secs"]])
+            except ValueError:
+                continue
+            frequencies.setdefault(row[header["trip_id"]], []).append((
+                gtfs_seconds(row[header["start_time"]]), gtfs_seconds(row[header["end_time"]]),
+                headway))
+    return frequencies
+
+
+def stream_trip(reader: Iterator[List[str]], check_sorted: bool) -> Iterator[tuple]:
+    """
+    Yields header (column: position) then (trip_id, rows) for each trip in stop_times.txt
+    If check_sorted, raises UnsortedError if a trip_id recurs after a different trip_id
+    """
+
+    header_row = next(reader, None)
+    if header_row is None:
+        return
+    header = {column.strip(): position for position, column in enumerate(header_row)}
+    for required in ["trip_id", "stop_id", "stop_sequence"]:
+        if required not in header:
+            raise IOError(f"Missing value {required} in GTFS stop_times.txt")
+    yield header
+
+    trip_col = header["trip_id"]
+    finished = set()  # Hashes of trip_id passed, collisions merely cause an unnecessary sort
+    trip_id = None
+    rows: List[List[str]] = []
+    for row in reader:
+        if len(row) != len(header_row):
+            continue
+        row = [value.strip() for value in row]
+        if row[trip_col] != trip_id:
+            if trip_id is not None:
+                yield trip_id, rows
+            if check_sorted:
+                if hash(row[trip_col]) in finished:
+                    raise UnsortedError(f"stop_times.txt trip_id {row[trip_col]} recurs")
+                finished.add(hash(trip_id))
+            trip_id = row[trip_col]
+            rows = []
+        rows.append(row)
+    if trip_id is not None:
+        yield trip_id, rows
+
+
+def build_link(aquius: dict, config: dict, trips: Iterator[tuple], trip: Dict[str, tuple],
+               route_ids: List[str], routes: Dict[str, tuple], calendar: List[set],
+               periods: Periods, frequencies: Dict[str, List[tuple]],
+               node_lookup: Dict[str, int]):
+    """Processes each trip of trips (as stream_trip) into aquius link"""
+
+    links = LinkBuilder(aquius=aquius, config=config)
+    header = next(trips, None)
+    if header is None:
+        aquius["link"] = []
+        return
+    stop_col = header["stop_id"]
+    sequence_col = header["stop_sequence"]
+    arrive_col = header.get("arrival_time")
+    depart_col = header.get("departure_time")
+    pickup_col = header.get("pickup_type")
+    drop_off_col = header.get("drop_off_type")
+    time_cache: Dict[str, int] = {}
+
+    def _seconds(value: str) -> int:
+        if value not in time_cache:
+            time_cache[value] = gtfs_seconds(value)
+        return time_cache[value]
+
+    for trip_id, rows in trips:
+        if trip_id not in trip:
+            continue
+        route_index, calendar_index, headsign, order = trip[trip_id]
+        route_id = route_ids[route_index]
+        if route_id not in routes:
+            continue
+        if not calendar[calendar_index]:
+            continue
+
+        stops = []  # [sequence, node, dwell]
+        on_off: Dict[int, set] = {}  # Node: flags both, setdown, pickup, route
+        start = None
+        end = None
+        for row in rows:
+            node = node_lookup.get(row[stop_col])
+            if node is None:
+                continue
+            no_pickup = pickup_col is not None and row[pickup_col] == "1"
+            no_drop_off = drop_off_col is not None and row[drop_off_col] == "1"
+            if no_pickup and no_drop_off:
+                on_off.setdefault(node, set()).add("route")
+            elif no_pickup:
+                on_off.setdefault(node, set()).add("setdown")
+            elif no_drop_off:
+                on_off.setdefault(node, set()).add("pickup")
+            else:
+                on_off.setdefault(node, set()).add("both")
+
+            if stops and stops[-1][1] == node:
+                continue  # Concurrent stops at the same node
+            arrive = 0
+            depart = 0
+            if depart_col is not None and row[depart_col] != "":
+                depart = _seconds(row[depart_col])
+                start = depart if start is None else min(start, depart)
+            if arrive_col is not None and row[arrive_col] != "":
+                arrive = _seconds(row[arrive_col])
+                end = arrive if end is None else max(end, arrive)
+            dwell = (depart - arrive) / 60 if (
+                config["allowDwell"] and arrive != 0 and depart > arrive) else 0
+            try:
+                sequence = float(row[sequence_col])
+            except ValueError:
+                sequence = 0
+            stops.append([sequence, node, dwell])
+
+        if len(stops) < 2:
+            continue
+
+        setdown = []
+        pickup = []
+        for node, flags in on_off.items():
+            if "both" in flags:
+                continue
+            if "setdown" in flags and "pickup" not in flags:
+                setdown.append(node)
+            elif "pickup" in flags and "setdown" not in flags:
+                pickup.append(node)
+            elif "route" in flags:
+                setdown.append(node)
+                pickup.append(node)
+        if pickup_col is None:
+            setdown = []
+        if drop_off_col is None:
+            pickup = []
+
+        service = periods.calendar_service(calendar_id=calendar_index,
+                                           calendar=calendar[calendar_index])
+        minutes = None
+        if trip_id in frequencies:
+            service = periods.frequency_service(service=service, frequencies=frequencies[trip_id])
+            if config["allowDuration"]:
+                minutes = [0] * len(service)
+        else:
+            service, in_periods = periods.trip_service(service=service, start=start, end=end)
+            if config["allowDuration"]:
+                minutes = []
+                for in_period in in_periods:
+                    if in_period and start is not None and end is not None:
+                        duration = end - start if end >= start else (end + 86400) - start
+                        minutes.append(js_round(duration / 60))
+                    else:
+                        minutes.append(0)
+
+        stops.sort(key=lambda stop: stop[0])
+        product, route_reference = routes[route_id]
+        references = [reference for reference in [route_reference, headsign]
+                      if reference is not None]
+        links.add(route_id=route_id, product=product, references=references,
+                  nodes=[stop[1] for stop in stops], dwells=[stop[2] for stop in stops],
+                  service=service, minutes=minutes, setdown=setdown, pickup=pickup, order=order)
+
+    links.build()
+
+
+def optimise_node(aquius: dict) -> dict:
+    """Assigns most referenced nodes to lowest indices and removes unused nodes"""
+
+    occurrence: Dict[int, int] = {}
+    for link in aquius["link"]:
+        for node in link[2] + link[3].get("u", []) + link[3].get("s", []) + link[3].get("t", []):
+            occurrence[node] = occurrence.get(node, 0) + 1
+
+    # Ascending count then reversed, matching gtfs.js tie order
+    order = sorted(sorted(occurrence.keys()), key=lambda node: occurrence[node])
+    order.reverse()
+    lookup = {old: new for new, old in enumerate(order)}
+    aquius["node"] = [aquius["node"][old] for old in order]
+
+    for link in aquius["link"]:
+        link[2] = [lookup[node] for node in link[2]]
+        for key in ["u", "s", "t"]:
+            if key in link[3]:
+                link[3][key] = [lookup[node] for node in link[3][key]]
+
+    return aquius
+
+
+def convert(source: GtfsSource, config: dict, memory: int = 512) -> Tuple[dict, dict]:
+    """Returns aquius and config (with defaults) for GTFS source"""
+
+    for required in ["routes", "stops", "trips", "stop_times"]:
+        if not source.has(required):
+            raise IOError(f"Missing GTFS {required}.txt")
+
+    config = default_dates(config=parse_config(config), source=source)
+    aquius: dict = {}
+    reference_lookup: Dict[str, Dict[str, int]] = {}  # Reference key: value: index
+    aquius = build_header(aquius=aquius, config=config, source=source)
+    product_index = build_network(aquius=aquius, config=config, source=source)
+    periods_config = build_service(aquius=aquius, config=config)
+    node_lookup = build_node(aquius=aquius, config=config, source=source,
+                             reference_lookup=reference_lookup)
+    aquius["place"] = []
+
+    from_date = gtfs_date(config["fromDate"])
+    to_date = gtfs_date(config["toDate"])
+    dates = [from_date + timedelta(days=day) for day in range((to_date - from_date).days + 1)]
+    calendar = service_calendar(source=source, dates=dates)
+    periods = Periods(periods=periods_config, dates=dates, service_per=config["servicePer"])
+    route_ids: List[str] = []
+    trip = load_trip(config=config, source=source, calendar=calendar, route_ids=route_ids)
+    frequencies = load_frequencies(source=source, trip=trip)
+    routes = build_route(aquius=aquius, config=config, source=source,
+                         product_index=product_index, route_ids=set(route_ids),
+                         reference_lookup=reference_lookup)
+    calendar_list = list(calendar.values())
+    logging.info("Loaded %s nodes, %s routes and %s trips", len(aquius["node"]), len(routes),
+                 len(trip))
+
+    try:
+        with source.raw_rows("stop_times") as reader:
+            build_link(aquius=aquius, config=config, trips=stream_trip(reader, True), trip=trip,
+                       route_ids=route_ids, routes=routes, calendar=calendar_list,
+                       periods=periods, frequencies=frequencies, node_lookup=node_lookup)
+    except UnsortedError as err:
+        logging.warning("%s, restarting with external sort", err)
+        with source.raw_rows("stop_times") as reader:
+            build_link(aquius=aquius, config=config,
+                       trips=stream_trip(sort_stop_times(reader, memory=memory), False),
+                       trip=trip, route_ids=route_ids, routes=routes, calendar=calendar_list,
+                       periods=periods, frequencies=frequencies, node_lookup=node_lookup)
+
+    aquius = optimise_node(aquius=aquius)
+    return aquius, config
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    if args is None:
+        args = get_args()
+    config_path = getattr(args, "config", None)
+    if config_path is None and Path(args.input).is_dir() and Path(
+            args.input, "config.json").is_file():
+        config_path = Path(args.input, "config.json")
+    config = load_json(filepath=config_path) if config_path is not None else {}
+
+    source = GtfsSource(path=args.input)
+    try:
+        aquius, config = convert(source=source, config=config, memory=getattr(args, "memory", 512))
+    finally:
+        source.close()
+
+    save_json(data=aquius, filepath=args.output)
+    if getattr(args, "config_auto", None) is not None:
+        save_json(data=config, filepath=args.config_auto)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,516 @@
+"""
+Python script that merges Aquius files into one, following Merge Aquius (dist/merge.js)
+and accepting the same config.json (coordinatePrecision, meta, option, translation).
+Nodes and places are grouped by coordinates quantized to integers at coordinatePrecision,
+products by name. Input files are processed one at a time, in order of filename,
+each folded into the merged hash tables before the next is read, so memory depends on
+the unique nodes and links merged, not the total size of the input files.
+
+Typically follows gtfs_chunker.py and gtfs_to_aquius.py: Input may be directories,
+from which any Aquius .json files are read (chunk manifests and configs are skipped).
+
+Usage: merge_aquius.py chunk_directory --output aquius.json
+See merge_aquius.py -h for further arguments
+"""
+
+import argparse
+import json
+import logging
+from math import floor
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from _common import load_json, save_json
+from gtfs_to_aquius import optimise_node
+
+
+DEFAULT_CONFIG = {
+    "coordinatePrecision": 5,
+    "meta": {},
+    "option": {},
+    "translation": {},
+}
+LINK_KEY_VALUES = ["b", "block", "d", "direction"]
+LINK_KEY_ARRAYS = ["h", "shared", "pickup", "s", "setdown", "split", "t", "u", "duration", "m",
+                   "dwell", "w"]
+
+
+def get_args() -> argparse.Namespace:
+    """Get command line arguments or apply defaults"""
+
+    class ArgparseFormatter(
+        argparse.ArgumentDefaultsHelpFormatter,
+        argparse.RawTextHelpFormatter
+    ):
+        """Formatter supports both defaults and help"""
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=ArgparseFormatter)
+    parser.add_argument(
+        "input",
+        nargs="+",
+        type=Path,
+        help="Aquius .json filenames, or directories containing them",
+    )
+    parser.add_argument(
+        "--config",
+        dest="config",
+        type=Path,
+        default=None,
+        help="Merge Aquius config.json",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=Path,
+        default=Path("aquius.json"),
+        help="Output Aquius .json filename with path",
+    )
+    return parser.parse_args()
+
+
+def find_aquius(paths: Iterable[Path]) -> List[Path]:
+    """Returns Aquius filenames in paths (or directories therein), in order of filename"""
+
+    found = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            found += [child for child in path.glob("*.json") if child.name.lower() not in [
+                "config.json"] and not child.stem.endswith("_manifest")]
+        else:
+            found.append(path)
+    return sorted(found, key=lambda path: path.name)
+
+
+def load_aquius(paths: Iterable[Path]) -> Iterator[dict]:
+    """Yields each Aquius file in paths in turn, skipping any that are not Aquius"""
+
+    for path in paths:
+        data = load_json(filepath=path)
+        # As merge.js, only schema, link and node are required
+        if (isinstance(data, dict) and isinstance(data.get("meta"), dict) and
+                "schema" in data["meta"] and "link" in data and "node" in data):
+            yield data
+        else:
+            logging.warning("Skipped %s, not an Aquius file", path)
+
+
+def is_js_equal(value_a, value_b) -> bool:
+    """JavaScript ===, under which objects are only equal to themselves"""
+
+    if isinstance(value_a, (dict, list)) or isinstance(value_b, (dict, list)):
+        return value_a is value_b
+    return value_a == value_b
+
+
+def merge_property(original: dict, addition: dict, append_string: bool = False) -> dict:
+    """Adds missing keys of addition to original, optionally joining differing strings with |"""
+
+    for key, value in addition.items():
+        if key in original:
+            if (append_string and original[key] != value and isinstance(original[key], str) and
+                    isinstance(value, str)):
+                original[key] += " | " + value
+        else:
+            original[key] = value
+    return original
+
+
+def within_keys(properties: dict, references: List[dict]) -> bool:
+    """True if all properties are contained within any of references"""
+
+    return any(all(key in reference and is_js_equal(reference[key], value)
+                   for key, value in properties.items()) for reference in references)
+
+
+def link_key(product: list, node: list, prop: dict) -> tuple:
+    """Returns hashable key of link, exact matches (including product and direction) merge"""
+
+    key = [tuple(product), tuple(node)]
+    for position, name in enumerate(LINK_KEY_VALUES):
+        if name in prop:
+            key.append((position, prop[name]))
+    for position, name in enumerate(LINK_KEY_ARRAYS):
+        if name in prop:
+            value = prop[name]  # Shared is schema integer, but merge.js arrays also accepted
+            key.append((position + len(LINK_KEY_VALUES),
+                        tuple(value) if isinstance(value, list) else value))
+    return tuple(key)
+
+
+def merge_link(target: list, service: list, prop: dict):
+    """Adds service and references (prop) of a link matching link_key() into target link"""
+
+    for position, value in enumerate(target[1]):
+        if position < len(service) and service[position] > 0:
+            target[1][position] = value + service[position]
+    for name in ["r", "reference"]:
+        if name not in prop:
+            continue
+        if "r" in target[3] or "reference" in target[3]:
+            existing = target[3].setdefault(name, [])
+            for reference in prop[name]:
+                # Reference matching any existing reference value is not added (as merge.js)
+                if not any(key in match and is_js_equal(reference[key], match[key])
+                           for match in existing for key in reference):
+                    existing.append(reference)
+        else:
+            target[3][name] = prop[name]
+
+
+class AquiusMerge:
+    """Merged Aquius, built one input at a time"""
+
+    def __init__(self, config: dict):
+        self.config = {key: config[key] if key in config and isinstance(
+            config[key], type(default)) else json.loads(json.dumps(default))
+            for key, default in DEFAULT_CONFIG.items()}
+        self.precision = 10 ** self.config["coordinatePrecision"]
+
+        self.aquius: dict = {"meta": self.config["meta"]}
+        self.aquius["meta"]["schema"] = "0"
+        if self.config["option"]:
+            self.aquius["option"] = self.config["option"]
+        if self.config["translation"]:
+            self.aquius["translation"] = self.config["translation"]
+
+        self.block_next = 0
+        self.link_lookup: Dict[tuple, int] = {}  # Link key: aquius.link index
+        self.node_lookup: Dict[Tuple[int, int], int] = {}  # Quantized x, y: aquius.node index
+        self.place_lookup: Dict[Tuple[int, int], int] = {}  # Quantized x, y: aquius.place index
+        self.reference_lookup: Dict[str, Dict[str, int]] = {}  # Type: value: index
+        self.service_lookup: Dict[tuple, int] = {}  # Service indices: aquius.service index
+        self.network: List[Tuple[list, Dict[int, int]]] = []  # Per input network, product switch
+
+        # Per input, old index: new index
+        self.block_switch: Dict[int, int] = {}
+        self.node_switch: Dict[int, Optional[int]] = {}
+        self.place_switch: Dict[int, int] = {}
+        self.product_switch: Dict[int, int] = {}
+        self.reference_switch: Dict[str, Dict[int, int]] = {}
+
+    def quantize(self, value: float) -> int:
+        """Coordinate as integer at coordinatePrecision"""
+
+        return int(floor(float(value) * self.precision + 0.5))
+
+    def add(self, data: dict):
+        """Merge one Aquius into the output"""
+
+        self.block_switch = {}
+        self.node_switch = {}
+        self.place_switch = {}
+        self.product_switch = {}
+        self.reference_switch = {"color": {}, "url": {}}
+
+        self.build_meta(data=data)
+        self.build_service(data=data)
+        self.build_link(data=data)
+
+        self.network.append((data.get("network", []), self.product_switch))
+
+    def build_meta(self, data: dict):
+        """Adds first found meta, option and translation"""
+
+        meta = data.get("meta", {})
+        if isinstance(meta, dict):
+            for key in ["attribution", "description", "name", "url"]:
+                if key in meta and key not in self.aquius["meta"]:
+                    self.aquius["meta"][key] = meta[key]
+
+        option = data.get("option", {})
+        if isinstance(option, dict) and option:
+            self.aquius.setdefault("option", {})
+            for key, value in option.items():
+                if key not in self.aquius["option"]:
+                    self.aquius["option"][key] = value
+
+        translation = data.get("translation", {})
+        if isinstance(translation, dict) and translation:
+            self.aquius.setdefault("translation", {})
+            for key, value in translation.items():
+                if key in self.aquius["translation"]:
+                    merge_property(self.aquius["translation"][key], value)
+                else:
+                    self.aquius["translation"][key] = value
+
+    def build_service(self, data: dict):
+        """Adds service, supposing service indices are consistent between inputs"""
+
+        service = data.get("service", [])
+        if not isinstance(service, list) or not service:
+            return
+        self.aquius.setdefault("service", [])
+        for definition in service:
+            if not (isinstance(definition, list) and len(definition) >= 2 and
+                    isinstance(definition[0], list) and isinstance(definition[1], dict)):
+                continue
+            key = tuple(definition[0])
+            if key in self.service_lookup:
+                target = self.aquius["service"][self.service_lookup[key]]
+                merge_property(target[1], definition[1], append_string=True)
+                if len(definition) > 2 and isinstance(definition[2], dict):
+                    if len(target) > 2:
+                        merge_property(target[2], definition[2])
+                    else:
+                        target.append(definition[2])
+            else:
+                self.service_lookup[key] = len(self.aquius["service"])
+                self.aquius["service"].append(definition)
+
+    def build_link(self, data: dict):
+        """Adds link, and with it product, node, place and reference"""
+
+        link = data.get("link", [])
+        if not isinstance(link, list) or not link:
+            return
+        self.aquius.setdefault("link", [])
+
+        for line in link:
+            if not (isinstance(line, list) and len(line) > 3 and isinstance(line[0], list) and
+                    isinstance(line[1], list) and isinstance(line[2], list) and
+                    isinstance(line[3], dict)):
+                continue
+
+            product = [self.parse_product(data=data, product=value) for value in line[0]]
+            node = []
+            for value in line[2]:
+                new_node = self.parse_node(data=data, node=value)
+                if new_node is not None and (not node or node[-1] != new_node):
+                    # Duplicates may emerge from coordinatePrecision changes
+                    node.append(new_node)
+            prop = self.parse_link_property(data=data, prop=line[3])
+
+            key = link_key(product=product, node=node, prop=prop)
+            if key not in self.link_lookup:
+                self.link_lookup[key] = len(self.aquius["link"])
+                self.aquius["link"].append([product, line[1], node, prop])
+                continue
+            merge_link(target=self.aquius["link"][self.link_lookup[key]], service=line[1],
+                       prop=prop)
+
+    def parse_product(self, data: dict, product: int) -> int:
+        """Returns new product index for original product, matching on all keys (name)"""
+
+        if product in self.product_switch:
+            return self.product_switch[product]
+        products = self.aquius.setdefault("reference", {}).setdefault("product", [])
+
+        reference = {}
+        original = data.get("reference", {}).get("product", []) if isinstance(
+            data.get("reference"), dict) else []
+        if isinstance(original, list) and isinstance(product, int) and 0 <= product < len(
+                original) and isinstance(original[product], dict):
+            reference = original[product]
+            for position, existing in enumerate(products):
+                if all(key in existing and is_js_equal(value, existing[key])
+                       for key, value in reference.items()):
+                    self.product_switch[product] = position
+                    return position
+
+        self.product_switch[product] = len(products)
+        products.append(reference)
+        return self.product_switch[product]
+
+    def parse_reference(self, data: dict, value: int, reference_type: str) -> Optional[int]:
+        """Returns new color or url reference index for original index, None if missing"""
+
+        switch = self.reference_switch[reference_type]
+        if value in switch:
+            return switch[value]
+        original = data.get("reference", {}).get(reference_type) if isinstance(
+            data.get("reference"), dict) else None
+        if not isinstance(original, list) or not isinstance(value, int) or not (
+                0 <= value < len(original)):
+            return None
+        lookup = self.reference_lookup.setdefault(reference_type, {})
+        references = self.aquius.setdefault("reference", {}).setdefault(reference_type, [])
+        content = original[value]
+        if content not in lookup:
+            lookup[content] = len(references)
+            references.append(content)
+        switch[value] = lookup[content]
+        return switch[value]
+
+    def parse_node(self, data: dict, node: int) -> Optional[int]:
+        """Returns new node index for original node, adding it and its properties if new"""
+
+        if node in self.node_switch:
+            return self.node_switch[node]
+        nodes = data.get("node")
+        if not (isinstance(nodes, list) and isinstance(node, int) and 0 <= node < len(nodes) and
+                isinstance(nodes[node], list) and len(nodes[node]) >= 3 and
+                isinstance(nodes[node][0], (int, float)) and
+                isinstance(nodes[node][1], (int, float)) and isinstance(nodes[node][2], dict)):
+            return None
+
+        key = (self.quantize(nodes[node][0]), self.quantize(nodes[node][1]))
+        if key not in self.node_lookup:
+            self.node_lookup[key] = len(self.aquius.setdefault("node", []))
+            self.aquius["node"].append([key[0] / self.precision, key[1] / self.precision, {}])
+        index = self.node_lookup[key]
+        self.node_switch[node] = index
+        target = self.aquius["node"][index][2]
+
+        for name, value in nodes[node][2].items():
+            if name in ["r", "reference"]:
+                if not isinstance(value, list) or not value:
+                    continue
+                existing = target.setdefault(name, [])
+                for reference in value:
+                    if isinstance(reference, dict) and "u" in reference:
+                        # Only URL reassigned, other references copied blindly
+                        url = self.parse_reference(data=data, value=reference["u"],
+                                                   reference_type="url")
+                        if url is not None:
+                            reference["u"] = url
+                    if not within_keys(reference, existing):
+                        existing.append(reference)
+            elif name in ["p", "place"]:
+                if name in target:
+                    continue  # Node can only be in one place
+                place = self.parse_place(data=data, place=value)
+                if place is not None:
+                    target[name] = place
+            elif name not in target:
+                # Unknown key, copied only if not already present
+                target[name] = value
+
+        return index
+
+    def parse_place(self, data: dict, place: int) -> Optional[int]:
+        """Returns new place index for original place, adding it if new"""
+
+        if place in self.place_switch:
+            return self.place_switch[place]
+        places = data.get("place")
+        if not (isinstance(places, list) and isinstance(place, int) and
+                0 <= place < len(places) and isinstance(places[place], list) and
+                len(places[place]) >= 3 and isinstance(places[place][0], (int, float)) and
+                isinstance(places[place][1], (int, float)) and isinstance(places[place][2], dict)):
+            return None
+
+        key = (self.quantize(places[place][0]), self.quantize(places[place][1]))
+        if key not in self.place_lookup:
+            self.place_lookup[key] = len(self.aquius.setdefault("place", []))
+            self.aquius["place"].append([key[0] / self.precision, key[1] / self.precision, {}])
+        index = self.place_lookup[key]
+        self.place_switch[place] = index
+        merge_property(self.aquius["place"][index][2], places[place][2])
+
+        return index
+
+    def parse_link_property(self, data: dict, prop: dict) -> dict:
+        """Returns link properties with block, product, node and reference indices switched"""
+
+        for name in ["b", "block"]:
+            if name in prop:
+                if prop[name] not in self.block_switch:
+                    self.block_switch[prop[name]] = self.block_next
+                    self.block_next += 1
+                prop[name] = self.block_switch[prop[name]]
+
+        for name in ["h", "shared"]:
+            if name in prop and isinstance(prop[name], list):
+                prop[name] = [self.parse_product(data=data, product=0 if value is None else value)
+                              for value in prop[name]]
+            elif name in prop and isinstance(prop[name], int):
+                prop[name] = self.parse_product(data=data, product=prop[name])
+
+        for name in ["pickup", "s", "setdown", "split", "t", "u"]:
+            if name in prop and isinstance(prop[name], list):
+                nodes = []
+                for value in prop[name]:
+                    new_node = self.parse_node(data=data, node=value)
+                    if new_node is not None and new_node not in nodes:
+                        # Duplicates may emerge from coordinatePrecision changes
+                        nodes.append(new_node)
+                if nodes:
+                    prop[name] = nodes
+                else:
+                    del prop[name]
+
+        for name in ["r", "reference"]:
+            if name in prop and isinstance(prop[name], list):
+                for reference in prop[name]:
+                    for key in ["c", "t", "u"]:
+                        if key in reference:
+                            value = self.parse_reference(
+                                data=data, value=reference[key],
+                                reference_type="url" if key == "u" else "color")
+                            if value is None:
+                                del reference[key]  # Missing in original
+                            else:
+                                reference[key] = value
+
+        return prop
+
+    def build_network(self):
+        """Adds network, grouping filters of the same name across inputs"""
+
+        def _matches(properties_a: dict, properties_b: dict) -> bool:
+            return all(key in properties_b and is_js_equal(value, properties_b[key])
+                       for key, value in properties_a.items())
+
+        for network, product_switch in self.network:
+            if not isinstance(network, list) or not network:
+                continue
+            self.aquius.setdefault("network", [])
+            for definition in network:
+                if not (isinstance(definition, list) and len(definition) > 2 and
+                        isinstance(definition[0], list) and isinstance(definition[1], dict) and
+                        isinstance(definition[2], dict)):
+                    continue
+                products = [product_switch[product] for product in definition[0]
+                            if product in product_switch]
+                for target in self.aquius["network"]:
+                    if _matches(target[1], definition[1]) and (
+                            len(target) < 3 or _matches(target[2], definition[2])):
+                        for product in products:
+                            if product not in target[0]:
+                                target[0].append(product)
+                        break
+                else:
+                    self.aquius["network"].append([products, definition[1], definition[2]])
+
+    def build(self) -> dict:
+        """Returns merged Aquius, after all inputs are added"""
+
+        self.build_network()
+        if "link" in self.aquius:
+            # Descending service count, since busiest most likely to be queried
+            self.aquius["link"].sort(key=lambda line: -sum(line[1]))
+            self.aquius = optimise_node(aquius=self.aquius)
+        return self.aquius
+
+
+def merge(inputs: Iterable[dict], config: Optional[dict] = None) -> dict:
+    """Returns merged Aquius from inputs (which is iterated once)"""
+
+    merged = AquiusMerge(config=config if isinstance(config, dict) else {})
+    for data in inputs:
+        merged.add(data=data)
+    return merged.build()
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    if args is None:
+        args = get_args()
+    config = load_json(filepath=args.config) if getattr(args, "config", None) is not None else {}
+
+    paths = find_aquius(paths=args.input)
+    if not paths:
+        logging.error("No Aquius files found in %s", args.input)
+        return
+    logging.info("Merging %s files", len(paths))
+
+    save_json(data=merge(inputs=load_aquius(paths=paths), config=config), filepath=args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,26 +19,65 @@ Coordinates precision must at least match GTFS To Aquius coordinatePrecision (5
 Argument --precision can be set, which reduces higher precisions,
 but obviously cannot reliably increase lower precision, not cluster nodes.
 Best to run all processing with the same coordinatePrecision.
+Coordinates are compared as integers of that precision (at most 7), every node sharing a row's
+coordinates assigned that place. Rows that miss by more can be matched to the nearest node
+without a place within --tolerance metres. Counts of matched and unmatched rows are reported.
+The place CSV is read in batches of --batch rows (with pyarrow if available), so memory use does
+not grow with CSV length. With --tolerance the CSV is read twice, once exact matches are known.
 
 Any prior places are retained, to avoid breaking prior references,
 however this could bloat the aquius file with excess place reference.
-Best to run this script on an aquius file with no existing place references.
+Best to run this script on an aquius file with no existing place references,
+else with --incremental: Existing places are reused where name or coordinates match,
+only nodes moved since the last incremental run (per a node fingerprint in meta) are assigned,
+and places no longer referenced are removed.
 """
 
 import argparse
+import csv
+import hashlib
+from itertools import islice
 import logging
 from pathlib import Path
+from typing import Iterator, NamedTuple
+
+import numpy as np
+from scipy.spatial import cKDTree
 
 from _common import (
+    EARTH_METRES,
+    changed_nodes,
+    clear_node_place,
+    collect_places,
     get_common_args,
+    get_max_population,
+    get_node_place,
     get_place_scale,
+    index_places,
     is_aquius,
-    load_csv,
     load_json,
+    match_place,
+    place_keys,
+    quantize,
     save_json,
-    to_precision
+    set_place_fingerprint,
+    to_precision,
+    unit_xyz,
+    use_arrow
 )
 
+BATCH_ROWS = 1000000  # Default place CSV rows processed at once
+ROW_BYTES = 64  # Approximate place CSV bytes per row, sizing pyarrow reads
+PLACE_COLUMNS = {'node_x': np.float64, 'node_y': np.float64, 'place_x': np.float64,
+                 'place_y': np.float64, 'place_name': str, 'place_population': np.int64}
+
+
+class NodeIndex(NamedTuple):
+    """Nodes sorted by quantized coordinates, nodes sharing coordinates adjacent"""
+    keys: np.ndarray  # quantize()
+    node_ids: np.ndarray  # Index in aquius['node']
+    xy: np.ndarray  # Coordinates
+
 
 def get_args() -> argparse.Namespace:
     """Get command line arguments or apply defaults"""
@@ -60,13 +99,217 @@ Coordinates must match GTFS To Aquius coordinatePrecision (5 by default).''',
         default=5,
         type=int,
     )
+    parser.add_argument(
+        '--tolerance',
+        dest='tolerance',
+        help='Metres within which rows matching no node exactly match the nearest unplaced node',
+        default=None,
+        type=float,
+    )
+    parser.add_argument(
+        '--batch',
+        dest='batch',
+        help='Place CSV rows processed at once, lower to reduce memory use',
+        default=BATCH_ROWS,
+        type=int,
+    )
+    parser.add_argument(
+        '--incremental',
+        dest='incremental',
+        help='Reuse existing places, assigning only nodes moved since the last incremental run',
+        action='store_true',
+    )
     return parser.parse_args()
 
 
-def main():
-    """Core script entrypoint"""
+def place_source(filepath: Path, precision: int) -> str:
+    """Returns hash of place CSV filepath and precision, as place fingerprint source"""
+
+    digest = hashlib.sha256()
+    with open(filepath, mode="rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(f"|{precision}".encode())
+    return digest.hexdigest()
+
+
+def get_node_index(aquius: dict, node_ids: list, precision: int) -> NodeIndex:
+    """Returns NodeIndex of node_ids, nodes without valid coordinates excluded"""
+
+    xy = np.full((len(node_ids), 2), np.nan, dtype=np.float64)
+    for position, index in enumerate(node_ids):
+        node = aquius['node'][index]
+        try:
+            xy[position] = [float(node[0]), float(node[1])]
+        except (IndexError, TypeError, ValueError):
+            logging.warning("Bad node %s: %s", index, node)
+    keys = quantize(x_values=xy[:, 0], y_values=xy[:, 1], precision=precision)
+    valid = np.flatnonzero(keys >= 0)
+    order = valid[np.argsort(keys[valid], kind='stable')]
+    return NodeIndex(keys=keys[order],
+                     node_ids=np.array(node_ids, dtype=np.int64).reshape(-1)[order],
+                     xy=xy[order])
+
+
+def read_batches(filepath: Path, batch_size: int) -> Iterator[tuple[dict, int]]:
+    """
+    Yields place CSV column: values, and row count, of batches of at most batch_size rows,
+    values as pyarrow string arrays if available, else lists. Columns missing from CSV omitted
+    """
+
+    with open(filepath, mode="r", newline="", encoding="utf-8-sig") as file:
+        reader = csv.DictReader(file)
+        present = [key for key in PLACE_COLUMNS if key in (reader.fieldnames or [])]
+        if not use_arrow():
+            while True:
+                rows = list(islice(reader, batch_size))
+                if not rows:
+                    return
+                yield {key: [row.get(key) for row in rows] for key in present}, len(rows)
+
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+    import pyarrow.csv as pa_csv  # pylint: disable=import-outside-toplevel
+
+    # Read as strings, so one bad value only invalidates its row, cast to type per batch
+    with pa_csv.open_csv(str(filepath), read_options=pa_csv.ReadOptions(
+            block_size=max(1 << 20, batch_size * ROW_BYTES)),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={key: pa.string() for key in present},
+                include_columns=present)) as arrow_reader:
+        for record_batch in arrow_reader:
+            for start in range(0, record_batch.num_rows, batch_size):
+                part = record_batch.slice(start, batch_size)
+                yield {key: part.column(key) for key in present}, part.num_rows
+
+
+def to_numbers(values, dtype: type) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns values (list, else pyarrow array) as dtype array, and whether each value is valid
+    (invalid as 0)
+    """
+
+    if not isinstance(values, list):
+        import pyarrow as pa  # pylint: disable=import-outside-toplevel
+        import pyarrow.compute as pc  # pylint: disable=import-outside-toplevel
+        try:
+            return (pc.cast(values, pa.from_numpy_dtype(dtype)).to_numpy(zero_copy_only=False),
+                    np.ones(len(values), dtype=bool))
+        except pa.ArrowInvalid:
+            values = values.to_pylist()  # Else value by value, as Python
+    try:
+        return np.array(values, dtype=dtype), np.ones(len(values), dtype=bool)
+    except (TypeError, ValueError, OverflowError):
+        pass  # Else value by value
+    parsed = np.zeros(len(values), dtype=dtype)
+    is_valid = np.ones(len(values), dtype=bool)
+    cast = int if np.issubdtype(dtype, np.integer) else float
+    for position, value in enumerate(values):
+        try:
+            parsed[position] = cast(value)
+        except (TypeError, ValueError, OverflowError):
+            is_valid[position] = False
+    return parsed, is_valid
+
+
+def parse_rows(columns: dict, row_count: int, first_row: int) -> dict:
+    """
+    Returns batch of read_batches() as typed column arrays, with "row_id" (position in CSV,
+    counting from first_row), invalid rows counted under "invalid" and excluded
+    """
+
+    rows = {}
+    is_valid = np.ones(row_count, dtype=bool)
+    for key, dtype in PLACE_COLUMNS.items():
+        if dtype is str:
+            continue
+        if key not in columns:
+            rows[key] = np.zeros(row_count, dtype=dtype)
+            continue
+        rows[key], is_column_valid = to_numbers(values=columns[key], dtype=dtype)
+        is_valid &= is_column_valid
+    row_ids = np.flatnonzero(is_valid)
+    rows = {key: values[row_ids] for key, values in rows.items()}
+    if 'place_name' not in columns:
+        rows['place_name'] = [''] * len(row_ids)
+    elif isinstance(columns['place_name'], list):
+        rows['place_name'] = [columns['place_name'][row_id] for row_id in row_ids.tolist()]
+    else:
+        rows['place_name'] = columns['place_name'].take(row_ids).to_pylist()
+    rows['row_id'] = row_ids + first_row
+    rows['invalid'] = row_count - len(row_ids)
+    return rows
+
+
+def place_row(rows: dict, position: int, precision: int) -> tuple:
+    """Returns row_id, place_x, place_y, place_name, place_population of rows at position"""
+
+    return (int(rows['row_id'][position]), to_precision(float(rows['place_x'][position]),
+                                                        precision),
+            to_precision(float(rows['place_y'][position]), precision),
+            rows['place_name'][position], int(rows['place_population'][position]))
+
+
+def match_exact(node_index: NodeIndex, rows: dict, precision: int) -> tuple[dict, np.ndarray]:
+    """
+    Returns node index: place_row() of the last row at its quantized coordinates, by one sorted
+    array join, and whether each row matched any node
+    """
+
+    keys = quantize(x_values=rows['node_x'], y_values=rows['node_y'], precision=precision)
+    start = np.searchsorted(node_index.keys, keys, side='left')
+    stop = np.searchsorted(node_index.keys, keys, side='right')
+    is_matched = stop > start
+    positions = np.flatnonzero(is_matched)
+    counts = (stop - start)[positions]
+    # Every node sharing the row's coordinates, rows ascending so the last row is kept
+    offsets = np.repeat(start[positions] - np.cumsum(counts) + counts, counts)
+    node_positions = np.arange(counts.sum(), dtype=np.int64) + offsets
+    repeated = np.repeat(positions, counts)
+    assigned = dict(zip(node_index.node_ids[node_positions].tolist(), repeated.tolist()))
+    return {node: place_row(rows=rows, position=position, precision=precision)
+            for node, position in assigned.items()}, is_matched
+
+
+def match_near(node_index: NodeIndex, tree: cKDTree, candidate: np.ndarray, rows: dict,
+               tolerance: float, is_candidate: np.ndarray, precision: int) -> dict:
+    """
+    Returns node index: (distance, place_row()) of the nearest rows matching no node exactly
+    within tolerance metres of a candidate node (position in node_index, as tree), assigning all
+    nodes sharing the nearest node's coordinates where is_candidate (by node index)
+    """
+
+    keys = quantize(x_values=rows['node_x'], y_values=rows['node_y'], precision=precision)
+    start = np.searchsorted(node_index.keys, keys, side='left')
+    stop = np.searchsorted(node_index.keys, keys, side='right')
+    row_xy = np.stack([rows['node_x'], rows['node_y']], axis=1)
+    positions = np.flatnonzero((stop == start) & np.isfinite(row_xy).all(axis=1))
+    if len(positions) == 0:
+        return {}
+    chord = 2 * np.sin(min(tolerance / EARTH_METRES, np.pi) / 2)
+    distance, nearest = tree.query(unit_xyz(row_xy[positions]), distance_upper_bound=chord)
+    is_near = np.isfinite(distance)
+    # Furthest first, so each node is assigned its nearest row
+    order = np.flatnonzero(is_near)[np.argsort(-distance[is_near], kind='stable')]
+    near: dict = {}
+    for position, row_distance, node_position in zip(
+            positions[order].tolist(), distance[order].tolist(),
+            candidate[nearest[order]].tolist()):
+        start = np.searchsorted(node_index.keys, node_index.keys[node_position], side='left')
+        stop = np.searchsorted(node_index.keys, node_index.keys[node_position], side='right')
+        for node in node_index.node_ids[start:stop].tolist():
+            if is_candidate[node]:
+                near[node] = (row_distance, place_row(rows=rows, position=position,
+                                                      precision=precision))
+    return near
+
 
-    arguments = get_args()
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    arguments = get_args() if args is None else args
     precision = getattr(arguments, 'precision')
     aquius = load_json(filepath=getattr(arguments, 'aquius'))
     if not is_aquius(aquius=aquius, skip_place=True):
@@ -75,66 +318,132 @@ def main():
     if "place" not in aquius:
         aquius["place"] = []
 
-    node_lookup: dict = {}
-    for index, node in enumerate(aquius['node']):
+    source = None
+    # Nodes to assign. All nodes are matched, so rows of unchanged nodes still match as before
+    is_target = np.ones(len(aquius['node']), dtype=bool)
+    place_index: dict = {}  # _common.place_keys: index in aquius['place'], if incremental
+    if getattr(arguments, 'incremental', False):
         try:
-            node_lookup[
-                f"{to_precision(node[0], precision)}:{to_precision(node[1], precision)}"
-            ] = index
-        except ValueError:
-            logging.warning("Bad node %s: %s", index, node)
-            continue
+            source = place_source(filepath=getattr(arguments, 'place'), precision=precision)
+        except IOError as err:
+            logging.error("Cannot load %s: %s", arguments.place, err)
+            return
+        is_target[:] = False
+        for index in changed_nodes(aquius=aquius, source=source):
+            is_target[index] = True
+            clear_node_place(node=aquius['node'][index])
+        place_index = index_places(places=aquius['place'])
 
-    places = load_csv(filepath=getattr(arguments, 'place'))
-    place_lookup: dict = {}  # "place_x:place_y": index in aquius['place']
-    max_population: int = 0
+    node_index = get_node_index(aquius=aquius, node_ids=list(range(len(aquius['node']))),
+                                precision=precision)
+    batch_size = max(1, getattr(arguments, 'batch', BATCH_ROWS))
+    # Node index: place row, of the last row matching that node
+    assigned: dict = {}
+    is_exact = np.zeros(len(aquius['node']), dtype=bool)
+    max_population = 0
+    row_count = 0
+    invalid_count = 0
+    exact_count = 0
+    try:
+        for columns, batch_count in read_batches(filepath=getattr(arguments, 'place'),
+                                                 batch_size=batch_size):
+            rows = parse_rows(columns=columns, row_count=batch_count, first_row=row_count)
+            row_count += batch_count
+            invalid_count += rows['invalid']
+            if len(rows['row_id']) > 0:
+                max_population = max(max_population, int(rows['place_population'].max()))
+            batch_assigned, is_matched = match_exact(node_index=node_index, rows=rows,
+                                                     precision=precision)
+            is_exact[list(batch_assigned)] = True
+            assigned.update({node: row for node, row in batch_assigned.items()
+                             if is_target[node]})
+            exact_count += int(is_matched.sum())
+    except (IOError, ValueError, csv.Error) as err:
+        logging.error("Cannot load %s: %s", arguments.place, err)
+        return
 
-    for _, place in enumerate(places):
+    near_count = 0
+    tolerance = getattr(arguments, 'tolerance', None)
+    # All nodes matching no row exactly are candidates, as in a full run, but only targets assigned
+    is_candidate = ~is_exact
+    candidate = np.flatnonzero(is_candidate[node_index.node_ids])
+    if (tolerance is not None and tolerance > 0 and len(candidate) > 0 and
+            exact_count < row_count - invalid_count):
+        # Second pass, once exact matches are known, so rows are not held in memory
+        tree = cKDTree(unit_xyz(node_index.xy[candidate]))
+        near: dict = {}  # Node index: (distance, place row) of nearest row
+        row_count = 0
         try:
-            node_x = to_precision(place.get("node_x", 0), precision)
-            node_y = to_precision(place.get("node_y", 0), precision)
-            place_x = to_precision(place.get("place_x", 0), precision)
-            place_y = to_precision(place.get("place_y", 0), precision)
-            place_name = place.get("place_name", "")
-            place_population = int(place.get("place_population", 0))
-        except ValueError:
-            continue
-
-        max_population = max(place_population, max_population)
-        place_target = f"{place_x}:{place_y}"
-        node_target = f"{node_x}:{node_y}"
-        node_index = node_lookup.get(node_target)
+            for columns, batch_count in read_batches(filepath=getattr(arguments, 'place'),
+                                                     batch_size=batch_size):
+                rows = parse_rows(columns=columns, row_count=batch_count, first_row=row_count)
+                row_count += batch_count
+                for node, (distance, row) in match_near(
+                        node_index=node_index, tree=tree, candidate=candidate, rows=rows,
+                        tolerance=tolerance, is_candidate=is_candidate,
+                        precision=precision).items():
+                    if node not in near or distance <= near[node][0]:
+                        near[node] = (distance, row)
+        except (IOError, ValueError, csv.Error) as err:
+            logging.error("Cannot load %s: %s", arguments.place, err)
+            return
+        near_count = len(set(row[0] for _, row in near.values()))
+        assigned.update({node: row for node, (_, row) in near.items() if is_target[node]})
 
-        if node_index is not None:
-            use_place_index = place_lookup.get(place_target, None)
-            if use_place_index is None:  # Create new place
-                use_place_index = len(aquius['place'])
-                place_lookup[place_target] = use_place_index
-                aquius['place'].append([
-                    place_x,
-                    place_y,
+    place_lookup: dict = {}  # "place_x:place_y": index in aquius['place']
+    for node, (_, place_x, place_y, place_name, place_population) in sorted(
+            assigned.items(), key=lambda item: item[1][0]):
+        new_place = [
+            place_x,
+            place_y,
+            {
+                "p": place_population,
+                "r": [
                     {
-                        "p": place_population,
-                        "r": [
-                            {
-                                "n": place_name
-                            }
-                        ]
+                        "n": place_name
                     }
-                ])
-            if not isinstance(aquius['node'][node_index][2], dict):
-                aquius['node'][node_index][2] = {}
-            if "place" in aquius['node'][node_index][2]:
-                aquius['node'][node_index][2]["place"] = use_place_index
-            else:
-                aquius['node'][node_index][2]["p"] = use_place_index
-
-    for index, node in enumerate(aquius['node']):
-        if len(node) < 3 or not isinstance(node[2], dict) or (
-                "p" not in node[2] and "place" not in node[2]):
-            logging.warning("Missing place in node: %s", node)
-
-    aquius["option"]["placeScale"] = get_place_scale(population=max_population)
+                ]
+            }
+        ]
+        place_target = f"{place_x}:{place_y}"
+        if source is not None:
+            use_place_index = match_place(place_index=place_index, place=new_place)
+        else:
+            use_place_index = place_lookup.get(place_target, None)
+        if use_place_index is None:  # Create new place
+            use_place_index = len(aquius['place'])
+            place_lookup[place_target] = use_place_index
+            for key in place_keys(place=new_place):
+                place_index.setdefault(key, use_place_index)
+            aquius['place'].append(new_place)
+        elif source is not None:  # Refresh existing place
+            aquius['place'][use_place_index] = new_place
+        if len(aquius['node'][node]) < 3:
+            aquius['node'][node].append({})
+        if not isinstance(aquius['node'][node][2], dict):
+            aquius['node'][node][2] = {}
+        if "place" in aquius['node'][node][2]:
+            aquius['node'][node][2]["place"] = use_place_index
+        else:
+            aquius['node'][node][2]["p"] = use_place_index
+
+    logging.warning("Place rows: %s matched exactly, %s within tolerance, %s matched no node, "
+                    "%s invalid", exact_count, near_count,
+                    row_count - invalid_count - exact_count - near_count, invalid_count)
+    node_ids = np.flatnonzero(is_target).tolist()
+    missing = [index for index in node_ids if get_node_place(
+        node=aquius['node'][index], place_count=len(aquius['place'])) is None]
+    for index in missing:
+        logging.debug("Missing place in node: %s", aquius['node'][index])
+    if missing:
+        logging.warning("Missing place in %s of %s nodes", len(missing), len(node_ids))
+
+    if source is not None:
+        aquius = collect_places(aquius=aquius)
+        set_place_fingerprint(aquius=aquius, source=source)
+        max_population = get_max_population(places=aquius['place'])
+    if max_population > 0:
+        aquius["option"]["placeScale"] = get_place_scale(population=max_population)
 
     save_json(data=aquius, filepath=getattr(arguments, 'aquius'))
 
@@ -5,24 +5,56 @@ In must contain at least fields "name" (as unique string) and "population" (inte
 Any other fields found will be copied into the Aquius place dictionary (albeit unused by default).
 Nodes (bus stops) within the area will be assigned that named place and associated data.
 The centroid of the area will be assigned as the notional geographic location of that place.
-Any prior place data is retained (so rerunning this script on the same aquius file will bloat it).
+Prepared boundaries (geometry, representative points, attributes and metric CRS copy) can be
+cached for later runs against the same file and CRS: --cache_dir cache (requires pyarrow).
+Several boundary files (levels, such as ward and district) can be assigned in one run, sharing
+the loaded nodes, each written to its own Aquius file in parallel: --geofile ward.gpkg dist.gpkg
+(by default aquius_ward.json, aquius_dist.json, else as --output).
+Large node sets are joined in spatial partitions of --partition nodes, each with only the
+boundaries within --nearest of it, across --workers processes.
+Any prior place data is retained (so rerunning this script on the same aquius file will bloat it),
+unless --incremental: Then existing places matching a boundary (by name, else coordinates) are
+reused, only nodes moved since the last incremental run (per a node fingerprint in meta) are
+joined, and places no longer referenced are removed. Prior places are read from the output.
 
 Usage: place_from_gis.py aquius.json --geofile geofile.gpkg
 See place_from_gis.py -h for further arguments
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import logging
+from math import cos, radians
+import os
 from pathlib import Path
-from typing import List, Optional
+from typing import List, NamedTuple, Optional
 
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
 
-from _common import get_common_args, get_place_scale, is_aquius, load_json, use_arrow, save_json
+from _common import (PLACE_FINGERPRINT, changed_nodes, clear_node_place, collect_places,
+                     get_common_args, get_max_population, get_node_place, get_place_scale,
+                     index_places, is_aquius, load_json, match_place, set_place_fingerprint,
+                     use_arrow, save_json)
+from aquius_compact import hilbert_index
 
 WGS84CRS = "EPSG:4326"
 NAME_COL = "name"
 POPULATION_COL = "population"
+METRES_PER_DEGREE = 110000  # Less than any degree of latitude, so buffers are generous
+CACHE_VERSION = "1"  # Increment if cached structure changes
+GEOMETRY_COLS = ["_geometry", "_metric", "_centroid"]  # Cached as WKB
+
+
+class PreparedBoundary(NamedTuple):
+    """Boundaries (WGS84, with attributes), their metric CRS copy, points and spatial index"""
+    boundary_gdf: gpd.GeoDataFrame
+    metric_gdf: gpd.GeoDataFrame
+    centroid: gpd.GeoSeries
+    tree: shapely.STRtree
 
 
 def get_args() -> argparse.Namespace:
@@ -33,9 +65,17 @@ def get_args() -> argparse.Namespace:
     parser.add_argument(
         "--geofile",
         dest="geofile",
-        nargs="?",
+        nargs="+",
         type=Path,
-        help="GIS boundary file - WGS84, column name (uniques) and population (integer)",
+        help="GIS boundary file(s) - WGS84, column name (uniques) and population (integer)",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        nargs="+",
+        type=Path,
+        default=None,
+        help="Output Aquius file per geofile, else aquius (one geofile) or aquius_geofile.json",
     )
     parser.add_argument(
         "--metric_crs",
@@ -58,6 +98,33 @@ def get_args() -> argparse.Namespace:
         default=5,
         help='coordinatePrecision (as GTFS To Aquius)',
     )
+    parser.add_argument(
+        "--partition",
+        dest="partition",
+        type=int,
+        default=250000,
+        help="Maximum nodes joined at once, lower to reduce memory use",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of partitions joined at the same time",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        dest="cache_dir",
+        type=Path,
+        default=None,
+        help="Directory of prepared boundary cache, else none",
+    )
+    parser.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help="Reuse places of the prior output, joining only nodes moved since",
+    )
 
     return parser.parse_args()
 
@@ -84,77 +151,380 @@ def load_geofile(filepath: Path, expected_crs: str, required_cols: List[str],
             return None
 
     if geo_gdf.crs != expected_crs:
-        geo_gdf.to_crs(crs=expected_crs)
+        geo_gdf = geo_gdf.to_crs(crs=expected_crs)
 
     return geo_gdf
 
 
+def boundary_cache_key(filepath: Path, metric_crs: str) -> str:
+    """Returns hash of filepath content and CRS"""
+
+    digest = hashlib.sha256()
+    with open(filepath, mode="rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(f"|{WGS84CRS}|{metric_crs}|{CACHE_VERSION}".encode())
+    return digest.hexdigest()
+
+
+def prepare_boundary(boundary_gdf: gpd.GeoDataFrame, metric_crs: str) -> PreparedBoundary:
+    """Returns boundary_gdf (WGS84) prepared for joins"""
+
+    boundary_gdf = boundary_gdf.reset_index(drop=True)
+    # representative_point ensures centroids are always within oddly-shaped boundary
+    return PreparedBoundary(
+        boundary_gdf=boundary_gdf,
+        metric_gdf=gpd.GeoDataFrame(geometry=boundary_gdf.geometry.to_crs(crs=metric_crs)),
+        centroid=boundary_gdf.geometry.representative_point(),
+        tree=shapely.STRtree(boundary_gdf.geometry.values),
+    )
+
+
+def save_prepared(filepath: Path, prepared: PreparedBoundary):
+    """Save prepared boundary to Arrow IPC file, geometries as WKB"""
+
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+    import pyarrow.ipc as ipc  # pylint: disable=import-outside-toplevel
+
+    table = pa.Table.from_pandas(pd.DataFrame(prepared.boundary_gdf.drop(
+        columns=prepared.boundary_gdf.geometry.name)), preserve_index=False)
+    for column, geometry in zip(GEOMETRY_COLS, [
+            prepared.boundary_gdf.geometry, prepared.metric_gdf.geometry, prepared.centroid]):
+        table = table.append_column(column, pa.array(shapely.to_wkb(geometry.values),
+                                                     type=pa.binary()))
+    partial = filepath.with_suffix(".partial")
+    try:
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        with pa.OSFile(str(partial), "wb") as sink:
+            with ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        partial.replace(filepath)
+    except (IOError, pa.ArrowException) as err:
+        logging.warning("Cannot cache %s: %s", filepath, err)
+
+
+def load_prepared(filepath: Path, metric_crs: str) -> Optional[PreparedBoundary]:
+    """Load prepared boundary from Arrow IPC file in one memory-mapped read, None on failure"""
+
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+    import pyarrow.ipc as ipc  # pylint: disable=import-outside-toplevel
+
+    try:
+        with pa.memory_map(str(filepath), "r") as source:
+            table = ipc.open_file(source).read_all()
+    except (IOError, pa.ArrowException) as err:
+        logging.warning("Cannot load cache %s: %s", filepath, err)
+        return None
+    geometry = {column: shapely.from_wkb(table.column(column).to_numpy(zero_copy_only=False))
+                for column in GEOMETRY_COLS}
+    boundary_gdf = gpd.GeoDataFrame(table.drop_columns(GEOMETRY_COLS).to_pandas(),
+                                    geometry=geometry["_geometry"], crs=WGS84CRS)
+    # A bulk-loaded STRtree is faster to rebuild than to unpickle
+    return PreparedBoundary(
+        boundary_gdf=boundary_gdf,
+        metric_gdf=gpd.GeoDataFrame(geometry=geometry["_metric"], crs=metric_crs),
+        centroid=gpd.GeoSeries(geometry["_centroid"], crs=WGS84CRS),
+        tree=shapely.STRtree(geometry["_geometry"]),
+    )
+
+
+def get_boundary(filepath: Path, metric_crs: str,
+                 cache_dir: Optional[Path]) -> Optional[PreparedBoundary]:
+    """Returns prepared boundary, from cache_dir if held, None on failure"""
+
+    cache_path = None
+    if cache_dir is not None:
+        if not use_arrow():
+            logging.warning("Boundary cache requires pyarrow")
+        else:
+            try:
+                cache_path = Path(cache_dir, f"{boundary_cache_key(filepath, metric_crs)}.arrow")
+            except IOError as err:
+                logging.error("Cannot load %s: %s", filepath, err)
+                return None
+            if cache_path.exists():
+                prepared = load_prepared(filepath=cache_path, metric_crs=metric_crs)
+                if prepared is not None:
+                    return prepared
+
+    # boundary_gdf also holds place data columns, only name and population required:
+    boundary_gdf = load_geofile(filepath=filepath, expected_crs=WGS84CRS,
+                                required_cols=[NAME_COL, POPULATION_COL], unique_cols=[NAME_COL])
+    if boundary_gdf is None:
+        return None
+    prepared = prepare_boundary(boundary_gdf=boundary_gdf, metric_crs=metric_crs)
+    if cache_path is not None:
+        save_prepared(filepath=cache_path, prepared=prepared)
+    return prepared
+
+
 def get_nodes(nodes: List[list], crs: str) -> gpd.GeoDataFrame:
     """Create point gdf from node list, id as position"""
 
-    features = []
-    for feature_id, node in enumerate(nodes):
-        features.append({
-            "id": feature_id,
-            "type": "Feature",
-            "properties": {"id": feature_id},
-            "geometry": {"type": "Point", "coordinates": (node[0], node[1])}
-        })
-    return gpd.GeoDataFrame.from_features(
-        {"type": "FeatureCollection", "features": features}, crs=crs)
-
-
-def add_place(aquius: dict, required_boundary_gdf: gpd.GeoDataFrame, precision: int) -> dict:
-    """Add required_boundary_gdf entries to aquius["place"] and return aquius"""
-
-    def _apply(*args, **kwargs) -> list:
-        place = [
-            round(args[0].x, precision),
-            round(args[0].y, precision),
-            {
-                "p": args[2],
-                "r": [{
-                    "n": args[1]
-                }]
-            }
-        ]
-        # Add any extra column data within references:
-        for position, key in enumerate(kwargs.get("target_cols")[kwargs.get("fixed_len"):]):
-            place[2][key] = args[position + kwargs.get("fixed_len")]
-        return place
-
-    fixed_cols = ["_centroid", NAME_COL, POPULATION_COL]  # Order of first three is fixed!
-    fixed_len = len(fixed_cols)
-    skip_cols = fixed_cols + ["geometry", "_place", "_boundary_index", "r", "reference"]
-    extra_cols = list(set(required_boundary_gdf.columns).difference(set(skip_cols)))
-    target_cols = fixed_cols + extra_cols
-
-    aquius["place"] = aquius["place"] + [
-        _apply(*row, target_cols=target_cols, fixed_len=fixed_len, precision=precision)
-        for row in required_boundary_gdf[target_cols].to_numpy()]  # Numpy retains data types
+    xy = np.array([node[:2] for node in nodes], dtype=np.float64).reshape(-1, 2)
+    return gpd.GeoDataFrame({"id": np.arange(len(nodes))},
+                            geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs=crs)
+
+
+def join_node_boundary(node_gdf: gpd.GeoDataFrame, prepared: PreparedBoundary,
+                       metric_crs: str, nearest: int) -> pd.DataFrame:
+    """
+    Returns lookup of node "id" to "_boundary_index", in two stages, both in metric_crs:
+    Nodes within (or on the edge of) only one boundary, by one vectorized STRtree query,
+    then only the remaining nodes joined to the nearest boundary within nearest
+    """
+
+    metric_node_gdf = node_gdf.to_crs(crs=metric_crs)
+    node_index, boundary_index = prepared.metric_gdf.sindex.query(
+        metric_node_gdf.geometry.values, predicate="intersects")
+    # Nodes on a shared edge intersect more than one boundary, so are left to the nearest join,
+    # which breaks the tie (as before). Both in metric_crs, since edges shift on reprojection
+    is_single = np.bincount(node_index, minlength=len(node_gdf))[node_index] == 1
+    within_df = pd.DataFrame({
+        "id": node_gdf["id"].to_numpy()[node_index[is_single]],
+        "_boundary_index": prepared.boundary_gdf.index.to_numpy()[boundary_index[is_single]],
+    })
+
+    remainder_gdf = metric_node_gdf[~np.isin(np.arange(len(node_gdf)), node_index[is_single])]
+    if remainder_gdf.empty:
+        return within_df
+    nearest_gdf = remainder_gdf.sjoin_nearest(
+        prepared.metric_gdf, how="inner", max_distance=nearest, distance_col="_metres")
+    nearest_df = pd.DataFrame({
+        "id": nearest_gdf["id"].to_numpy(),
+        "_boundary_index": nearest_gdf["index_right"].to_numpy(),
+    }).drop_duplicates(subset="id", keep="last")
+    return pd.concat([within_df, nearest_df], ignore_index=True)
+
+
+def join_partition(node_gdf: gpd.GeoDataFrame, boundary_gdf: gpd.GeoDataFrame,
+                   metric_gdf: gpd.GeoDataFrame, metric_crs: str, nearest: int) -> pd.DataFrame:
+    """Returns join_node_boundary() of one partition, given only its candidate boundaries"""
+
+    return join_node_boundary(node_gdf=node_gdf, prepared=PreparedBoundary(
+        boundary_gdf=boundary_gdf, metric_gdf=metric_gdf, centroid=None,
+        tree=shapely.STRtree(boundary_gdf.geometry.values)), metric_crs=metric_crs,
+        nearest=nearest)
+
+
+def join_node_boundary_partitioned(node_gdf: gpd.GeoDataFrame, prepared: PreparedBoundary,
+                                   args: argparse.Namespace) -> pd.DataFrame:
+    """
+    Returns join_node_boundary(), nodes partitioned into spatial tiles (consecutive along a
+    Hilbert curve) of at most args.partition nodes, joined across args.workers processes
+    Each partition is given only boundaries within its bbox buffered by args.nearest
+    """
+
+    partition = max(1, args.partition)
+    if len(node_gdf) <= partition:
+        return join_node_boundary(node_gdf=node_gdf, prepared=prepared,
+                                  metric_crs=args.metric_crs, nearest=args.nearest)
+
+    xy = np.stack([shapely.get_x(node_gdf.geometry.values),
+                   shapely.get_y(node_gdf.geometry.values)], axis=1)
+    valid = ~np.isnan(xy).any(axis=1)
+    order = np.flatnonzero(valid)[np.argsort(hilbert_index(xy[valid]), kind="stable")]
+    tasks = []
+    for start in range(0, len(order), partition):
+        tile = np.sort(order[start:start + partition])
+        minimum = xy[tile].min(axis=0)
+        maximum = xy[tile].max(axis=0)
+        # Degrees of longitude shrink towards the poles, so buffered at the highest latitude
+        y_buffer = 1.5 * args.nearest / METRES_PER_DEGREE
+        x_buffer = y_buffer / max(0.01, cos(radians(min(89.9, max(
+            abs(minimum[1]), abs(maximum[1])) + y_buffer))))
+        candidate = np.sort(prepared.tree.query(shapely.box(
+            minimum[0] - x_buffer, minimum[1] - y_buffer,
+            maximum[0] + x_buffer, maximum[1] + y_buffer)))
+        tasks.append((node_gdf.iloc[tile], prepared.boundary_gdf.iloc[candidate],
+                      prepared.metric_gdf.iloc[candidate]))
+
+    workers = max(1, min(args.workers or 1, len(tasks)))
+    if workers == 1:
+        joined = [join_partition(*task, args.metric_crs, args.nearest) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            joined = list(executor.map(join_partition, *zip(*tasks),
+                                       [args.metric_crs] * len(tasks),
+                                       [args.nearest] * len(tasks)))
+    # Partitions complete in any order, so sorted by node, as an unpartitioned join
+    return pd.concat(joined, ignore_index=True).sort_values(
+        "id", kind="stable", ignore_index=True)
+
+
+def place_source(filepath: Path, args: argparse.Namespace) -> str:
+    """Returns hash of boundary filepath and arguments altering places, as place fingerprint"""
+
+    return hashlib.sha256(f"{boundary_cache_key(filepath, args.metric_crs)}|{args.nearest}|"
+                          f"{args.precision}".encode()).hexdigest()
+
+
+def add_place(aquius: dict, required_boundary_gdf: gpd.GeoDataFrame, precision: int,
+              place_index: Optional[dict] = None) -> tuple[dict, np.ndarray]:
+    """
+    Add required_boundary_gdf entries to aquius["place"], returns aquius and place index of each
+    Entries matching place_index (as _common.index_places) replace that place, not appended
+    """
+
+    skip_cols = ["_centroid", NAME_COL, POPULATION_COL, "geometry", "_place", "_boundary_index",
+                 "r", "reference"]
+    extra_cols = [column for column in required_boundary_gdf.columns if column not in skip_cols]
+    # Columns as lists retain (native) data types, only combined per place when written
+    columns = {column: required_boundary_gdf[column].tolist()
+               for column in [NAME_COL, POPULATION_COL] + extra_cols}
+    centroid = shapely.get_coordinates(required_boundary_gdf["_centroid"].values).tolist()
+
+    places = [[
+        round(x, precision),
+        round(y, precision),
+        {
+            "p": columns[POPULATION_COL][position],
+            "r": [{
+                "n": columns[NAME_COL][position]
+            }],
+            # Add any extra column data within references:
+            **{column: columns[column][position] for column in extra_cols},
+        }
+    ] for position, (x, y) in enumerate(centroid)]
+    place_ids = np.arange(len(places), dtype=np.int64) + len(aquius["place"])
+    if place_index is None:
+        aquius["place"] = aquius["place"] + places
+        return aquius, place_ids
+
+    reused = set()
+    for position, place in enumerate(places):
+        match = match_place(place_index=place_index, place=place)
+        if match is None or match in reused:
+            place_ids[position] = len(aquius["place"])
+            aquius["place"].append(place)
+        else:
+            reused.add(match)
+            place_ids[position] = match
+            aquius["place"][match] = place
+    return aquius, place_ids
+
+
+def augment_node(aquius: dict, node_ids: np.ndarray, place_ids: np.ndarray) -> dict:
+    """Add place refence (place_ids) to node array at node_ids"""
+
+    for position, place in zip(node_ids.tolist(), place_ids.tolist()):
+        node = aquius["node"][position]
+        if len(node) < 3:
+            node.append({})
+        elif not isinstance(node[2], dict):
+            node[2] = {}
+        elif "place" in node[2]:  #Theoretical
+            del node[2]["place"]
+        node[2]["p"] = place
 
     return aquius
 
 
-def augment_node(aquius: dict, node_place_lookup: dict) -> dict:
-    """Add place refence to node array"""
-
-    for position, _ in enumerate(aquius["node"]):
-        if position in node_place_lookup:
-            if len(aquius["node"][position]) < 3 or not isinstance(
-                aquius["node"][position][2], dict):
-                aquius["node"][position][2] = {}
-            elif "place" in aquius["node"][position][2]:  #Theoretical
-                del aquius["node"][position][2]["place"]
-            aquius["node"][position][2]["p"] = node_place_lookup[position]
-
+def copy_aquius(aquius: dict) -> dict:
+    """Returns copy of aquius with node, place and option copied, such that they can be altered"""
+
+    copied = dict(aquius)
+    copied["node"] = [node[:2] + [dict(node[2])] + node[3:]
+                      if len(node) > 2 and isinstance(node[2], dict) else list(node)
+                      for node in aquius["node"]]
+    copied["place"] = list(aquius.get("place", []))
+    copied["option"] = dict(aquius.get("option", {}))
+    copied["meta"] = dict(aquius["meta"])
+    return copied
+
+
+def carry_prior(aquius: dict, prior: dict) -> dict:
+    """Returns aquius with the places, node places and place fingerprint of prior output"""
+
+    aquius["place"] = list(prior.get("place", []))
+    if PLACE_FINGERPRINT in prior["meta"]:
+        aquius["meta"][PLACE_FINGERPRINT] = prior["meta"][PLACE_FINGERPRINT]
+    else:
+        aquius["meta"].pop(PLACE_FINGERPRINT, None)
+    node_ids = []
+    place_ids = []
+    for node_id, node in enumerate(aquius["node"]):
+        clear_node_place(node=node)
+        if node_id < len(prior["node"]):
+            place = get_node_place(node=prior["node"][node_id], place_count=len(aquius["place"]))
+            if place is not None:
+                node_ids.append(node_id)
+                place_ids.append(place)
+    # Any node moved since is found by changed_nodes()
+    return augment_node(aquius=aquius, node_ids=np.array(node_ids, dtype=np.int64),
+                        place_ids=np.array(place_ids, dtype=np.int64))
+
+
+def place_level(aquius: dict, node_gdf: gpd.GeoDataFrame, prepared: PreparedBoundary,
+                args: argparse.Namespace, source: Optional[str] = None,
+                prior: Optional[dict] = None) -> dict:
+    """
+    Returns copy of aquius with places and node places of prepared boundary added
+    If source (place_source()), only nodes changed since prior (else aquius) are joined
+    """
+
+    aquius = copy_aquius(aquius=aquius)
+    place_index = None
+    if source is not None:
+        if prior is not None:
+            aquius = carry_prior(aquius=aquius, prior=prior)
+        node_ids = changed_nodes(aquius=aquius, source=source)
+        for node_id in node_ids:
+            clear_node_place(node=aquius["node"][node_id])
+        node_gdf = node_gdf.iloc[node_ids]
+        place_index = index_places(places=aquius["place"])
+    # node_boundary_df = lookup between node index and boundary index, distant nodes excluded:
+    node_boundary_df = join_node_boundary_partitioned(node_gdf=node_gdf, prepared=prepared,
+                                                      args=args)
+    is_required = prepared.boundary_gdf.index.isin(node_boundary_df["_boundary_index"])
+    required_boundary_gdf = prepared.boundary_gdf[is_required].copy()
+    # _centroid is POINT (n n) in WGS84:
+    required_boundary_gdf["_centroid"] = prepared.centroid.values[is_required]
+    aquius, place_ids = add_place(aquius=aquius, required_boundary_gdf=required_boundary_gdf,
+                                  precision=args.precision, place_index=place_index)
+    # Place index of each node is that of its boundary's position in required_boundary_gdf
+    node_place = place_ids[required_boundary_gdf.index.get_indexer(
+        node_boundary_df["_boundary_index"])]
+    aquius = augment_node(aquius=aquius, node_ids=node_boundary_df["id"].to_numpy(),
+                          place_ids=node_place)
+
+    population = 0
+    if source is not None:
+        aquius = collect_places(aquius=aquius)
+        set_place_fingerprint(aquius=aquius, source=source)
+        population = get_max_population(places=aquius["place"])
+    elif not required_boundary_gdf.empty:
+        population = required_boundary_gdf[POPULATION_COL].max()
+    if population > 0:
+        aquius["option"]["placeScale"] = get_place_scale(population=population)
     return aquius
 
 
-def main():
-    """Core script entrypoint"""
+def get_outputs(args: argparse.Namespace) -> Optional[List[Path]]:
+    """Returns output filepath of each geofile, None if --output does not match"""
 
-    args = get_args()
+    if args.output is not None:
+        if len(args.output) != len(args.geofile):
+            logging.error("Expected %s --output files, one per --geofile", len(args.geofile))
+            return None
+        return list(args.output)
+    if len(args.geofile) == 1:
+        return [args.aquius]
+    return [Path(args.aquius).with_name(f"{Path(args.aquius).stem}_{Path(geofile).stem}.json")
+            for geofile in args.geofile]
+
+
+def main(args=None):
+    """
+    Core script entrypoint
+    If provided, args namespace must contain all arguments, else read from command line
+    """
+
+    if args is None:
+        args = get_args()
+    outputs = get_outputs(args=args)
+    if outputs is None:
+        return
     aquius = load_json(filepath=args.aquius)
     if not is_aquius(aquius=aquius, skip_place=True):
         logging.error("Not an aquius file: %s", args.aquius)
@@ -162,41 +532,39 @@ def main():
     if "place" not in aquius:
         aquius["place"] = []
 
-    # boundary_gdf also holds place data columns, only name and population required:
-    boundary_gdf = load_geofile(filepath=args.geofile, expected_crs=WGS84CRS,
-                                required_cols=[NAME_COL, POPULATION_COL], unique_cols=[NAME_COL])
-    if boundary_gdf is None:
+    prepared_levels = []
+    for geofile in args.geofile:
+        prepared = get_boundary(filepath=geofile, metric_crs=args.metric_crs,
+                                cache_dir=args.cache_dir)
+        if prepared is None:
+            return
+        prepared_levels.append(prepared)
+
+    sources = [None] * len(args.geofile)
+    priors = [None] * len(args.geofile)
+    if args.incremental:
+        try:
+            sources = [place_source(filepath=geofile, args=args) for geofile in args.geofile]
+        except IOError as err:
+            logging.error("Cannot load %s: %s", args.geofile, err)
+            return
+        for position, output in enumerate(outputs):
+            if Path(output).exists() and Path(output).resolve() != Path(args.aquius).resolve():
+                prior = load_json(filepath=output)
+                if is_aquius(aquius=prior, skip_place=True):
+                    priors[position] = prior
+
+    # Nodes are loaded once, shared by every level
+    node_gdf = get_nodes(nodes=aquius["node"], crs=WGS84CRS)
+    levels = [place_level(aquius=aquius, node_gdf=node_gdf, prepared=prepared, args=args,
+                          source=source, prior=prior)
+              for prepared, source, prior in zip(prepared_levels, sources, priors)]
+
+    if len(levels) == 1:
+        save_json(data=levels[0], filepath=outputs[0])
         return
-
-    boundary_metric_gdf = boundary_gdf.to_crs(crs=args.metric_crs)
-    node_gdf = get_nodes(nodes=aquius["node"], crs=WGS84CRS).to_crs(crs=args.metric_crs)
-    node_boundary_gdf = node_gdf.sjoin_nearest(
-        boundary_metric_gdf, how="left", distance_col="_metres")
-    node_boundary_gdf.rename(columns={"index_right": "_boundary_index"}, inplace=True)
-    # Remove any distant nodes,
-    # then node_boundary_gdf = lookup between node index and boundary index:
-    node_boundary_gdf = node_boundary_gdf[node_boundary_gdf["_metres"] <= args.nearest]
-    required_boundary_ids: List[int] = node_boundary_gdf["_boundary_index"].unique().tolist()
-    required_boundary_gdf = boundary_gdf[boundary_gdf.index.isin(required_boundary_ids)].copy()
-    # _centroid is POINT (n n) in WGS84:
-    required_boundary_gdf["_centroid"] = required_boundary_gdf["geometry"].representative_point()
-    # representative_point ensures centroids are always within oddly-shaped boundary
-    # _place becomes the aquius place index, adjusted for any pre-existing places
-    new_place_count = len(required_boundary_gdf)
-    required_boundary_gdf.insert(
-        0, "_place", range(len(aquius["place"]), len(aquius["place"]) + new_place_count))
-    required_boundary_gdf["_boundary_index"] = required_boundary_gdf.index
-
-    aquius = add_place(
-        aquius=aquius, required_boundary_gdf=required_boundary_gdf, precision=args.precision)
-    node_place_df = node_boundary_gdf.merge(
-        required_boundary_gdf, how="left", on="_boundary_index")
-    node_place_lookup = node_place_df.set_index("id").to_dict()["_place"]
-    aquius = augment_node(aquius=aquius, node_place_lookup=node_place_lookup)
-    aquius["option"]["placeScale"] = get_place_scale(
-        population=required_boundary_gdf[POPULATION_COL].max())
-
-    save_json(data=aquius, filepath=args.aquius)
+    with ProcessPoolExecutor(max_workers=min(len(levels), os.cpu_count() or 1)) as executor:
+        list(executor.map(save_json, levels, outputs))
 
 
 if __name__ == '__main__':